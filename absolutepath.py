@@ -4,6 +4,8 @@ from inode import Inode
 from inodenumber import InodeNumber
 from filename import FileName
 
+logger = logging.getLogger(__name__)
+
 
 ## This class implements methods for absolute path layer
 
@@ -16,102 +18,79 @@ class AbsolutePathName:
     ## Maximum depth for symlink resolution to prevent infinite loops
     MAX_SYMLINK_DEPTH = 10
 
-    def _ResolveSymlink(self, inode_number, depth=0):
-        """If inode_number points to a symlink, follow the target and return the final inode number.
-        Returns the inode number of the resolved target, or -1 on error."""
+    def _ResolveSymlink(self, inode_number, inode_type, depth=0):
+        """If inode_number points to a symlink, follow the target and return the final (inode number, type).
+        inode_type comes from the dentry cache, so non-symlinks are returned without reading the inode.
+        Returns (-1, INODE_TYPE_INVALID) on error."""
+        if inode_type != fsconfig.INODE_TYPE_SYM:
+            return inode_number, inode_type
+
         if depth > self.MAX_SYMLINK_DEPTH:
-            logging.error("AbsolutePathName::_ResolveSymlink: too many levels of symlinks")
-            return -1
+            logger.error("AbsolutePathName::_ResolveSymlink: too many levels of symlinks")
+            return -1, fsconfig.INODE_TYPE_INVALID
 
         inobj = InodeNumber(inode_number)
         inobj.InodeNumberToInode(self.RawBlocks)
 
-        if inobj.inode.type != fsconfig.INODE_TYPE_SYM:
-            return inode_number
-
         # Read the symlink target path from the first data block
         target_block = self.RawBlocks.Get(inobj.inode.block_numbers[0])
         target_path = target_block[0:inobj.inode.size].decode("utf-8")
-        logging.debug("AbsolutePathName::_ResolveSymlink: following symlink -> " + target_path)
-
-        # Resolve the target path (could be absolute or relative)
-        resolved = self.GeneralPathToInodeNumber(target_path, 0)
-        if resolved == -1:
-            return -1
+        logger.debug("AbsolutePathName::_ResolveSymlink: following symlink -> %s", target_path)
+
+        # Resolve the target path (could be absolute or relative); the target's own symlinks
+        # are followed with one more level of depth
+        return self._ResolveGeneralPath(target_path, 0, depth + 1)
+
+    def _ResolvePath(self, path, dir, depth):
+        """Iteratively resolve a relative path, one component at a time, starting at dir.
+        Returns (inode number, inode type) of the final component, or (-1, INODE_TYPE_INVALID)."""
+        inode_number = dir
+        inode_type = fsconfig.INODE_TYPE_INVALID
+
+        for name in path.split("/"):
+            logger.debug("AbsolutePathName::_ResolvePath: name: %s, dir: %s", name, inode_number)
+            inode_number, inode_type = self.FileNameObject.LookupDentry(name, inode_number)
+            if inode_number == -1:
+                return -1, fsconfig.INODE_TYPE_INVALID
+            # Resolve symlinks for every path component
+            inode_number, inode_type = self._ResolveSymlink(inode_number, inode_type, depth)
+            if inode_number == -1:
+                return -1, fsconfig.INODE_TYPE_INVALID
+
+        return inode_number, inode_type
+
+    def _ResolveGeneralPath(self, path, cwd, depth):
+        if not path:
+            return -1, fsconfig.INODE_TYPE_INVALID
 
-        # Target could itself be a symlink, resolve recursively
-        return self._ResolveSymlink(resolved, depth + 1)
+        if path[0] == "/":
+            if len(path) == 1:  # special case: root
+                logger.debug(
+                    "AbsolutePathName::GeneralPathToInodeNumber: returning root inode 0"
+                )
+                return 0, fsconfig.INODE_TYPE_DIR
+            cut_path = path[1 : len(path)]
+            logger.debug("AbsolutePathName::GeneralPathToInodeNumber: cut_path: %s", cut_path)
+            return self._ResolvePath(cut_path, 0, depth)
+        else:
+            return self._ResolvePath(path, cwd, depth)
 
     def PathToInodeNumber(self, path, dir):
 
-        logging.debug(
-            "AbsolutePathName::PathToInodeNumber: path: "
-            + str(path)
-            + ", dir: "
-            + str(dir)
-        )
+        logger.debug("AbsolutePathName::PathToInodeNumber: path: %s, dir: %s", path, dir)
 
-        if "/" in path:
-            split_path = path.split("/")
-            first = split_path[0]
-            del split_path[0]
-            rest = "/".join(split_path)
-            logging.debug(
-                "AbsolutePathName::PathToInodeNumber: first: "
-                + str(first)
-                + ", rest: "
-                + str(rest)
-            )
-            d = self.FileNameObject.Lookup(first, dir)
-            if d == -1:
-                return -1
-            # Resolve symlinks for intermediate path components
-            d = self._ResolveSymlink(d)
-            if d == -1:
-                return -1
-            return self.PathToInodeNumber(rest, d)
-        else:
-            d = self.FileNameObject.Lookup(path, dir)
-            if d == -1:
-                return -1
-            # Resolve symlinks for the final path component
-            return self._ResolveSymlink(d)
+        inode_number, _ = self._ResolvePath(path, dir, 0)
+        return inode_number
 
     def GeneralPathToInodeNumber(self, path, cwd):
 
-        if not path:
-            return -1
-
-        logging.debug(
-            "AbsolutePathName::GeneralPathToInodeNumber: path: "
-            + str(path)
-            + ", cwd: "
-            + str(cwd)
-        )
+        logger.debug("AbsolutePathName::GeneralPathToInodeNumber: path: %s, cwd: %s", path, cwd)
 
-        if path[0] == "/":
-            if len(path) == 1:  # special case: root
-                logging.debug(
-                    "AbsolutePathName::GeneralPathToInodeNumber: returning root inode 0"
-                )
-                return 0
-            cut_path = path[1 : len(path)]
-            logging.debug(
-                "AbsolutePathName::GeneralPathToInodeNumber: cut_path: " + str(cut_path)
-            )
-            return self.PathToInodeNumber(cut_path, 0)
-        else:
-            return self.PathToInodeNumber(path, cwd)
+        inode_number, _ = self._ResolveGeneralPath(path, cwd, 0)
+        return inode_number
 
     def Link(self, target, name, cwd):
-        logging.debug(
-            "AbsolutePathName::Link: target="
-            + target
-            + ", name="
-            + name
-            + ", cwd="
-            + str(cwd)
-        )
+        logger.debug("AbsolutePathName::Link: target=%s, name=%s, cwd=%s", target, name, cwd)
 
         # Get the Inode of the Target
         # target_inode = self.FileNameObject.Lookup(target, cwd)
@@ -152,6 +131,7 @@ class AbsolutePathName:
 
         # Insert the New Link Entry
         self.FileNameObject.InsertFilenameInodeNumber(cwd_inode, name, target_inode)
+        self.FileNameObject.InvalidateDentry(cwd, name)
 
         # Increment Reference Count
         target_inode_obj.inode.refcnt += 1
@@ -160,11 +140,7 @@ class AbsolutePathName:
         return 0, "LINK CREATED"
 
     def Symlink(self, target, name, cwd):
-        logging.debug(
-            "AbsolutePathName::Symlink: target = {}, name = {}, cwd = {}".format(
-                target, name, cwd
-            )
-        )
+        logger.debug("AbsolutePathName::Symlink: target = %s, name = %s, cwd = %s", target, name, cwd)
 
         # Check if the target exists
         # target_inode = self.FileNameObject.Lookup(target, cwd)
@@ -224,6 +200,7 @@ class AbsolutePathName:
         )
         if result is not None:
             return -1, str(result)
+        self.FileNameObject.InvalidateDentry(cwd, name)
 
         # Store the inode in raw storage
         symlink_inode.StoreInode(self.RawBlocks)
@@ -0,0 +1,151 @@
+import argparse, os, time, logging
+import fsconfig
+import fslog
+import raid6
+from raidlayout import LAYOUTS
+
+## Micro-benchmarks of the client's hot paths, without block servers:
+##   raid6: throughput of the RAID-6 arithmetic (raid6.py), encoding (P and Q of a stripe) and decoding
+##     (recovery of missing blocks), in MB of stripe data per second, for each available backend
+##   mapping: cost of mapping logical blocks to servers (raidlayout.py), per block, one call at a time
+##     and by range, next to the per-call computation the lookup tables replace
+##   logging: cost of the debug messages of a Get and a Put (with a hex dump of the block) under each
+##     logging profile, formatted eagerly as before fslog.py and lazily as now, in ns per Get+Put
+## Example: python benchmark.py -bs 4096 -nd 6 > bench_output.txt
+
+
+## Runs function(*args) repeatedly for about duration seconds; returns the number of calls per second
+
+def Rate(function, args, duration):
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(0, 16):
+            function(*args)
+        calls += 16
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+def Recover(syndromes, data, p, q, missing):
+    raid6.Syndromes = syndromes
+    return raid6.Recover([None if i in missing else block for i, block in enumerate(data)],
+                         None if 'P' in missing else p, None if 'Q' in missing else q)
+
+
+## The block to server mapping as computed on every call before the lookup tables (RAID-5 only)
+
+def ComputedMapping(block_number):
+    datablock_per_stripe = fsconfig.NO_OF_SERVERS - 1
+    stripe_number = block_number // datablock_per_stripe
+    data_offset = block_number % datablock_per_stripe
+    parity_server_index = stripe_number % fsconfig.NO_OF_SERVERS
+    data_servers = [i for i in range(fsconfig.NO_OF_SERVERS) if i != parity_server_index]
+    data_server_index = data_servers[data_offset]
+    logging.debug(f"RAID 5: Block {block_number} -> Server {data_server_index}, Parity {parity_server_index}")
+    return data_server_index, stripe_number, parity_server_index
+
+
+def MapComputed(block_numbers):
+    for block_number in block_numbers:
+        ComputedMapping(block_number)
+
+
+def MapLookup(block_map, block_numbers):
+    for block_number in block_numbers:
+        block_map[block_number]
+
+
+def MapRanges(layout, chunk_blocks):
+    for first_block in range(0, fsconfig.TOTAL_NUM_BLOCKS, chunk_blocks):
+        layout.MapRange(first_block, chunk_blocks)
+
+
+def Mapping(args):
+    fsconfig.NO_OF_SERVERS = args.servers
+    fsconfig.TOTAL_NUM_BLOCKS = args.blocks
+    fsconfig.STRIPE_UNIT = args.stripe_unit
+    start = time.perf_counter()
+    layout = LAYOUTS[args.layout]()
+    setup = time.perf_counter() - start
+    blocks = range(0, fsconfig.TOTAL_NUM_BLOCKS)
+    # ranges of 16 stripes, as in a dump chunk
+    chunk_blocks = max(16 // layout.stripe_unit, 1) * layout.stripe_width
+
+    def PerBlock(function, function_args):
+        return format(1e9 / (Rate(function, function_args, args.duration) * len(blocks)), '.1f') + ' ns/block'
+
+    print('Mapping: ' + args.layout + ' layout, ' + str(args.servers) + ' servers, ' + str(args.blocks) + ' blocks, stripe unit ' + str(args.stripe_unit))
+    print('tables built in           : ' + format(setup * 1000, '.1f') + ' ms')
+    if args.layout == 'raid5' and args.stripe_unit == 1:
+        print('computed per call         : ' + PerBlock(MapComputed, (blocks,)))
+    print('table lookup per call     : ' + PerBlock(MapLookup, (layout.block_map, blocks)))
+    print('MapRange, ' + str(chunk_blocks).rjust(4) + ' blocks    : ' + PerBlock(MapRanges, (layout, chunk_blocks)))
+
+
+## The debug messages of a Get and a Put, formatted before the logging call, and lazily
+
+def EagerMessages(logger, block_number, block):
+    logger.debug(f'Get: Reading block number {block_number} using RAID 5')
+    logger.debug(f'Put: block number {block_number} len {len(block)}\n{block.hex()}')
+
+
+def LazyMessages(logger, block_number, block):
+    logger.debug('Get: Reading block number %d using RAID 5', block_number)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Put: block number %s len %s\n%s', block_number, len(block), block.hex())
+
+
+def Logging(args):
+    logger = logging.getLogger('benchmark')
+    logger.propagate = False
+    logger.addHandler(logging.FileHandler(os.devnull))
+    block = bytearray(os.urandom(args.block_size))
+
+    print('Logging: ' + str(args.block_size) + '-byte blocks')
+    for profile, level in sorted(fslog.PROFILES.items(), key=lambda item: item[1]):
+        logger.setLevel(level)
+        for name, messages in [('eager', EagerMessages), ('lazy', LazyMessages)]:
+            rate = Rate(messages, (logger, 1234, block), args.duration)
+            print((profile + ' ' + name).ljust(26) + ': ' + format(1e9 / rate, '.0f') + ' ns per Get+Put')
+
+
+def RAID6(args):
+    data = [bytearray(os.urandom(args.block_size)) for _ in range(0, args.data_blocks)]
+    megabytes = args.block_size * args.data_blocks / 1e6
+    backends = [('python', raid6.SyndromesPython)]
+    if raid6.numpy is not None:
+        backends.append(('numpy', raid6.SyndromesNumPy))
+    default_syndromes = raid6.Syndromes
+
+    print('RAID-6: ' + str(args.data_blocks) + ' data blocks of ' + str(args.block_size) + ' bytes per stripe')
+    for name, syndromes in backends:
+        p, q = syndromes(data)
+        print(name + ' encode P+Q        : ' + format(Rate(syndromes, (data,), args.duration) * megabytes, '.1f') + ' MB/s')
+        for missing in [(0,), (0, 'P'), (0, 1)]:
+            label = '+'.join('D' + str(m) if m not in ('P', 'Q') else m for m in missing)
+            rate = Rate(Recover, (syndromes, data, p, q, missing), args.duration)
+            print(name + ' decode ' + label.ljust(10) + ' : ' + format(rate * megabytes, '.1f') + ' MB/s')
+        raid6.Syndromes = default_syndromes
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-bs', '--block_size', type=int, default=4096, help='block size in bytes')
+    ap.add_argument('-nd', '--data_blocks', type=int, default=6, help='data blocks per stripe')
+    ap.add_argument('-t', '--duration', type=float, default=1.0, help='seconds per measurement')
+    ap.add_argument('-ns', '--servers', type=int, default=4, help='number of servers (mapping)')
+    ap.add_argument('-nb', '--blocks', type=int, default=65536, help='number of logical blocks (mapping)')
+    ap.add_argument('-su', '--stripe_unit', type=int, default=1, help='stripe unit in blocks (mapping)')
+    ap.add_argument('-rl', '--layout', default='raid5', choices=sorted(LAYOUTS), help='RAID layout (mapping)')
+    ap.add_argument('-b', '--benchmark', default='all', choices=['all', 'logging', 'mapping', 'raid6'], help='benchmark to run')
+    args = ap.parse_args()
+
+    if args.benchmark in ('all', 'raid6'):
+        RAID6(args)
+    if args.benchmark in ('all', 'mapping'):
+        Mapping(args)
+    if args.benchmark in ('all', 'logging'):
+        Logging(args)
@@ -1,6 +1,16 @@
 import pickle, logging
+import threading, time
+import os, mmap, struct
 import fsconfig
+import fslog
 import xmlrpc.client, socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from intentlog import IntentLog, DirtyRegionBitmap
+from raidlayout import ConfiguredLayout
+import raid6
+
+logger = logging.getLogger(__name__)
 
 
 #### BLOCK LAYER
@@ -27,48 +37,133 @@ class DiskBlocks():
         self.block_servers = {}
         for port in range(fsconfig.STARTPORT, fsconfig.STARTPORT + fsconfig.NO_OF_SERVERS):
             server_url = 'http://' + fsconfig.SERVER_ADDRESS + ':' + str(port)
-            self.block_servers[port] = xmlrpc.client.ServerProxy(server_url, use_builtin_types=True)
+            self.block_servers[port] = fslog.ServerProxy(server_url)
         socket.setdefaulttimeout(fsconfig.SOCKET_TIMEOUT)
 
         # Track servers that have been detected as failed (at-most-once / fail-fast)
         self.failed_servers = set()
 
+        # Worker threads used to contact several block servers in parallel (one per server)
+        self.executor = ThreadPoolExecutor(max_workers=fsconfig.NO_OF_SERVERS)
+
+        # RAID layout: placement of the logical blocks (and parity blocks) on the servers, as lookup tables
+        self.layout = ConfiguredLayout()
+
+        # Block cache: blocks read ahead of demand, by logical block number, oldest first
+        # An entry is handed out once (the next read of the block takes it) and dropped when the block is written
+        self.block_cache = OrderedDict()
+
+        # Change tracking for incremental dumps: one byte per logical block, set when the block is written;
+        # cleared when a dump is saved or loaded, whose identifier is kept as the base of the next delta
+        self.changed_blocks = bytearray(fsconfig.TOTAL_NUM_BLOCKS)
+        self.dump_id = None
+
+        # Client lock: held by a file system operation (Acquire/Release) and by the parity flusher
+        self.lock = threading.RLock()
+
+        # File system lock shared by the clients: a lease on lock LEASE_LOCK_NUMBER of the first block server,
+        # taken with RSM (an atomic test-and-set with expiry) by the outermost Acquire and given back by its
+        # Release; LEASE_TIME = 0 leaves the file system to a single client. The lease is renewed by a
+        # background thread while an operation runs. The lock server has its own proxy (and lease_mutex),
+        # as the renewing thread calls it concurrently with the operation's own calls to the first server
+        # While it holds no lease (or lost it), the client is fenced: Put, PutBlocks, FlushParity and ResyncStripes
+        # refuse to write. lease_expiry (time.monotonic()) is counted from before the call that took or renewed
+        # the lease, so it passes before the server's own expiry, when another client may take the lock
+        self.lock_depth = 0
+        self.lease_expiry = 0
+        self.lease_mutex = threading.Lock()
+        self.lock_server = fslog.ServerProxy('http://' + fsconfig.SERVER_ADDRESS + ':' + str(fsconfig.STARTPORT))
+        # Caches of the layers above (dentry cache, dedup index, ...), as functions dropping them: called with
+        # the block cache dropped when another client held the lock since this one last did (InvalidateCaches)
+        self.cache_invalidators = []
+        if fsconfig.LEASE_TIME > 0:
+            threading.Thread(target=self._LeaseRenewer, daemon=True).start()
+
+        # Deferred parity: pending parity updates (XOR of old and new data) by stripe number, folded into
+        # the parity blocks by a background thread every PARITY_FLUSH_INTERVAL seconds. The thread takes
+        # the client lock, so it only runs between file system operations
+        self.parity_deltas = {}
+        # (a one-block stripe's parity, a mirror copy, is written without reading anything: nothing to defer,
+        # nor is there a RAID-6 delta: Q changes differently for each data block of the stripe)
+        self.deferred_parity = fsconfig.PARITY_FLUSH_INTERVAL > 0 and self.layout.parity and self.layout.data_per_stripe > 1 \
+            and not self.layout.q_parity
+
+        # Write intents: stripes written recently, recorded in a local log file or in the dirty-region
+        # bitmap; after a crash, only the stripes recorded as dirty have their parity resynchronized
+        self.intent_log = None
+        if fsconfig.INTENT_LOG:
+            self.intent_log = IntentLog(fsconfig.INTENT_LOG)
+        elif fsconfig.DIRTY_REGION_STRIPES > 0:
+            self.intent_log = DirtyRegionBitmap(self)
+        if self.intent_log is not None:
+            self.Acquire()
+            self.intent_log.Reset(self.ResyncStripes(self.intent_log.Replay()))
+            self.Release()
+
+        # (pending updates left when the shell exits are folded by fsmain.py: an atexit hook would run after
+        # the executor used to reach the servers is shut down)
+        if self.deferred_parity:
+            threading.Thread(target=self._ParityFlusher, daemon=True).start()
+
+    def _Fenced(self, operation):
+        """Whether writes must be refused: with LEASE_TIME > 0, the client's lease on the file system lock expired,
+        was lost to another client, or was never taken (the write is outside Acquire/Release)."""
+        if fsconfig.LEASE_TIME > 0 and time.monotonic() >= self.lease_expiry:
+            logger.error('%s: write refused, this client does not hold the lease on the file system lock', operation)
+            return True
+        return False
+
     def getServerBlockAndParity(self, block_number):
         """
-        Calculate RAID 5 server mapping for a given block number.
-
-        In RAID 5, parity is distributed across all servers. For each stripe:
-        - Data blocks are stored on (N-1) servers
-        - Parity block is stored on 1 server
-        - Parity location rotates across servers for each stripe
+        Map a logical block to its servers, as placed by the RAID layout (see raidlayout.py).
 
         Args:
             block_number: Logical block number
 
         Returns:
-            tuple: (data_server_index, stripe_number, parity_server_index)
+            tuple: (data_server_index, stripe_number, parity_server_index); parity_server_index is
+            None in a layout without parity. The block is stored at offset
+            layout.stripe_offset[stripe_number] on its server.
         """
-        # Number of data blocks per stripe (excluding parity)
-        datablock_per_stripe = fsconfig.NO_OF_SERVERS - 1
+        return self.layout.block_map[block_number]
 
-        # Calculate stripe number and data block offset within the stripe
-        stripe_number = block_number // datablock_per_stripe
-        data_offset = block_number % datablock_per_stripe
-
-        # Calculate which server holds parity for this stripe (rotating parity)
-        parity_server_index = stripe_number % fsconfig.NO_OF_SERVERS
+    def getStripeBlockRange(self, block_number):
+        """
+        Return the logical block numbers that share block_number's stripe (and parity block).
 
-        # Calculate which server holds the data block
-        # Create list of all servers excluding the parity server
-        data_servers = [i for i in range(fsconfig.NO_OF_SERVERS) if i != parity_server_index]
-        data_server_index = data_servers[data_offset]
+        A stripe's data blocks are layout.stripe_unit logical blocks apart, so the result is a
+        range (contiguous with a one-block stripe unit) of up to layout.data_per_stripe block numbers.
+        """
+        return self.layout.StripeBlocks(self.layout.block_stripe[block_number])
 
-        logging.debug(
-            f"RAID 5 mapping: block_number={block_number}, stripe={stripe_number}, "
-            f"data_server={data_server_index}, parity_server={parity_server_index}, "
-            f"data_offset={data_offset}")
+    def getFullStripeRange(self, block_number):
+        """
+        Return the consecutive logical blocks around block_number that make up whole stripes.
 
-        return data_server_index, stripe_number, parity_server_index
+        These are the layout.stripe_width blocks of the layout.stripe_unit stripes sharing
+        block_number's placement (block_number's stripe alone with a one-block stripe unit):
+        writing all of them in one batch only writes full stripes.
+        """
+        first_block = block_number - block_number % self.layout.stripe_width
+        return range(first_block, min(first_block + self.layout.stripe_width, fsconfig.TOTAL_NUM_BLOCKS))
+
+    def getStripeParityServer(self, stripe_number):
+        """Return the index of the server holding the parity block of stripe stripe_number (None without parity)."""
+        return self.layout.stripe_parity_server[stripe_number]
+
+    def _StripeParityBlocks(self, stripe_number, data):
+        """Return the parity blocks of a stripe computed from its data blocks (in order), as (server, block) tuples."""
+        if self.layout.q_parity:
+            p, q = raid6.Syndromes(data)
+            return [(self.getStripeParityServer(stripe_number), p), (self.layout.stripe_q_server[stripe_number], q)]
+        return [(self.getStripeParityServer(stripe_number), self._XorBlocks(*data))]
+
+    def _XorBlocks(self, *blocks):
+        """XOR equally sized blocks together (computed on integers rather than byte by byte)"""
+        result = 0
+        for block in blocks:
+            result ^= int.from_bytes(block, byteorder='big')
+        return bytearray(result.to_bytes(fsconfig.BLOCK_SIZE, byteorder='big'))
 
     ## Put: interface to write a raw block of data to the block indexed by block number
     ## Blocks are padded with zeroes up to BLOCK_SIZE
@@ -77,12 +172,11 @@ class DiskBlocks():
         if server_proxy is None:
             server_proxy = self.block_servers[fsconfig.STARTPORT]
 
-        logging.debug(
-            f'Put: block number {block_number} len {len(block_data)}\n{block_data.hex()}'
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Put: block number %s len %s\n%s', block_number, len(block_data), block_data.hex())
 
         if len(block_data) > fsconfig.BLOCK_SIZE:
-            logging.error(f'Put: Block larger than BLOCK_SIZE: {len(block_data)}')
+            logger.error('Put: Block larger than BLOCK_SIZE: %s', len(block_data))
             raise RuntimeError(f'Put: Block larger than BLOCK_SIZE: {len(block_data)}')
 
         if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
@@ -93,246 +187,299 @@ class DiskBlocks():
             ret = server_proxy.SinglePut(block_number, putdata)
 
             if ret == -1:
-                logging.error('Put: Server returns error')
+                logger.error('Put: Server returns error')
                 return -1
 
             return 0  # Successfully written
         else:
-            logging.error(f'Put: Block out of range: {block_number}')
+            logger.error('Put: Block out of range: %s', block_number)
             raise RuntimeError(f'Put: Block out of range: {block_number}')
 
     def SingleGet(self, block_number, server_proxy=None):
         if server_proxy is None:
             server_proxy = self.block_servers[fsconfig.STARTPORT]
 
-        logging.debug('Get: ' + str(block_number))
+        logger.debug('Get: %s', block_number)
 
         if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(
-                f'DiskBlocks::Get: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
+            logger.error('DiskBlocks::Get: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
             raise RuntimeError(
                 f'DiskBlocks::Get: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
 
         if not server_proxy:
-            logging.error(f"Connection refused by server at port {fsconfig.STARTPORT}")
+            logger.error("Connection refused by server at port %s", fsconfig.STARTPORT)
             raise RuntimeError(f"Connection refused by server at port {fsconfig.STARTPORT}")
 
         # Call Get() method on the server and return the data as bytearray
         data = server_proxy.SingleGet(block_number)
         return bytearray(data)
 
-    def RAID1Put(self, block_number, block_data):
-        logging.debug(f'MultiPut: Writing block number {block_number} across multiple servers')
-
-        if len(block_data) > fsconfig.BLOCK_SIZE:
-            logging.error(f'MultiPut: Block larger than BLOCK_SIZE: {len(block_data)}')
-            raise RuntimeError(f'MultiPut: Block larger than BLOCK_SIZE: {len(block_data)}')
-
-        if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            putdata = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
-
-            # Iterate over all available servers and call SinglePut on each one
-            for port, server_proxy in self.block_servers.items():
-                if not server_proxy:
-                    logging.error(f"Connection refused by server on port {port}")
-                    raise RuntimeError(f"Connection refused by server on port {port}")
-
-                ret = server_proxy.Put(block_number, putdata)
-
-                if ret == -1:
-                    logging.error(f'MultiPut: Server on port {port} returned an error')
-                    raise RuntimeError(f'MultiPut: Server on port {port} returned an error')
-
-            return 0  # Successfully written to all servers
-        else:
-            logging.error(f'MultiPut: Block out of range: {block_number}')
-            raise RuntimeError(f'MultiPut: Block out of range: {block_number}')
-
-    def RAID1Get(self, block_number):
-        logging.debug(f'Get: Reading block number {block_number} across multiple servers')
-
-        if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(f'Get: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
-            raise IndexError(f'Block number {block_number} is out of range')
-
-        # Iterate over all available servers and call SingleGet
-        for port, server_proxy in self.block_servers.items():
-            if server_proxy is None:
-                logging.error(f"Connection refused by server on port {port}")
-                print(f"SERVER_DISCONNECTED GET {block_number}")
-                continue
-
-            data = server_proxy.Get(block_number)  # Attempt to get data from the server
-            if isinstance(data, str) and "CORRUPTED_BLOCK" in data:
-                print(f"CORRUPTED_BLOCK {block_number}")
-                logging.warning(f"Block {block_number} is corrupted. Attempting recovery...")
-                raise ValueError("Corrupted block")
-            logging.debug(f"Successfully fetched block {block_number} from server on port {port}")
-
-            return bytearray(data)  # Return the first successful result
-
-        # If no server succeeded, raise an error
-        logging.error(f"MultiGet: Failed to retrieve block {block_number} from any server")
-        raise RuntimeError(f"Failed to get block {block_number} from any server")
-
-    def RAID4Put(self, block_number, block_data):
-        logging.debug(f'Put: Writing block number {block_number} across servers')
-
-        if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(f'Put: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
+    def _compute_parity_from_scratch(self, stripe_number, data_server_index, parity_server_index, new_data):
+        """Compute parity by XORing new_data with all other data blocks in the stripe.
+        Used in degraded mode when the data server is down and we can't read old_data."""
+        new_parity = bytearray(new_data)
+        offset = self.layout.stripe_offset[stripe_number]
+        for i in self.layout.stripe_data_servers[stripe_number]:
+            if i != data_server_index:
+                port = fsconfig.STARTPORT + i
+                try:
+                    block = self.block_servers[port].Get(offset)
+                    if block and not (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
+                        new_parity = bytes([x ^ y for x, y in zip(new_parity, block)])
+                    else:
+                        logger.error("Cannot read valid data from server %s during degraded write", i)
+                        return None
+                except ConnectionRefusedError:
+                    self.failed_servers.add(i)
+                    logger.error("Server %s unreachable during degraded write", i)
+                    return None
+        return new_parity
 
-        # Identify the last server (parity server)
-        servers = list(self.block_servers.items())
-        parity_server_port = servers[-1][0]  # Last server in the list is the parity server
-        data_servers = servers[:-1]  # All servers except the last one are data servers
+    def _BeginStripeWrites(self, stripes):
+        """Record stripes in the intent log before their data and parity blocks are written.
+        Returns -1 if the record could not be written: the caller must not write the stripes."""
+        if self.intent_log is not None and stripes:
+            return self.intent_log.Begin(stripes)
+        return 0
 
-        # Distribute the data block across the data servers
-        server_index = block_number % len(data_servers)  # Decides which data server to use
-        blockno_slice = block_number // len(data_servers)  # This might change depending on how blocks are divided
+    def _EndStripeWrites(self, stripes):
+        """Record that the writes announced by _BeginStripeWrites are done."""
+        if self.intent_log is not None and stripes:
+            self.intent_log.End(stripes)
 
-        # Prepare the block data to ensure it's the correct size
-        putdata = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+    def ResyncStripes(self, stripes):
+        """
+        Recompute the parity of the given stripes from their data blocks (after a crash, parity may
+        be stale where a write was interrupted). All data blocks are read in one round of multicalls
+        and all parity blocks written in another.
 
-        # Store the data on the selected data server
-        try:
-            ret = data_servers[server_index][1].Put(blockno_slice, putdata)  # Assuming Put method is in server
-            if ret == -1:
-                logging.error(f'Put: Server on port {data_servers[server_index][0]} returned an error')
-                raise Exception(f"Failed to store data on data server {server_index}")
-        except ConnectionRefusedError:
-            print(f"SERVER_DISCONNECTED Put {block_number}")
+        Returns:
+            list: the stripes that could not be resynchronized (a server is unreachable)
+        """
+        stripes = [s for s in stripes if s < self.layout.total_stripes and self.getStripeParityServer(s) is not None]
+        if not stripes:
+            return []
+        if self._Fenced('ResyncStripes'):
+            return sorted(stripes)
+        logger.info('ResyncStripes: resynchronizing parity of %s stripes', len(stripes))
+
+        reads_by_server = {}
+        for stripe_number in stripes:
+            for i in self.layout.stripe_data_servers[stripe_number]:
+                reads_by_server.setdefault(i, []).append(stripe_number)
+        replies = self._MultiCallServers(self._StripeCalls('Get', reads_by_server))
+
+        # data blocks of each stripe, in order
+        data = dict((stripe_number, [None] * self.layout.data_per_stripe) for stripe_number in stripes)
+        unreadable = set()
+        for server_index, blocks in replies.items():
+            for i, stripe_number in enumerate(reads_by_server[server_index]):
+                block = blocks[i] if blocks is not None else None
+                if block is None or (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
+                    unreadable.add(stripe_number)
+                else:
+                    data[stripe_number][self.layout.stripe_data_servers[stripe_number].index(server_index)] = bytearray(block)
+
+        writes_by_server = {}
+        for stripe_number in stripes:
+            if stripe_number not in unreadable:
+                for server_index, parity in self._StripeParityBlocks(stripe_number, data[stripe_number]):
+                    writes_by_server.setdefault(server_index, []).append((stripe_number, parity))
+        replies = self._MultiCallServers(self._StripeCalls('Put', writes_by_server))
+        for server_index, reply in replies.items():
+            if reply is None:
+                unreadable.update(stripe for stripe, _ in writes_by_server[server_index])
+
+        if unreadable:
+            logger.error('ResyncStripes: could not resynchronize stripes %s', sorted(unreadable))
+        return sorted(unreadable)
+
+    def Put(self, block_number, block_data, old_data=None):
+        if self._Fenced('Put'):
+            return -1
+        stripes = []
+        if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+            stripes = [self.getServerBlockAndParity(block_number)[1]]
+            self.changed_blocks[block_number] = 1
+        if self._BeginStripeWrites(stripes) == -1:
+            logger.error('Put: write intent not recorded, block %s not written', block_number)
             return -1
-
-        # Fetch the old parity data from the parity server, if it exists
-        try:
-            old_parity = self.block_servers[parity_server_port].Get(blockno_slice)
-        except ConnectionRefusedError:
-            print(f"SERVER_DISCONNECTED Put {block_number}")
-            return -1  # Return error if parity server is down
-
-        # If old parity data does not exist (first time storing this block), initialize it to zeros
-        if old_parity is None:
-            old_parity = bytearray(fsconfig.BLOCK_SIZE)
-
-        # Subtract the old data from parity (XOR removes the old data)
-        old_data = data_servers[server_index][1].Get(blockno_slice)
-        parity_data = bytes([x ^ y for x, y in zip(old_parity, old_data)])
-
-        # Add the new data to the parity (XOR adds the new data)
-        parity_data = bytes([x ^ y for x, y in zip(parity_data, putdata)])
-
-        # Store the updated parity on the parity server
         try:
-            ret = self.block_servers[parity_server_port].Put(blockno_slice, parity_data)
-            if ret == -1:
-                logging.error(f'Put: Parity server on port {parity_server_port} returned an error')
-        except ConnectionRefusedError:
-            print(f"SERVER_DISCONNECTED Put {block_number}")
-
-        logging.debug(
-            f"Block {block_number} stored on Data Server {data_servers[server_index][0]} and Parity Server {parity_server_port}")
-        return 0  # Successfully written to all servers
-
-    ## Get: interface to read a raw block of data from block indexed by block number
-    ## Equivalent to the textbook's BLOCK_NUMBER_TO_BLOCK(b)
-
-    def RAID4Get(self, block_number):
-        logging.debug(f'Get: Reading block number {block_number} across multiple servers')
-
-        if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(f'Get: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
+            if self.layout.q_parity and stripes:
+                return self.RAID6PutBlocks({block_number: block_data})
+            if self.deferred_parity and stripes:
+                if self._DeferredPut(block_number, block_data, old_data) == 0:
+                    return 0
+                # the stripe cannot take a deferred update: its parity is brought up to date first
+                self.FlushParity(stripes)
+            return self.RAID5Put(block_number, block_data, old_data)
+        finally:
+            self._EndStripeWrites(stripes)
+
+    def _DeferredPut(self, block_number, block_data, old_data=None):
+        """
+        Write a data block right away and record the parity update (old data XOR new data) as
+        pending for its stripe, without reading or writing the parity block.
 
-        servers = list(self.block_servers.items())
-        parity_server_port = servers[-1][0]  # Last server in the list is the parity server
-        data_servers = servers[:-1]  # All servers except the last one are data servers
+        Returns:
+            int: 0 on success, -1 if the block must go through RAID5Put() instead (a server of the
+            stripe failed, or the old data cannot be read)
+        """
+        self.block_cache.pop(block_number, None)
 
-        # Assign the block data to the data servers
-        server_index = block_number % len(data_servers)  # Decide which data server to use
-        data_server_startport = data_servers[server_index][0]
-        blockno_slice = block_number // len(data_servers)
+        data_server_index, stripe_number, parity_server_index = self.getServerBlockAndParity(block_number)
+        if data_server_index in self.failed_servers or parity_server_index in self.failed_servers:
+            return -1
+        data_server_port = fsconfig.STARTPORT + data_server_index
+        offset = self.layout.stripe_offset[stripe_number]
 
-        # Try fetching the data block from the selected data server
+        putdata = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
         try:
-            data = data_servers[server_index][1].Get(blockno_slice)  # Attempt to get data from the data server
-            if isinstance(data, str) and "CORRUPTED_BLOCK" in data:
-                print(f"CORRUPTED_BLOCK {block_number}")
-                logging.warning(f"Block {block_number} is corrupted. Attempting recovery...")
-                raise ValueError("Corrupted block")
-            logging.debug(
-                    f"Successfully fetched block {blockno_slice} from data server on port {data_server_startport}")
-            return bytearray(data)
-
+            if old_data is not None:
+                old_data = bytearray(old_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+            else:
+                old_data = self.block_servers[data_server_port].Get(offset)
+                if old_data is None or (isinstance(old_data, str) and "CORRUPTED_BLOCK" in old_data):
+                    return -1
+            if self.block_servers[data_server_port].Put(offset, putdata) == -1:
+                return -1
         except ConnectionRefusedError:
-            print(f"SERVER_DISCONNECTED Get {block_number}")
+            self.failed_servers.add(data_server_index)
+            print(f"SERVER_DISCONNECTED PUT {block_number}")
+            return -1
 
-            # If data server is down, calculate missing data using parity
-            logging.debug(
-                f"Attempting to recover missing block {block_number} using parity data from parity server {parity_server_port}")
+        self._AddParityDelta(stripe_number, self._XorBlocks(old_data, putdata))
+        return 0
 
-            try:
-                parity_data = self.block_servers[parity_server_port].Get(blockno_slice)
-                logging.debug(
-                    f"Successfully fetched parity block {blockno_slice} from parity server on port {parity_server_port}")
-
-                # Recover missing block using XOR with parity and the available data blocks
-                recovered_data = bytearray(parity_data)
-
-                # XOR all the other data blocks to recover the missing one
-                for server_port, server in data_servers:
-                    if server_port != data_servers[server_index][0]:  # Only XOR with the other data servers
-                        try:
-                            data_block = server.Get(blockno_slice)  # Fetch data from the other servers
-                            recovered_data = bytes([x ^ y for x, y in zip(recovered_data, data_block)])
-                        except ConnectionRefusedError:
-                            print(f"SERVER_DISCONNECTED Get {block_number} during recovery")
+    def _AddParityDelta(self, stripe_number, delta):
+        """Accumulate a pending parity update for a stripe (deferred parity)."""
+        pending = self.parity_deltas.get(stripe_number)
+        if pending is None:
+            # the stripe's parity is stale until the update is folded: it stays dirty in the intent log
+            self._BeginStripeWrites([stripe_number])
+            self.parity_deltas[stripe_number] = delta
+        else:
+            self.parity_deltas[stripe_number] = self._XorBlocks(pending, delta)
 
-                logging.debug(f"Successfully recovered block {block_number} from parity data")
-                return bytearray(recovered_data)
+    def _DropParityDelta(self, stripe_number):
+        """Forget the pending parity update of a stripe (folded, or superseded by a new parity block)."""
+        if self.parity_deltas.pop(stripe_number, None) is not None:
+            self._EndStripeWrites([stripe_number])
 
-            except ConnectionRefusedError:
-                print(f"SERVER_DISCONNECTED Get {block_number} - Unable to recover missing data")
+    def FlushParity(self, stripes=None):
+        """
+        Fold the pending parity updates (deferred parity) into the parity blocks: one round of
+        multicalls reads the parity blocks, another writes them back. Updates for a parity server
+        known to have failed are dropped (repair recomputes its parity blocks from the data), and a
+        corrupted parity block is recomputed from the data of its stripe. An update whose parity
+        block could not be read stays pending, for the next fold to retry; a parity block that
+        could not be written is recomputed from the data as well. Until its parity is up to date,
+        a stripe stays dirty in the write intents.
 
-        return None  # Return None if all attempts fail
+        Args:
+            stripes: the stripes to fold (default: all stripes with pending updates)
 
-    def _compute_parity_from_scratch(self, stripe_number, data_server_index, parity_server_index, new_data):
-        """Compute parity by XORing new_data with all other data blocks in the stripe.
-        Used in degraded mode when the data server is down and we can't read old_data."""
-        new_parity = bytearray(new_data)
-        for i in range(fsconfig.NO_OF_SERVERS):
-            if i != data_server_index and i != parity_server_index:
-                port = fsconfig.STARTPORT + i
-                try:
-                    block = self.block_servers[port].Get(stripe_number)
-                    if block and not (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
-                        new_parity = bytes([x ^ y for x, y in zip(new_parity, block)])
+        Returns:
+            int: 0 on success, -1 if a parity block could not be updated
+        """
+        with self.lock:
+            if stripes is None:
+                stripes = list(self.parity_deltas)
+            stripes = sorted(s for s in stripes if s in self.parity_deltas)
+            if not stripes:
+                return 0
+            if self._Fenced('FlushParity'):
+                return -1
+            logger.debug('FlushParity: folding parity updates of stripes %s', stripes)
+
+            ret = 0
+            by_server = {}
+            for stripe_number in stripes:
+                parity_server_index = self.getStripeParityServer(stripe_number)
+                if parity_server_index in self.failed_servers:
+                    self._DropParityDelta(stripe_number)
+                else:
+                    by_server.setdefault(parity_server_index, []).append(stripe_number)
+
+            replies = self._MultiCallServers(self._StripeCalls('Get', by_server))
+            writes_by_server = {}
+            resync = []
+            for server_index, blocks in replies.items():
+                for i, stripe_number in enumerate(by_server[server_index]):
+                    parity = blocks[i] if blocks is not None else None
+                    if blocks is None:
+                        ret = -1
+                    elif parity is None or (isinstance(parity, str) and "CORRUPTED_BLOCK" in parity):
+                        resync.append(stripe_number)
                     else:
-                        logging.error(f"Cannot read valid data from server {i} during degraded write")
-                        return None
-                except ConnectionRefusedError:
-                    self.failed_servers.add(i)
-                    logging.error(f"Server {i} unreachable during degraded write")
-                    return None
-        return new_parity
+                        writes_by_server.setdefault(server_index, []).append(
+                            (stripe_number, self._XorBlocks(parity, self.parity_deltas[stripe_number])))
+
+            replies = self._MultiCallServers(self._StripeCalls('Put', writes_by_server))
+            for server_index, reply in replies.items():
+                for stripe_number, _ in writes_by_server[server_index]:
+                    if reply is None:
+                        # some of the parity blocks may have been written: recompute them rather than fold again
+                        resync.append(stripe_number)
+                    else:
+                        self._DropParityDelta(stripe_number)
+            if self._ResyncParityDeltas(resync):
+                ret = -1
+            return ret
+
+    def _ResyncParityDeltas(self, stripes):
+        """Recompute the parity of stripes with pending parity updates from their data, instead of folding the updates.
+        Returns the stripes that could not be resynchronized: they stay dirty in the write intents, for resync or repair."""
+        failed = self.ResyncStripes(stripes)
+        for stripe_number in stripes:
+            if stripe_number in failed:
+                self.parity_deltas.pop(stripe_number, None)
+            else:
+                self._DropParityDelta(stripe_number)
+        return failed
+
+    def _ParityFlusher(self):
+        """Background thread of deferred parity: folds the pending parity updates periodically."""
+        while True:
+            time.sleep(fsconfig.PARITY_FLUSH_INTERVAL)
+            self.FlushParity()
+
+    def RAID5Put(self, block_number, block_data, old_data=None):
+        logger.debug('Put: Writing block number %d using RAID 5', block_number)
+        if self._Fenced('Put'):
+            return -1
 
-    def Put(self, block_number, block_data):
-        logging.debug(f'Put: Writing block number {block_number} using RAID 5')
+        self.block_cache.pop(block_number, None)
 
         if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(f'Put: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
+            logger.error('Put: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
             return -1
 
         data_server_index, stripe_number, parity_server_index = self.getServerBlockAndParity(block_number)
+        offset = self.layout.stripe_offset[stripe_number]
         data_server_port = fsconfig.STARTPORT + data_server_index
-        parity_server_port = fsconfig.STARTPORT + parity_server_index
 
         putdata = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
 
+        # --- No parity (RAID-0): write the data block alone ---
+        if parity_server_index is None:
+            if data_server_index in self.failed_servers:
+                print(f"SERVER_DISCONNECTED PUT {block_number}")
+                return -1
+            try:
+                return 0 if self.block_servers[data_server_port].Put(offset, putdata) != -1 else -1
+            except ConnectionRefusedError:
+                self.failed_servers.add(data_server_index)
+                print(f"SERVER_DISCONNECTED PUT {block_number}")
+                return -1
+        parity_server_port = fsconfig.STARTPORT + parity_server_index
+
         data_failed = data_server_index in self.failed_servers
         parity_failed = parity_server_index in self.failed_servers
 
         # Cannot write if both servers in the stripe are failed
         if data_failed and parity_failed:
-            logging.error(f"Put: Both data server {data_server_index} and parity server {parity_server_index} are failed")
+            logger.error("Put: Both data server %s and parity server %s are failed", data_server_index, parity_server_index)
             return -1
 
         # --- Degraded mode: data server is known-failed ---
@@ -343,7 +490,7 @@ class DiskBlocks():
             if new_parity is None:
                 return -1
             try:
-                ret = self.block_servers[parity_server_port].Put(stripe_number, new_parity)
+                ret = self.block_servers[parity_server_port].Put(offset, new_parity)
                 if ret == -1:
                     return -1
                 return 0
@@ -357,7 +504,7 @@ class DiskBlocks():
             print(f"SERVER_DISCONNECTED PUT {block_number}")
             # Write data only, parity will be rebuilt on repair
             try:
-                ret = self.block_servers[data_server_port].Put(stripe_number, putdata)
+                ret = self.block_servers[data_server_port].Put(offset, putdata)
                 if ret == -1:
                     return -1
                 return 0
@@ -368,8 +515,10 @@ class DiskBlocks():
 
         # --- Normal mode: both servers available ---
         # Step 1: Read old parity
+        # (a stripe of a single data block needs no read: its parity is a copy of the new data)
+        single = len(self.getStripeBlockRange(block_number)) == 1
         try:
-            old_parity = self.block_servers[parity_server_port].Get(stripe_number)
+            old_parity = bytearray(fsconfig.BLOCK_SIZE) if single else self.block_servers[parity_server_port].Get(offset)
             if isinstance(old_parity, str) and "CORRUPTED_BLOCK" in old_parity:
                 old_parity = bytearray(fsconfig.BLOCK_SIZE)
             elif old_parity is None:
@@ -379,7 +528,7 @@ class DiskBlocks():
             self.failed_servers.add(parity_server_index)
             print(f"SERVER_DISCONNECTED PUT {block_number}")
             try:
-                ret = self.block_servers[data_server_port].Put(stripe_number, putdata)
+                ret = self.block_servers[data_server_port].Put(offset, putdata)
                 if ret == -1:
                     return -1
                 return 0
@@ -388,9 +537,14 @@ class DiskBlocks():
                 print(f"SERVER_DISCONNECTED PUT {block_number}")
                 return -1
 
-        # Step 2: Read old data
+        # Step 2: Read old data (unless the caller already has it)
         try:
-            old_data = self.block_servers[data_server_port].Get(stripe_number)
+            if single:
+                old_data = old_parity
+            elif old_data is not None:
+                old_data = bytearray(old_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+            else:
+                old_data = self.block_servers[data_server_port].Get(offset)
             if isinstance(old_data, str) and "CORRUPTED_BLOCK" in old_data:
                 old_data = bytearray(fsconfig.BLOCK_SIZE)
             elif old_data is None:
@@ -403,7 +557,7 @@ class DiskBlocks():
             if new_parity is None:
                 return -1
             try:
-                ret = self.block_servers[parity_server_port].Put(stripe_number, new_parity)
+                ret = self.block_servers[parity_server_port].Put(offset, new_parity)
                 if ret == -1:
                     return -1
                 return 0
@@ -414,9 +568,9 @@ class DiskBlocks():
 
         # Step 3: Write new data to data server
         try:
-            ret = self.block_servers[data_server_port].Put(stripe_number, putdata)
+            ret = self.block_servers[data_server_port].Put(offset, putdata)
             if ret == -1:
-                logging.error(f'Put: Data server {data_server_port} returned an error')
+                logger.error('Put: Data server %s returned an error', data_server_port)
                 return -1
         except ConnectionRefusedError:
             # Data server failed during write - flag it, still update parity
@@ -424,7 +578,7 @@ class DiskBlocks():
             print(f"SERVER_DISCONNECTED PUT {block_number}")
             parity_data = bytes([x ^ y ^ z for x, y, z in zip(old_parity, old_data, putdata)])
             try:
-                self.block_servers[parity_server_port].Put(stripe_number, parity_data)
+                self.block_servers[parity_server_port].Put(offset, parity_data)
                 return 0
             except ConnectionRefusedError:
                 self.failed_servers.add(parity_server_index)
@@ -436,9 +590,9 @@ class DiskBlocks():
 
         # Step 5: Write the updated parity
         try:
-            ret = self.block_servers[parity_server_port].Put(stripe_number, parity_data)
+            ret = self.block_servers[parity_server_port].Put(offset, parity_data)
             if ret == -1:
-                logging.error(f'Put: Parity server {parity_server_port} returned an error')
+                logger.error('Put: Parity server %s returned an error', parity_server_port)
                 return -1
         except ConnectionRefusedError:
             # Parity server failed after data was written - data is saved, parity is stale
@@ -447,34 +601,36 @@ class DiskBlocks():
             # Data write succeeded, so this is still a successful write
             return 0
 
-        logging.debug(
-            f"RAID 5: Block {block_number} stored on Data Server {data_server_port} and updated Parity Server {parity_server_port}")
+        logger.debug("RAID 5: Block %s stored on Data Server %s and updated Parity Server %s", block_number, data_server_port, parity_server_port)
 
         return 0
 
     def Get(self, block_number):
-        logging.debug(f'Get: Reading block number {block_number} using RAID 5')
+        logger.debug('Get: Reading block number %d using RAID 5', block_number)
+
+        if block_number in self.block_cache:
+            return self.block_cache.pop(block_number)
 
         if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            logging.error(f'Get: Block number {block_number} is out of range (0-{fsconfig.TOTAL_NUM_BLOCKS - 1})')
+            logger.error('Get: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
             return None
 
         data_server_index, stripe_number, parity_server_index = self.getServerBlockAndParity(block_number)
+        offset = self.layout.stripe_offset[stripe_number]
         data_server_port = fsconfig.STARTPORT + data_server_index
-        parity_server_port = fsconfig.STARTPORT + parity_server_index
 
         need_recovery = False
 
         # Step 1: Try to read from the primary data server (skip if known-failed)
         if data_server_index not in self.failed_servers:
             try:
-                data = self.block_servers[data_server_port].Get(stripe_number)
+                data = self.block_servers[data_server_port].Get(offset)
                 if isinstance(data, str) and "CORRUPTED_BLOCK" in data:
                     print(f"CORRUPTED_BLOCK {block_number}")
-                    logging.warning(f"Block {block_number} is corrupted. Attempting recovery...")
+                    logger.warning("Block %s is corrupted. Attempting recovery...", block_number)
                     need_recovery = True
                 else:
-                    logging.debug(f"Successfully fetched block {stripe_number} from data server on port {data_server_port}")
+                    logger.debug("Successfully fetched block %d from data server on port %d", stripe_number, data_server_port)
                     return bytearray(data)
             except ConnectionRefusedError:
                 self.failed_servers.add(data_server_index)
@@ -487,53 +643,453 @@ class DiskBlocks():
         if not need_recovery:
             return None
 
+        if self.layout.q_parity:
+            stripe = self.ReadStripe(stripe_number)
+            if stripe is None:
+                return None
+            logger.debug("Successfully recovered block %s using P and Q parity", block_number)
+            return stripe[0][self.layout.stripe_data_servers[stripe_number].index(data_server_index)]
+
+        if parity_server_index is None:
+            logger.error("Block %s cannot be recovered: the RAID layout has no parity", block_number)
+            return None
+        parity_server_port = fsconfig.STARTPORT + parity_server_index
+
         # Step 2: Recovery using parity and other data servers
-        logging.debug(f"Attempting to recover block {block_number} using parity server on port {parity_server_port}")
+        logger.debug("Attempting to recover block %s using parity server on port %s", block_number, parity_server_port)
 
         recovery_failures = 0
 
         try:
-            parity_data = self.block_servers[parity_server_port].Get(stripe_number)
+            parity_data = self.block_servers[parity_server_port].Get(offset)
             if not parity_data or (isinstance(parity_data, str) and "CORRUPTED_BLOCK" in parity_data):
-                logging.error(f"Failed to fetch valid parity data from parity server {parity_server_port}")
+                logger.error("Failed to fetch valid parity data from parity server %s", parity_server_port)
                 return None
 
-            logging.debug(f"Successfully fetched parity block {stripe_number} from parity server on port {parity_server_port}")
+            logger.debug("Successfully fetched parity block %s from parity server on port %s", stripe_number, parity_server_port)
 
-            # Initialize recovered data with parity
+            # Initialize recovered data with parity, including its pending updates (deferred parity)
             recovered_data = bytearray(parity_data)
+            if stripe_number in self.parity_deltas:
+                recovered_data = self._XorBlocks(recovered_data, self.parity_deltas[stripe_number])
 
             # XOR with data from all other servers in the stripe
-            for i in range(fsconfig.NO_OF_SERVERS):
-                if i != data_server_index and i != parity_server_index:
+            for i in self.layout.stripe_data_servers[stripe_number]:
+                if i != data_server_index:
                     server_port = fsconfig.STARTPORT + i
                     try:
-                        data_block = self.block_servers[server_port].Get(stripe_number)
+                        data_block = self.block_servers[server_port].Get(offset)
                         if data_block and not (isinstance(data_block, str) and "CORRUPTED_BLOCK" in data_block):
                             recovered_data = bytes([x ^ y for x, y in zip(recovered_data, data_block)])
                         else:
-                            logging.warning(f"No valid data from server {i} for stripe {stripe_number}")
+                            logger.warning("No valid data from server %s for stripe %s", i, stripe_number)
                             recovery_failures += 1
                     except ConnectionRefusedError:
                         self.failed_servers.add(i)
-                        logging.warning(f"Server {i} is unreachable during recovery")
+                        logger.warning("Server %s is unreachable during recovery", i)
                         recovery_failures += 1
 
             if recovery_failures > 0:
-                logging.error(
-                    f"RAID 5 recovery failed: {recovery_failures} additional server(s) unreachable during "
-                    f"recovery of block {block_number}. Cannot recover from 2+ failures in a stripe.")
+                logger.error("RAID 5 recovery failed: %s additional server(s) unreachable during recovery of block %s. "
+                             "Cannot recover from 2+ failures in a stripe.", recovery_failures, block_number)
                 return None
 
-            logging.debug(f"Successfully recovered block {block_number} using parity data")
+            logger.debug("Successfully recovered block %s using parity data", block_number)
             return bytearray(recovered_data)
 
         except ConnectionRefusedError:
             self.failed_servers.add(parity_server_index)
             print(f"SERVER_DISCONNECTED GET {block_number}")
-            logging.error(f"Parity server on port {parity_server_port} is unavailable")
+            logger.error("Parity server on port %s is unavailable", parity_server_port)
             return None
 
+    def _MultiCallServer(self, server_index, calls):
+        """Send several calls to one server with a single XML-RPC multicall.
+        calls is a list of (method name, args) tuples. Returns the list of results in order,
+        or None if the server is unreachable or does not support multicall."""
+        server_port = fsconfig.STARTPORT + server_index
+        multicall = xmlrpc.client.MultiCall(self.block_servers[server_port])
+        for method, args in calls:
+            getattr(multicall, method)(*args)
+        try:
+            return list(multicall())
+        except ConnectionRefusedError:
+            self.failed_servers.add(server_index)
+            return None
+        except xmlrpc.client.Fault as e:
+            logger.warning("Multicall to server %s failed: %s", server_index, e)
+            return None
+
+    def _StripeCalls(self, method, entries_by_server):
+        """Build multicalls reading ('Get': entries are stripe numbers) or writing ('Put': entries are
+        (stripe number, block) tuples) a block of each stripe, at the stripe's offset on the server."""
+        calls_by_server = {}
+        for server_index, entries in entries_by_server.items():
+            if method == 'Get':
+                calls_by_server[server_index] = [('Get', (self.layout.stripe_offset[stripe],)) for stripe in entries]
+            else:
+                calls_by_server[server_index] = [('Put', (self.layout.stripe_offset[stripe], block)) for stripe, block in entries]
+        return calls_by_server
+
+    def _MultiCallServers(self, calls_by_server):
+        """Issue one multicall per server, to all servers in parallel.
+        Returns dict: server_index -> list of results (None if that server failed)."""
+        futures = {}
+        for server_index, calls in calls_by_server.items():
+            futures[server_index] = self.executor.submit(self._MultiCallServer, server_index, calls)
+        return {server_index: future.result() for server_index, future in futures.items()}
+
+    def GetBlocks(self, block_numbers, prefetch=()):
+        """
+        Read several logical blocks with one round of RPCs.
+
+        Blocks are grouped by the data server that holds them; each server receives a single
+        multicall and all servers are contacted in parallel. Blocks that cannot be served this
+        way (failed server, corrupted block) fall back to Get(), which performs recovery.
+
+        Blocks found in the block cache are served from it. Blocks listed in prefetch ride along
+        in the same multicalls and are stored in the block cache instead of being returned; a
+        prefetched block that cannot be read is simply not cached.
+
+        Args:
+            block_numbers: iterable of logical block numbers (duplicates are read once)
+            prefetch: iterable of logical block numbers to read ahead into the block cache
+
+        Returns:
+            dict: block_number -> bytearray (None for blocks that could not be read)
+        """
+        logger.debug('GetBlocks: Reading block numbers %s using RAID 5', block_numbers)
+
+        results = {}
+        fallback = []
+        by_server = {}
+        demand = set(block_numbers)
+        for block_number in demand | set(prefetch):
+            if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                logger.error('GetBlocks: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
+                if block_number in demand:
+                    results[block_number] = None
+                continue
+            if block_number in self.block_cache:
+                if block_number in demand:
+                    results[block_number] = self.block_cache.pop(block_number)
+                continue
+            data_server_index = self.layout.block_server[block_number]
+            if data_server_index in self.failed_servers:
+                if block_number in demand:
+                    fallback.append(block_number)
+            else:
+                by_server.setdefault(data_server_index, []).append((block_number, self.layout.block_offset[block_number]))
+
+        replies = self._MultiCallServers(
+            {server_index: [('Get', (offset,)) for _, offset in entries] for server_index, entries in by_server.items()})
+
+        for server_index, data in replies.items():
+            entries = by_server[server_index]
+            if data is None:
+                fallback.extend(block_number for block_number, _ in entries if block_number in demand)
+                continue
+            for (block_number, _), block in zip(entries, data):
+                if isinstance(block, str) and "CORRUPTED_BLOCK" in block:
+                    if block_number in demand:
+                        fallback.append(block_number)
+                elif block_number in demand:
+                    results[block_number] = bytearray(block)
+                else:
+                    self.block_cache[block_number] = bytearray(block)
+
+        # Keep the block cache within its size, dropping the oldest entries
+        while len(self.block_cache) > fsconfig.BLOCK_CACHE_SIZE:
+            self.block_cache.popitem(last=False)
+
+        # Degraded path: one block at a time, with parity reconstruction
+        for block_number in fallback:
+            results[block_number] = self.Get(block_number)
+
+        return results
+
+    def PutBlocks(self, blocks, old_blocks=None):
+        """Write several logical blocks (see RAID5PutBlocks and RAID6PutBlocks), with one intent log record for the batch."""
+        if self._Fenced('PutBlocks'):
+            return -1
+        stripes = set()
+        for block_number in blocks:
+            if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                stripes.add(self.getServerBlockAndParity(block_number)[1])
+                self.changed_blocks[block_number] = 1
+        if self._BeginStripeWrites(stripes) == -1:
+            logger.error('PutBlocks: write intents not recorded, blocks %s not written', sorted(blocks))
+            return -1
+        try:
+            if self.layout.q_parity:
+                return self.RAID6PutBlocks(blocks)
+            return self.RAID5PutBlocks(blocks, old_blocks)
+        finally:
+            self._EndStripeWrites(stripes)
+
+    def RAID5PutBlocks(self, blocks, old_blocks=None):
+        """
+        Write several logical blocks with as few RPC rounds as possible.
+
+        Stripes whose data blocks are all part of the batch are written as full stripes: the new
+        parity is the XOR of the new data alone, so nothing is read. The other stripes are updated
+        with a batched read-modify-write: one round reads the old parity of every such stripe, and
+        the old contents of the blocks the caller did not supply in old_blocks; the new parity is
+        old parity XOR old data XOR new data. Every server then receives one multicall carrying all
+        of its data and parity blocks, in parallel. Stripes touching a failed server (or whose old
+        data cannot be read) go through Put() one block at a time. With deferred parity, the
+        read-modify-write stripes neither read nor write their parity: the change to it is recorded
+        as pending, and folded later by FlushParity().
+
+        Args:
+            blocks: dict block_number -> data (padded with zeroes to BLOCK_SIZE)
+            old_blocks: optional dict block_number -> current contents of that block, as already
+                known by the caller (saves reading it back for the parity update)
+
+        Returns:
+            int: 0 on success, -1 if any block could not be written
+        """
+        logger.debug('PutBlocks: Writing block numbers %s using RAID 5', blocks.keys())
+
+        if old_blocks is None:
+            old_blocks = {}
+
+        # Group the blocks by stripe
+        stripes = {}
+        for block_number, block_data in blocks.items():
+            if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                logger.error('PutBlocks: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
+                return -1
+            if len(block_data) > fsconfig.BLOCK_SIZE:
+                logger.error('PutBlocks: Block larger than BLOCK_SIZE: %s', len(block_data))
+                raise RuntimeError(f'PutBlocks: Block larger than BLOCK_SIZE: {len(block_data)}')
+            self.block_cache.pop(block_number, None)
+            stripe_range = self.getStripeBlockRange(block_number)
+            stripes.setdefault(stripe_range.start, {})[block_number] = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+
+        # parity for each stripe written in the batch: stripe number -> (parity server, parity or None until known)
+        parities = {}
+        # servers involved in each stripe, and the blocks of each stripe
+        stripe_servers = {}
+        stripe_blocks_by_number = {}
+        # read round of the read-modify-write stripes: server -> [(block number or None for parity, stripe number)]
+        reads_by_server = {}
+        fallback = {}
+        for first_block, stripe_blocks in stripes.items():
+            stripe_range = self.getStripeBlockRange(first_block)
+            _, stripe_number, parity_server_index = self.getServerBlockAndParity(first_block)
+            servers = [self.getServerBlockAndParity(b)[0] for b in stripe_blocks]
+            if parity_server_index is not None:
+                servers.append(parity_server_index)
+            if any(i in self.failed_servers for i in servers):
+                fallback.update(stripe_blocks)
+                continue
+            stripe_servers[stripe_number] = servers
+            stripe_blocks_by_number[stripe_number] = stripe_blocks
+            if parity_server_index is None:
+                # No parity (RAID-0): the data blocks alone are written
+                parities[stripe_number] = (None, None)
+                continue
+            if len(stripe_blocks) == len(stripe_range):
+                # Full stripe: parity straight from the new data (superseding any pending update)
+                parities[stripe_number] = (parity_server_index, self._XorBlocks(*stripe_blocks.values()))
+                continue
+            parities[stripe_number] = (parity_server_index, None)
+            if not self.deferred_parity:
+                reads_by_server.setdefault(parity_server_index, []).append((None, stripe_number))
+            for block_number in stripe_blocks:
+                if block_number not in old_blocks:
+                    data_server_index = self.getServerBlockAndParity(block_number)[0]
+                    reads_by_server.setdefault(data_server_index, []).append((block_number, stripe_number))
+
+        # Read round: old parity, and old data not supplied by the caller
+        replies = self._MultiCallServers(
+            {server_index: [('Get', (self.layout.stripe_offset[stripe],)) for _, stripe in entries] for server_index, entries in reads_by_server.items()})
+        old_data = {}
+        old_parity = {}
+        unreadable = set()
+        for server_index, data in replies.items():
+            for i, (block_number, stripe_number) in enumerate(reads_by_server[server_index]):
+                block = data[i] if data is not None else None
+                if block is None or (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
+                    unreadable.add(stripe_number)
+                elif block_number is None:
+                    old_parity[stripe_number] = bytearray(block)
+                else:
+                    old_data[block_number] = bytearray(block)
+        for stripe_number in unreadable:
+            fallback.update(stripe_blocks_by_number.pop(stripe_number))
+            del parities[stripe_number]
+            del stripe_servers[stripe_number]
+
+        # Write round: data and parity blocks of every stripe, one multicall per server
+        calls_by_server = {}
+        for stripe_number, stripe_blocks in stripe_blocks_by_number.items():
+            parity_server_index, parity = parities[stripe_number]
+            offset = self.layout.stripe_offset[stripe_number]
+            for block_number, block_data in sorted(stripe_blocks.items()):
+                data_server_index = self.getServerBlockAndParity(block_number)[0]
+                calls_by_server.setdefault(data_server_index, []).append(('Put', (offset, block_data)))
+            if parity_server_index is None:
+                continue
+            deferred = False
+            if parity is None:
+                # With deferred parity, the change to the parity is recorded instead of applied
+                deferred = self.deferred_parity
+                changes = [] if deferred else [old_parity[stripe_number]]
+                for block_number, block_data in stripe_blocks.items():
+                    if block_number in old_blocks:
+                        changes.append(bytearray(old_blocks[block_number]).ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+                    else:
+                        changes.append(old_data[block_number])
+                    changes.append(block_data)
+                parity = self._XorBlocks(*changes)
+            if deferred:
+                self._AddParityDelta(stripe_number, parity)
+                continue
+            self._DropParityDelta(stripe_number)
+            calls_by_server.setdefault(parity_server_index, []).append(('Put', (offset, parity)))
+
+        ret = 0
+        replies = self._MultiCallServers(calls_by_server)
+        failed = {server_index for server_index, reply in replies.items() if reply is None}
+        for stripe_number, servers in stripe_servers.items():
+            lost = [i for i in servers if i in failed]
+            if lost:
+                print(f"SERVER_DISCONNECTED PUT stripe {stripe_number}")
+            # One lost server per stripe is covered by parity (or the data it protects)
+            if len(lost) > (1 if self.layout.parity else 0):
+                logger.error("PutBlocks: %s servers failed while writing stripe %s", len(lost), stripe_number)
+                ret = -1
+
+        for block_number in sorted(fallback):
+            if self.Put(block_number, fallback[block_number], old_blocks.get(block_number)) == -1:
+                ret = -1
+
+        return ret
+
+    def ReadStripe(self, stripe_number, exclude=()):
+        """
+        Read all blocks of a RAID-6 stripe with one round of multicalls, and recover those missing
+        (on a failed or excluded server, or corrupted) from the others: up to two of them.
+
+        Args:
+            stripe_number: the stripe to read
+            exclude: servers whose blocks are treated as missing (e.g. a server being rebuilt)
+
+        Returns:
+            tuple: (list of data blocks, P, Q), or None if more than two blocks are missing
+        """
+        servers = list(self.layout.stripe_data_servers[stripe_number]) + \
+            [self.getStripeParityServer(stripe_number), self.layout.stripe_q_server[stripe_number]]
+        offset = self.layout.stripe_offset[stripe_number]
+        replies = self._MultiCallServers(dict((i, [('Get', (offset,))]) for i in servers
+                                              if i not in self.failed_servers and i not in exclude))
+        blocks = []
+        for i in servers:
+            block = replies[i][0] if replies.get(i) is not None else None
+            if block is None or (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
+                blocks.append(None)
+            else:
+                blocks.append(bytearray(block))
+        stripe = raid6.Recover(blocks[:-2], blocks[-2], blocks[-1])
+        if stripe is None:
+            logger.error("RAID 6 recovery failed: more than two blocks of stripe %s are missing", stripe_number)
+        return stripe
+
+    def RAID6PutBlocks(self, blocks):
+        """
+        Write several logical blocks in a RAID-6 layout.
+
+        Each stripe written is encoded whole: one round of multicalls reads the data blocks of the
+        stripes that are not part of the batch (a full stripe needs none), P and Q are computed
+        from the complete data, and a second round writes the new data, P and Q blocks, every
+        server receiving one multicall, in parallel. A stripe whose blocks cannot all be read is
+        read with ReadStripe() instead, which recovers up to two missing blocks. Blocks on failed
+        servers are not written: repair rebuilds them.
+
+        Args:
+            blocks: dict block_number -> data (padded with zeroes to BLOCK_SIZE)
+
+        Returns:
+            int: 0 on success, -1 if any block could not be written
+        """
+        logger.debug('PutBlocks: Writing block numbers %s using RAID 6', blocks.keys())
+
+        # Group the new blocks by stripe: stripe number -> {index in the stripe: data}
+        stripes = {}
+        for block_number, block_data in blocks.items():
+            if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                logger.error('PutBlocks: Block number %s is out of range (0-%s)', block_number, fsconfig.TOTAL_NUM_BLOCKS - 1)
+                return -1
+            if len(block_data) > fsconfig.BLOCK_SIZE:
+                logger.error('PutBlocks: Block larger than BLOCK_SIZE: %s', len(block_data))
+                raise RuntimeError(f'PutBlocks: Block larger than BLOCK_SIZE: {len(block_data)}')
+            self.block_cache.pop(block_number, None)
+            data_server_index, stripe_number, _ = self.getServerBlockAndParity(block_number)
+            index = self.layout.stripe_data_servers[stripe_number].index(data_server_index)
+            stripes.setdefault(stripe_number, {})[index] = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+
+        # Read round: the data blocks of each stripe that are not being written
+        data = dict((stripe_number, [None] * self.layout.data_per_stripe) for stripe_number in stripes)
+        reads_by_server = {}
+        degraded = set()
+        for stripe_number, new_blocks in stripes.items():
+            for index, server_index in enumerate(self.layout.stripe_data_servers[stripe_number]):
+                if index in new_blocks:
+                    data[stripe_number][index] = new_blocks[index]
+                elif server_index in self.failed_servers:
+                    degraded.add(stripe_number)
+                else:
+                    reads_by_server.setdefault(server_index, []).append((stripe_number, index))
+        replies = self._MultiCallServers(
+            {server_index: [('Get', (self.layout.stripe_offset[stripe],)) for stripe, _ in entries] for server_index, entries in reads_by_server.items()})
+        for server_index, replied in replies.items():
+            for i, (stripe_number, index) in enumerate(reads_by_server[server_index]):
+                block = replied[i] if replied is not None else None
+                if block is None or (isinstance(block, str) and "CORRUPTED_BLOCK" in block):
+                    degraded.add(stripe_number)
+                else:
+                    data[stripe_number][index] = bytearray(block)
+
+        # Degraded stripes: the blocks not being written are recovered from the rest of the stripe
+        ret = 0
+        for stripe_number in sorted(degraded):
+            stripe = self.ReadStripe(stripe_number)
+            if stripe is None:
+                del stripes[stripe_number]
+                ret = -1
+                continue
+            for index, block in enumerate(stripe[0]):
+                if index not in stripes[stripe_number]:
+                    data[stripe_number][index] = block
+
+        # Write round: new data, P and Q of every stripe, one multicall per server
+        calls_by_server = {}
+        for stripe_number, new_blocks in stripes.items():
+            offset = self.layout.stripe_offset[stripe_number]
+            writes = [(self.layout.stripe_data_servers[stripe_number][index], block) for index, block in sorted(new_blocks.items())]
+            writes += self._StripeParityBlocks(stripe_number, data[stripe_number])
+            for server_index, block in writes:
+                if server_index not in self.failed_servers:
+                    calls_by_server.setdefault(server_index, []).append(('Put', (offset, block)))
+        replies = self._MultiCallServers(calls_by_server)
+        failed = {server_index for server_index, reply in replies.items() if reply is None}
+
+        for stripe_number in stripes:
+            servers = list(self.layout.stripe_data_servers[stripe_number]) + \
+                [self.getStripeParityServer(stripe_number), self.layout.stripe_q_server[stripe_number]]
+            # servers known to have failed, and those whose multicall failed (unreachable, or a Fault)
+            lost = [i for i in servers if i in self.failed_servers or i in failed]
+            if lost:
+                print(f"SERVER_DISCONNECTED PUT stripe {stripe_number}")
+            # Two lost servers per stripe are covered by P and Q
+            if len(lost) > 2:
+                logger.error("PutBlocks: %s servers failed while writing stripe %s", len(lost), stripe_number)
+                ret = -1
+
+        return ret
+
     def verifyRAID5Consistency(self, block_number):
         """
         Verify that RAID 5 parity is consistent for a given block.
@@ -544,45 +1100,47 @@ class DiskBlocks():
         Returns:
             bool: True if consistent, False otherwise
         """
+        # Parity blocks are only consistent once their pending updates are folded (deferred parity)
+        self.FlushParity()
+
         data_server_index, stripe_number, parity_server_index = self.getServerBlockAndParity(block_number)
+        offset = self.layout.stripe_offset[stripe_number]
+
+        # Without parity, there is nothing to check
+        if parity_server_index is None:
+            return True
 
         # Get all data blocks in this stripe
         stripe_data = []
-        for i in range(fsconfig.NO_OF_SERVERS):
-            if i != parity_server_index:
-                server_port = fsconfig.STARTPORT + i
-                try:
-                    data = self.block_servers[server_port].Get(stripe_number)
-                    if data:
-                        stripe_data.append(data)
-                    else:
-                        stripe_data.append(bytearray(fsconfig.BLOCK_SIZE))
-                except ConnectionRefusedError:
-                    logging.warning(f"Server {i} unreachable during consistency check")
+        for i in self.layout.stripe_data_servers[stripe_number]:
+            server_port = fsconfig.STARTPORT + i
+            try:
+                data = self.block_servers[server_port].Get(offset)
+                if data:
+                    stripe_data.append(bytearray(data))
+                else:
                     stripe_data.append(bytearray(fsconfig.BLOCK_SIZE))
+            except ConnectionRefusedError:
+                logger.warning("Server %s unreachable during consistency check", i)
+                stripe_data.append(bytearray(fsconfig.BLOCK_SIZE))
 
-        # Calculate expected parity
-        expected_parity = bytearray(fsconfig.BLOCK_SIZE)
-        for data in stripe_data:
-            expected_parity = bytes([x ^ y for x, y in zip(expected_parity, data)])
+        # Compare the expected parity blocks (P, and Q in RAID-6) with the actual ones
+        for parity_server_index, expected_parity in self._StripeParityBlocks(stripe_number, stripe_data):
+            parity_port = fsconfig.STARTPORT + parity_server_index
+            try:
+                actual_parity = self.block_servers[parity_port].Get(offset)
+                if not actual_parity:
+                    actual_parity = bytearray(fsconfig.BLOCK_SIZE)
+            except ConnectionRefusedError:
+                logger.error("Parity server %s unreachable during consistency check", parity_server_index)
+                return False
 
-        # Get actual parity
-        parity_port = fsconfig.STARTPORT + parity_server_index
-        try:
-            actual_parity = self.block_servers[parity_port].Get(stripe_number)
-            if not actual_parity:
-                actual_parity = bytearray(fsconfig.BLOCK_SIZE)
-        except ConnectionRefusedError:
-            logging.error(f"Parity server {parity_server_index} unreachable during consistency check")
-            return False
+            if expected_parity != actual_parity:
+                logger.error("RAID 5 consistency check failed for block %s", block_number)
+                return False
 
-        # Compare
-        if expected_parity == actual_parity:
-            logging.debug(f"RAID 5 consistency verified for block {block_number}")
-            return True
-        else:
-            logging.error(f"RAID 5 consistency check failed for block {block_number}")
-            return False
+        logger.debug("RAID 5 consistency verified for block %d", block_number)
+        return True
 
     def verifyAllRAID5Consistency(self):
         """
@@ -594,97 +1152,273 @@ class DiskBlocks():
         Returns:
             bool: True if all stripes are consistent, False otherwise
         """
-        datablock_per_stripe = fsconfig.NO_OF_SERVERS - 1
-        total_stripes = (fsconfig.TOTAL_NUM_BLOCKS + datablock_per_stripe - 1) // datablock_per_stripe
         all_consistent = True
 
-        checked_stripes = set()
-        for block_number in range(fsconfig.TOTAL_NUM_BLOCKS):
-            _, stripe_number, parity_server_index = self.getServerBlockAndParity(block_number)
-            stripe_key = (stripe_number, parity_server_index)
-            if stripe_key in checked_stripes:
-                continue
-            checked_stripes.add(stripe_key)
+        for stripe_number in range(0, self.layout.total_stripes):
+            block_number = self.layout.StripeBlocks(stripe_number)[0]
+            parity_server_index = self.getStripeParityServer(stripe_number)
 
             if not self.verifyRAID5Consistency(block_number):
-                logging.error(f"Consistency check failed for stripe {stripe_number} "
-                              f"(parity server index {parity_server_index})")
+                logger.error("Consistency check failed for stripe %s (parity server index %s)", stripe_number, parity_server_index)
                 all_consistent = False
 
         if all_consistent:
-            logging.info("All RAID 5 stripes passed consistency check")
+            logger.info("All RAID 5 stripes passed consistency check")
         else:
-            logging.error("One or more RAID 5 stripes failed consistency check")
+            logger.error("One or more RAID 5 stripes failed consistency check")
 
         return all_consistent
 
-    ## RSM: read and set memory equivalent
-    ## Single-client design: RSM always returns success (unlocked) without contacting the server.
-    ## Since there is only one client, mutual exclusion is guaranteed by design.
+    ## RSM: read and set memory equivalent, on the lease table of the lock server (see blockserver.py)
+    ## Takes (or renews) the lease on lock lock_number for LEASE_TIME seconds: the server grants it if the lock
+    ## is free, its lease expired or this client holds it already, atomically (it serves one call at a time)
+    ## Returns (granted, client id of the last holder (-1 if none), seconds left on the holder's lease)
+    ## The caller holds lease_mutex
 
-    def RSM(self, block_number):
-        logging.debug('RSM: ' + str(block_number))
-        if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            # Single-client: no need to contact the server, just return unlocked
-            return bytearray(fsconfig.RSM_UNLOCKED.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+    def RSM(self, lock_number):
+        logger.debug('RSM: %s', lock_number)
+        granted, holder, remaining = self.lock_server.RSM(lock_number, self.clientID, fsconfig.LEASE_TIME)
+        return granted, holder, remaining
 
-        logging.error('RSM: Block number larger than TOTAL_NUM_BLOCKS: ' + str(block_number))
-        raise RuntimeError('RSM: Block number larger than TOTAL_NUM_BLOCKS: ' + str(block_number))
+    def _TakeLease(self):
+        """
+        Take the lease on the file system lock, waiting while another client holds it (and while the
+        lock server is unreachable). If another client held the lock since this one last did, it may
+        have written anything: the caches are dropped.
+        """
+        while True:
+            try:
+                with self.lease_mutex:
+                    start = time.monotonic()
+                    granted, holder, remaining = self.RSM(fsconfig.LEASE_LOCK_NUMBER)
+                    if granted:
+                        self.lease_expiry = start + fsconfig.LEASE_TIME
+            except (ConnectionRefusedError, socket.timeout) as e:
+                logger.error('Acquire: lock server unreachable (%s), retrying in %s s', e, fsconfig.RETRY_INTERVAL)
+                time.sleep(fsconfig.RETRY_INTERVAL)
+                continue
+            if granted:
+                break
+            logger.debug('Acquire: lock held by client %s for %.3f s more', holder, remaining)
+            time.sleep(min(remaining, fsconfig.LEASE_POLL_INTERVAL))
+
+        if holder != self.clientID:
+            logger.info('Acquire: lock handed off by client %s, dropping the caches', holder)
+            self.InvalidateCaches()
+        # parity updates left pending by an operation fenced off when it lost the lease: other clients may have
+        # written the stripes since, so their parity is recomputed from the data
+        if self.parity_deltas:
+            self._ResyncParityDeltas(sorted(self.parity_deltas))
+
+    def _LeaseRenewer(self):
+        """Background thread of the lease: renews it every third of LEASE_TIME while an operation holds the lock."""
+        while True:
+            time.sleep(fsconfig.LEASE_TIME / 3)
+            with self.lease_mutex:
+                # (a lease lost during the operation is not taken back: it stays fenced until its Release)
+                if self.lock_depth == 0 or self.lease_expiry == 0:
+                    continue
+                try:
+                    start = time.monotonic()
+                    granted, holder, _ = self.RSM(fsconfig.LEASE_LOCK_NUMBER)
+                except (ConnectionRefusedError, socket.timeout) as e:
+                    logger.error('LeaseRenewer: lock server unreachable (%s)', e)
+                    continue
+                # another holder in between may have written what this client cached or is writing
+                if granted and holder == self.clientID:
+                    self.lease_expiry = start + fsconfig.LEASE_TIME
+                else:
+                    self.lease_expiry = 0
+                    logger.error('LeaseRenewer: lease lost to client %s during an operation, writes are refused', holder)
+
+    def InvalidateCaches(self):
+        """Drop the block cache and the caches of the layers above (raw storage changed under them)."""
+        logger.debug('InvalidateCaches')
+        self.block_cache.clear()
+        for invalidate in self.cache_invalidators:
+            invalidate()
 
-        ## Acquire and Release using a disk block lock
+    ## Acquire and Release the file system lock: the client lock, and with LEASE_TIME > 0 the lease on the
+    ## lock server, taken by the outermost Acquire and given back by its Release (calls may nest)
 
     def Acquire(self):
-        # Single-client design: no locking needed, return immediately
-        logging.debug('Acquire: no-op (single client)')
+        logger.debug('Acquire: depth %s', self.lock_depth)
+        self.lock.acquire()
+        if self.lock_depth == 0 and fsconfig.LEASE_TIME > 0:
+            self._TakeLease()
+        self.lock_depth += 1
         return 0
 
     def Release(self):
-        # Single-client design: no locking needed, return immediately
-        logging.debug('Release: no-op (single client)')
+        logger.debug('Release: depth %s', self.lock_depth)
+        if self.lock_depth == 1 and fsconfig.LEASE_TIME > 0:
+            # the next holder must find the parity blocks up to date (deferred parity only defers within an operation)
+            self.FlushParity()
+            held = True
+            try:
+                with self.lease_mutex:
+                    self.lock_depth = 0
+                    self.lease_expiry = 0
+                    held = self.lock_server.Unlock(fsconfig.LEASE_LOCK_NUMBER, self.clientID)
+            except (ConnectionRefusedError, socket.timeout) as e:
+                logger.error('Release: lock server unreachable (%s), the lease will expire', e)
+            if not held:
+                logger.error('Release: lease expired during the operation, another client may have taken the lock')
+        else:
+            self.lock_depth -= 1
+        self.lock.release()
         return 0
 
-    ## Serializes and saves the DiskBlocks block[] data structure to a "dump" file on your disk
-
-    def DumpToDisk(self, filename):
+    ## Dump files: a header, then chunks of blocks, then an empty chunk marking the end
+    ## header: DUMP_MAGIC, format version, the file system constants the dump was made with, the dump's
+    ## identifier and the identifier of the dump it is a delta of (zero for a full dump)
+    ## chunk: first block number, number of blocks, then the blocks (BLOCK_SIZE bytes each)
+    ## The chunks of a full dump hold DUMP_CHUNK_STRIPES whole stripes, so loading them writes full stripes;
+    ## those of a delta hold runs of the blocks written since its base dump was saved or loaded
+
+    DUMP_HEADER = struct.Struct('>8sHIIIIII16s16s')
+    DUMP_CHUNK_HEADER = struct.Struct('>II')
+    NO_DUMP_ID = bytes(16)
+
+    def _DumpConstants(self):
+        return (fsconfig.BLOCK_SIZE, fsconfig.TOTAL_NUM_BLOCKS, fsconfig.INODE_SIZE, fsconfig.MAX_NUM_INODES,
+                fsconfig.MAX_FILENAME, fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
+
+    def _DumpChunks(self, changed=None):
+        """Yield (first block number, number of blocks) for the chunks of a dump (of the changed blocks only, if given)."""
+        # (whole groups of stripe_unit stripes, so that loading a chunk writes full stripes)
+        chunk_blocks = max(fsconfig.DUMP_CHUNK_STRIPES // self.layout.stripe_unit, 1) * self.layout.stripe_width
+        for first_block in range(0, fsconfig.TOTAL_NUM_BLOCKS, chunk_blocks):
+            last_block = min(first_block + chunk_blocks, fsconfig.TOTAL_NUM_BLOCKS)
+            if changed is None:
+                yield first_block, last_block - first_block
+                continue
+            run_start = None
+            for block_number in range(first_block, last_block + 1):
+                if block_number < last_block and changed[block_number]:
+                    if run_start is None:
+                        run_start = block_number
+                elif run_start is not None:
+                    yield run_start, block_number - run_start
+                    run_start = None
+
+    ## Saves the contents of all blocks to a "dump" file on your disk
+    ## With incremental, only the blocks written since the last dump saved or loaded are saved, as a delta
+    ## to be loaded on top of that dump
+    ## The file is written chunk by chunk as the blocks are read, one GetBlocks() per chunk
+    ## Returns 0, or -1 if a block cannot be read
+
+    def DumpToDisk(self, filename, incremental=False):
+
+        logger.info("DiskBlocks::DumpToDisk: Dumping blocks to file %s", filename)
+        if incremental and self.dump_id is None:
+            print("DiskBlocks::DumpToDisk: Error: no dump saved or loaded yet for an incremental dump to apply to")
+            return -1
 
-        logging.info("DiskBlocks::DumpToDisk: Dumping pickled blocks to file " + filename)
-        # Collect all blocks via self.Get() into a list
-        all_blocks = []
-        for i in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            all_blocks.append(self.Get(i))
-        file_system_constants = "BS_" + str(fsconfig.BLOCK_SIZE) + "_NB_" + str(
-            fsconfig.TOTAL_NUM_BLOCKS) + "_IS_" + str(fsconfig.INODE_SIZE) \
-                                + "_MI_" + str(fsconfig.MAX_NUM_INODES) + "_MF_" + str(
-            fsconfig.MAX_FILENAME) + "_IDS_" + str(fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
+        # blocks written from now on belong to the next delta
+        changed = self.changed_blocks
+        self.changed_blocks = bytearray(fsconfig.TOTAL_NUM_BLOCKS)
+        dump_id = os.urandom(len(self.NO_DUMP_ID))
+        base_id = self.dump_id if incremental else self.NO_DUMP_ID
         with open(filename, 'wb') as file:
-            pickle.dump(file_system_constants, file)
-            pickle.dump(all_blocks, file)
+            file.write(self.DUMP_HEADER.pack(fsconfig.DUMP_MAGIC, fsconfig.DUMP_VERSION, *self._DumpConstants(), dump_id, base_id))
+            for first_block, count in self._DumpChunks(changed if incremental else None):
+                blocks = self.GetBlocks(range(first_block, first_block + count))
+                file.write(self.DUMP_CHUNK_HEADER.pack(first_block, count))
+                for block_number in range(first_block, first_block + count):
+                    if blocks[block_number] is None:
+                        print("DiskBlocks::DumpToDisk: Error: block " + str(block_number) + " cannot be read")
+                        self.changed_blocks = bytearray(a | b for a, b in zip(changed, self.changed_blocks))
+                        return -1
+                    file.write(bytes(blocks[block_number]).ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+            file.write(self.DUMP_CHUNK_HEADER.pack(0, 0))
+        self.dump_id = dump_id
+        return 0
 
-    ## Loads DiskBlocks block[] data structure from a "dump" file on your disk
+    ## Loads the contents of all blocks from a "dump" file on your disk
+    ## A delta is only loaded on top of its base dump (just loaded or saved, with no write since)
+    ## The file is memory-mapped and written chunk by chunk, one PutBlocks() per chunk
+    ## Dumps in the former pickle format are still accepted
+    ## Returns 0, or -1 if the file does not match the file system or is malformed
 
     def LoadFromDump(self, filename):
 
-        logging.info("DiskBlocks::LoadFromDump: Reading blocks from pickled file " + filename)
+        logger.info("DiskBlocks::LoadFromDump: Reading blocks from file %s", filename)
+        with open(filename, 'rb') as file:
+            if file.read(len(fsconfig.DUMP_MAGIC)) != fsconfig.DUMP_MAGIC:
+                file.seek(0)
+                return self._DumpLoaded(self._LoadFromPickledDump(file), None)
+            if os.fstat(file.fileno()).st_size < self.DUMP_HEADER.size:
+                print("DiskBlocks::LoadFromDump: Error: File not in proper format, header is truncated")
+                return -1
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+                header = self.DUMP_HEADER.unpack_from(dump, 0)
+                if header[1] != fsconfig.DUMP_VERSION:
+                    print("DiskBlocks::LoadFromDump: Error: unsupported dump format version " + str(header[1]))
+                    return -1
+                if header[2:8] != self._DumpConstants():
+                    print("DiskBlocks::LoadFromDump Error: File System constants of File : " + str(header[2:8]) +
+                          " do not match with current file system constants : " + str(self._DumpConstants()))
+                    return -1
+                dump_id, base_id = header[8:10]
+                if base_id != self.NO_DUMP_ID and (base_id != self.dump_id or any(self.changed_blocks)):
+                    print("DiskBlocks::LoadFromDump: Error: " + filename + " is an incremental dump of another dump, load that dump first")
+                    return -1
+
+                offset = self.DUMP_HEADER.size
+                while offset + self.DUMP_CHUNK_HEADER.size <= len(dump):
+                    first_block, count = self.DUMP_CHUNK_HEADER.unpack_from(dump, offset)
+                    offset += self.DUMP_CHUNK_HEADER.size
+                    if count == 0:
+                        return self._DumpLoaded(0, dump_id)
+                    end = offset + count * fsconfig.BLOCK_SIZE
+                    if end > len(dump) or first_block + count > fsconfig.TOTAL_NUM_BLOCKS:
+                        break
+                    blocks = {}
+                    for i in range(0, count):
+                        blocks[first_block + i] = bytearray(dump[offset + i * fsconfig.BLOCK_SIZE:offset + (i + 1) * fsconfig.BLOCK_SIZE])
+                    if isinstance(self.intent_log, DirtyRegionBitmap):
+                        # the dirty-region bitmap describes this array, not the dumped one
+                        blocks.pop(fsconfig.DIRTY_REGION_BLOCK_NUMBER, None)
+                    if self.PutBlocks(blocks) == -1:
+                        print("DiskBlocks::LoadFromDump: Error: blocks " + str(first_block) + "-" + str(first_block + count - 1) + " cannot be written")
+                        return self._DumpLoaded(-1, None)
+                    offset = end
+        print("DiskBlocks::LoadFromDump: Error: File not in proper format, dump is truncated")
+        return self._DumpLoaded(-1, None)
+
+    ## Records the dump the blocks now hold (None if unknown, e.g. after a partial load); returns status
+
+    def _DumpLoaded(self, status, dump_id):
+        self.dump_id = dump_id if status == 0 else None
+        self.changed_blocks = bytearray(fsconfig.TOTAL_NUM_BLOCKS)
+        return status
+
+    ## Loads a dump in the former format: the file system constants and the list of blocks, pickled
+
+    def _LoadFromPickledDump(self, file):
         file_system_constants = "BS_" + str(fsconfig.BLOCK_SIZE) + "_NB_" + str(
             fsconfig.TOTAL_NUM_BLOCKS) + "_IS_" + str(fsconfig.INODE_SIZE) \
                                 + "_MI_" + str(fsconfig.MAX_NUM_INODES) + "_MF_" + str(
             fsconfig.MAX_FILENAME) + "_IDS_" + str(fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
 
         try:
-            with open(filename, 'rb') as file:
-                read_file_system_constants = pickle.load(file)
-                if file_system_constants != read_file_system_constants:
-                    print(
-                        'DiskBlocks::LoadFromDump Error: File System constants of File :' + read_file_system_constants + ' do not match with current file system constants :' + file_system_constants)
-                    return -1
-                block = pickle.load(file)
-                for i in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-                    self.Put(i, block[i])
-                return 0
+            read_file_system_constants = pickle.load(file)
+            if file_system_constants != read_file_system_constants:
+                print(
+                    'DiskBlocks::LoadFromDump Error: File System constants of File :' + read_file_system_constants + ' do not match with current file system constants :' + file_system_constants)
+                return -1
+            block = pickle.load(file)
+            for first_block, count in self._DumpChunks():
+                blocks = dict((i, block[i]) for i in range(first_block, first_block + count))
+                if isinstance(self.intent_log, DirtyRegionBitmap):
+                    blocks.pop(fsconfig.DIRTY_REGION_BLOCK_NUMBER, None)
+                self.PutBlocks(blocks)
+            return 0
         except TypeError:
             print("DiskBlocks::LoadFromDump: Error: File not in proper format, encountered type error ")
             return -1
-        except EOFError:
+        except (EOFError, pickle.UnpicklingError):
             print("DiskBlocks::LoadFromDump: Error: File not in proper format, encountered EOFError error ")
             return -1
 
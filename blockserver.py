@@ -129,16 +129,40 @@ if __name__ == "__main__":
     server.register_function(SingleGet)
 
 
-    def RSM(block_number):
-        RSM_LOCKED = bytearray(b'\x01') * 1
-        result = RawBlocks.block[block_number]
-        # RawBlocks.block[block_number] = RSM_LOCKED
-        RawBlocks.block[block_number] = bytearray(RSM_LOCKED.ljust(BLOCK_SIZE, b'\x01'))
-        RawBlocks.Sleep()
-        return result
+    # Leases of the clients' locks: lock number -> (client id of the last holder, expiry as time.monotonic())
+    # A released or expired lease keeps its last holder, so that the next one learns whether the lock changed hands
+    leases = {}
+
+    ## RSM: read and set memory, as a test-and-set with expiry on the lease table. The server handles one call
+    ## at a time, so this is atomic: client_id gets the lock for lease_time seconds if it is free, its lease
+    ## expired, or client_id holds it already (a renewal)
+    ## Returns [granted, client id of the last holder (-1 if none), seconds left on the holder's lease]
+    ## (lock calls are not delayed by -delayat: a delayed grant would reach the client expired)
+
+    def RSM(lock_number, client_id, lease_time):
+        now = time.monotonic()
+        holder, expiry = leases.get(lock_number, (-1, 0))
+        if holder != client_id and expiry > now:
+            return [False, holder, expiry - now]
+        leases[lock_number] = (client_id, now + lease_time)
+        return [True, holder, lease_time]
+
+
+    ## Gives back client_id's lease on the lock; returns whether it was still held (not expired, nor taken over)
+
+    def Unlock(lock_number, client_id):
+        holder, expiry = leases.get(lock_number, (-1, 0))
+        if holder != client_id:
+            return False
+        leases[lock_number] = (client_id, 0)
+        return expiry > time.monotonic()
 
 
     server.register_function(RSM)
+    server.register_function(Unlock)
+
+    # Allow clients to batch several calls into one round trip (system.multicall)
+    server.register_multicall_functions()
 
     # Run the server's main loop
     print("Running block server with nb=" + str(TOTAL_NUM_BLOCKS) + ", bs=" + str(BLOCK_SIZE) + " on port " + str(PORT))
@@ -0,0 +1,57 @@
+import fsconfig
+import logging
+import hashlib
+
+logger = logging.getLogger(__name__)
+
+#### DEDUPLICATION LAYER
+
+
+## This class implements the fingerprint index used to deduplicate file data blocks
+## The index maps the fingerprint (SHA-256 digest) of a data block's contents to the raw block storing
+## them, and back. It lives in memory and only knows blocks written while it was in use; whether a block
+## is shared is recorded on disk, by the reference count kept in the block's free bitmap entry
+
+class DedupIndex():
+    def __init__(self):
+        # fingerprint -> raw block number
+        self.blocks = {}
+        # raw block number -> fingerprint
+        self.fingerprints = {}
+
+
+    ## Returns the fingerprint of a block's contents (padded with zeroes to BLOCK_SIZE)
+
+    def Fingerprint(self, data):
+        return hashlib.sha256(bytes(data).ljust(fsconfig.BLOCK_SIZE, b'\x00')).digest()
+
+
+    ## Returns the raw block number known to hold contents with this fingerprint, or 0 if there is none
+
+    def Lookup(self, fingerprint):
+        return self.blocks.get(fingerprint, 0)
+
+
+    ## Records that raw block block_number now holds contents with this fingerprint
+
+    def Insert(self, block_number, fingerprint):
+        logger.debug('DedupIndex::Insert: %s', block_number)
+        self.Remove([block_number])
+        self.blocks[fingerprint] = block_number
+        self.fingerprints[block_number] = fingerprint
+
+
+    ## Forgets raw blocks whose contents are about to change, or that were freed
+
+    def Remove(self, block_numbers):
+        for block_number in block_numbers:
+            fingerprint = self.fingerprints.pop(block_number, None)
+            if fingerprint is not None and self.blocks.get(fingerprint) == block_number:
+                del self.blocks[fingerprint]
+
+
+    ## Forgets everything (e.g. when the raw blocks are replaced by loading a dump)
+
+    def Clear(self):
+        self.blocks = {}
+        self.fingerprints = {}
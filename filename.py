@@ -2,6 +2,9 @@ import fsconfig
 import logging
 from inode import Inode
 from inodenumber import InodeNumber
+from dedup import DedupIndex
+
+logger = logging.getLogger(__name__)
 
 #### File name layer
 
@@ -12,12 +15,26 @@ class FileName():
     def __init__(self, RawBlocks):
         ## Initialize a reference to the rawblocks object
         self.RawBlocks = RawBlocks
+        ## Dentry cache: maps (dir inode number, file name) to (inode number, inode type)
+        ## It lets path resolution skip directory scans and inode reads for components seen before
+        self.dentry_cache = {}
+        ## Block reservations: free data block number -> inode number it is set aside for
+        ## When a file allocates blocks, the rest of the last stripe it touched is reserved for it, so the file's
+        ## next blocks land in the same stripe; reservations live in memory only and never reach the bitmap
+        self.reservations = {}
+        ## Fingerprint index of file data blocks when deduplication is enabled (None otherwise)
+        self.dedup = DedupIndex() if fsconfig.DEDUP else None
+        ## Whether data blocks may be shared (superblock flag, read on first use; see SharedBlocks)
+        self.shared = None
+        ## The block layer drops these caches when raw storage changes under them (see InvalidateCaches)
+        RawBlocks.cache_invalidators.append(self.InvalidateCaches)
 
     ## This helper function extracts a file name string from a directory data block
     ## The index selects which file name entry to extract within the block - e.g. index 0 is the first file name, 1 second file name
 
     def HelperGetFilenameString(self, block, index):
-        logging.debug('FileName::HelperGetFilenameString: ' + str(block.hex()) + ', ' + str(index))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('FileName::HelperGetFilenameString: %s, %s', block.hex(), index)
 
         # Locate bytes that store string - first MAX_FILENAME characters aligned by MAX_FILENAME + INODE_NUMBER_DIRENTRY_SIZE
         string_start = index * fsconfig.FILE_NAME_DIRENTRY_SIZE
@@ -29,7 +46,8 @@ class FileName():
     ## The index selects which entry to extract within the block - e.g. index 0 is the inode for the first file name, 1 second file name
 
     def HelperGetFilenameInodeNumber(self, block, index):
-        logging.debug('FileName::HelperGetFilenameInodeNumber: ' + str(block.hex()) + ', ' + str(index))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('FileName::HelperGetFilenameInodeNumber: %s, %s', block.hex(), index)
 
         # Locate bytes that store inode
         inode_start = (index * fsconfig.FILE_NAME_DIRENTRY_SIZE) + fsconfig.MAX_FILENAME
@@ -43,7 +61,7 @@ class FileName():
 
     def FindAvailableInode(self):
 
-        logging.debug('FileName::FindAvailableInode: ')
+        logger.debug('FileName::FindAvailableInode: ')
 
         for i in range(0, fsconfig.MAX_NUM_INODES):
             # Initialize inode_number object from raw storage
@@ -51,17 +69,17 @@ class FileName():
             inode_number.InodeNumberToInode(self.RawBlocks)
             # the integer inode number of first INVALID inode found is returned
             if inode_number.inode.type == fsconfig.INODE_TYPE_INVALID:
-                logging.debug("FileName::FindAvailableInode: " + str(i))
+                logger.debug("FileName::FindAvailableInode: %s", i)
                 return i
 
-        logging.debug("FileName::FindAvailableInode: no available inodes")
+        logger.debug("FileName::FindAvailableInode: no available inodes")
         return -1
 
     ## Returns index to an available entry in directory, if there is room for new entry
 
     def FindAvailableFileEntry(self, dir):
 
-        logging.debug('FileName::FindAvailableFileEntry: dir: ' + str(dir))
+        logger.debug('FileName::FindAvailableFileEntry: dir: %s', dir)
 
         # Initialize inode_number object from raw storage
         inode_number = InodeNumber(dir)
@@ -70,10 +88,10 @@ class FileName():
         # Check if there is still room for another (filename,inode) entry
         # the inode cannot exceed maximum size
         if inode_number.inode.size >= fsconfig.MAX_FILE_SIZE:
-            logging.debug("FileName::FindAvailableFileEntry: no entries available")
+            logger.debug("FileName::FindAvailableFileEntry: no entries available")
             return -1
 
-        logging.debug("FileName::FindAvailableFileEntry: " + str(inode_number.inode.size))
+        logger.debug("FileName::FindAvailableFileEntry: %s", inode_number.inode.size)
         return inode_number.inode.size
 
 
@@ -81,29 +99,227 @@ class FileName():
 
     def AllocateDataBlock(self):
 
-        logging.debug('FileName::AllocateDataBlock: ')
+        logger.debug('FileName::AllocateDataBlock: ')
 
-        # Scan through all available data blocks in the free bitmap to see if there's any free ones
-        for block_number in range(fsconfig.DATA_BLOCKS_OFFSET, fsconfig.TOTAL_NUM_BLOCKS):
+        allocated = self.AllocateDataBlocks(1)
+        if allocated == -1:
+            return -1
+        return allocated[0]
+
+
+    ## Allocate count data blocks with a stripe-aligned policy, update the free bitmap, and return their numbers
+    ## goal is the block that would continue the caller's existing run (e.g. the block after a file's last block)
+    ## owner is the inode number the blocks are for; the remainder of the last stripe width touched is reserved for it
+    ## Blocks are picked, in order of preference:
+    ##   1. consecutively from goal onwards (continuing the file in its stripe, using its reservation)
+    ##   2. as a run starting on a stripe width boundary, so sequential writers fill whole stripes
+    ##   3. first free blocks not reserved for another inode
+    ##   4. any free block, reserved or not
+    ## Returns the list of block numbers, or -1 if there are not enough free blocks (nothing is allocated then)
+
+    def AllocateDataBlocks(self, count, goal=0, owner=None):
+
+        logger.debug('FileName::AllocateDataBlocks: count %s, goal %s, owner %s', count, goal, owner)
+
+        # Read every bitmap block covering the data blocks, once and in one batch
+        def bitmap_block(block_number):
+            return fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)
+
+        data_blocks = range(fsconfig.DATA_BLOCKS_OFFSET, fsconfig.TOTAL_NUM_BLOCKS)
+        bitmap = self.RawBlocks.GetBlocks({bitmap_block(b) for b in data_blocks})
+
+        def is_free(block_number):
+            return bitmap[bitmap_block(block_number)][block_number % fsconfig.BLOCK_SIZE] == 0
+
+        def available(block_number):
+            return block_number in data_blocks and is_free(block_number) and \
+                self.reservations.get(block_number, owner) == owner
+
+        chosen = []
+
+        # 1. continue from goal
+        block_number = goal
+        while len(chosen) < count and available(block_number):
+            chosen.append(block_number)
+            block_number += 1
+
+        # 2. a run of available blocks starting on a stripe width boundary
+        if len(chosen) < count:
+            needed = count - len(chosen)
+            block_number = data_blocks.start
+            while block_number < data_blocks.stop:
+                stripe = self.RawBlocks.getFullStripeRange(block_number)
+                start = max(stripe.start, data_blocks.start)
+                if stripe.start == start and all(available(b) and b not in chosen for b in range(start, start + needed)):
+                    chosen += range(start, start + needed)
+                    break
+                block_number = stripe.stop
+
+        # 3. and 4. first fit, avoiding other inodes' reservations if possible
+        for allow_reserved in (False, True):
+            for block_number in data_blocks:
+                if len(chosen) >= count:
+                    break
+                if block_number in chosen or not is_free(block_number):
+                    continue
+                if allow_reserved or available(block_number):
+                    chosen.append(block_number)
+
+        if len(chosen) < count:
+            logger.debug('FileName::AllocateDataBlocks: no free data blocks available')
+            return -1
 
-            # GET() raw block that stores the bitmap entry for block_number
-            bitmap_block = fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)
-            block = self.RawBlocks.Get(bitmap_block)
+        # Mark the blocks as used in the bitmap and write back the bitmap blocks that changed
+        modified = {}
+        for block_number in chosen:
+            self.reservations.pop(block_number, None)
+            block = bitmap[bitmap_block(block_number)]
+            block[block_number % fsconfig.BLOCK_SIZE] = 1
+            modified[bitmap_block(block_number)] = block
+        self.RawBlocks.PutBlocks(modified)
 
-            # Locate the proper byte the refers to block_number within the free bitmap block
-            byte_bitmap = block[block_number % fsconfig.BLOCK_SIZE]
+        # Reserve the rest of the last stripe width for the owner's next allocation
+        if owner is not None:
+            self.ReleaseReservation(owner)
+            for block_number in range(chosen[-1] + 1, self.RawBlocks.getFullStripeRange(chosen[-1]).stop):
+                if available(block_number):
+                    self.reservations[block_number] = owner
 
-            # Data block block_number is free
-            if byte_bitmap == 0:
-                # Mark it as used in bitmap
-                block[block_number % fsconfig.BLOCK_SIZE] = 1
-                # Write it back to the free bitmap in raw storage
-                self.RawBlocks.Put(bitmap_block, block)
-                logging.debug('FileName::AllocateDataBlock: allocated ' + str(block_number))
-                return block_number
+        logger.debug('FileName::AllocateDataBlocks: allocated %s', chosen)
+        return chosen
+
+
+    ## Drops the blocks reserved for inode owner (e.g. when the file is removed)
+
+    def ReleaseReservation(self, owner):
+        for block_number in [b for b, o in self.reservations.items() if o == owner]:
+            del self.reservations[block_number]
+
+
+    ## Returns the reference counts of blocks, as kept in their free bitmap entries (0 = free)
+    ## The bitmap blocks involved are read in one batch
+    ## Returns a dict: block_number -> reference count
+
+    def GetBlockRefCounts(self, block_numbers):
+
+        bitmap_blocks = {fsconfig.FREEBITMAP_BLOCK_OFFSET + (b // fsconfig.BLOCK_SIZE) for b in block_numbers}
+        bitmap = self.RawBlocks.GetBlocks(bitmap_blocks)
+        return {b: bitmap[fsconfig.FREEBITMAP_BLOCK_OFFSET + (b // fsconfig.BLOCK_SIZE)][b % fsconfig.BLOCK_SIZE]
+                for b in block_numbers}
+
+
+    ## Adds a reference to each of the (allocated) blocks listed; a block listed twice gains two
+    ## Returns 0, or -1 if a block would exceed MAX_BLOCK_REFCNT (then nothing is changed)
+
+    def IncrementBlockRefCounts(self, block_numbers):
+
+        logger.debug('FileName::IncrementBlockRefCounts: %s', block_numbers)
+
+        if not block_numbers:
+            return 0
+        bitmap = self.RawBlocks.GetBlocks({fsconfig.FREEBITMAP_BLOCK_OFFSET + (b // fsconfig.BLOCK_SIZE) for b in block_numbers})
+        for block_number in block_numbers:
+            block = bitmap[fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)]
+            if block[block_number % fsconfig.BLOCK_SIZE] >= fsconfig.MAX_BLOCK_REFCNT:
+                logger.debug('FileName::IncrementBlockRefCounts: reference count of block %s is at its maximum', block_number)
+                return -1
+            block[block_number % fsconfig.BLOCK_SIZE] += 1
+        self.RawBlocks.PutBlocks(bitmap)
+        return 0
+
+
+    ## Release data blocks in the free bitmap
+    ## Each block listed drops one reference; a block is free once its reference count reaches 0
+    ## The bitmap blocks involved are read in one batch and written back in one batch
+    ## Returns the list of blocks that became free
+
+    def FreeDataBlocks(self, block_numbers):
+
+        logger.debug('FileName::FreeDataBlocks: %s', block_numbers)
+
+        block_numbers = [b for b in block_numbers if b != 0]
+        if not block_numbers:
+            return []
+        bitmap = self.RawBlocks.GetBlocks({fsconfig.FREEBITMAP_BLOCK_OFFSET + (b // fsconfig.BLOCK_SIZE) for b in block_numbers})
+
+        freed = []
+        for block_number in block_numbers:
+            block = bitmap[fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)]
+            # Drop a reference (an entry of 0 marks the block as free)
+            if block[block_number % fsconfig.BLOCK_SIZE] > 0:
+                block[block_number % fsconfig.BLOCK_SIZE] -= 1
+                if block[block_number % fsconfig.BLOCK_SIZE] == 0:
+                    freed.append(block_number)
+        self.RawBlocks.PutBlocks(bitmap)
+
+        # freed blocks no longer hold the contents they were indexed by
+        if self.dedup is not None:
+            self.dedup.Remove(freed)
+        return freed
+
+    ## Returns True if blocks may be shared by several references (deduplication, snapshots or reflink copies),
+    ## in which case writers must check reference counts and copy shared blocks before modifying them
+
+    def SharedBlocks(self):
+        if self.dedup is not None:
+            return True
+        if self.shared is None:
+            superblock = self.RawBlocks.Get(fsconfig.SUPERBLOCK_BLOCK_NUMBER)
+            self.shared = bool(superblock[0] & fsconfig.SUPERBLOCK_FLAG_SHARED)
+        return self.shared
+
+
+    ## Records in the superblock that blocks may be shared from now on
+
+    def MarkSharedBlocks(self):
+        superblock = self.RawBlocks.Get(fsconfig.SUPERBLOCK_BLOCK_NUMBER)
+        if not superblock[0] & fsconfig.SUPERBLOCK_FLAG_SHARED:
+            superblock[0] |= fsconfig.SUPERBLOCK_FLAG_SHARED
+            self.RawBlocks.Put(fsconfig.SUPERBLOCK_BLOCK_NUMBER, superblock)
+        self.shared = True
+
+
+    ## Gives inode_number_object private copies of its shared indirect blocks before its block mapping changes
+    ## Returns 0, or -1 if the file system is out of blocks
+
+    def UnshareIndirectBlocks(self, inode_number_object):
+        if not self.SharedBlocks():
+            return 0
+        return inode_number_object.UnshareIndirectBlocks(self.RawBlocks, self.GetBlockRefCounts, self.AllocateDataBlock,
+                                                         self.FreeDataBlocks)
+
+
+    ## Makes the blocks at the listed block indices of inode_number_object private to it before they are
+    ## modified in place: a block shared with other references is replaced by a newly allocated one
+    ## The new blocks are not initialized - the caller must write them in full (e.g. the old contents, modified)
+    ## Returns a dict: block index -> raw block number to write, or -1 if the file system is out of blocks
+
+    def UnshareBlocks(self, inode_number_object, indices):
+        block_numbers = dict((index, inode_number_object.IndexToBlockNumber(self.RawBlocks, index)) for index in indices)
+        if not self.SharedBlocks():
+            return block_numbers
+
+        refcounts = self.GetBlockRefCounts([b for b in block_numbers.values() if b != 0])
+        shared = [index for index, b in block_numbers.items() if b != 0 and refcounts[b] > 1]
+        if not shared:
+            return block_numbers
+        if self.UnshareIndirectBlocks(inode_number_object) == -1:
+            return -1
+
+        logger.debug('FileName::UnshareBlocks: %s copies indices %s', inode_number_object.inode_number, shared)
+        released = []
+        for index in shared:
+            new_block = self.AllocateDataBlocks(1, block_numbers[index] + 1, inode_number_object.inode_number)
+            if new_block == -1:
+                return -1
+            if inode_number_object.SetIndexBlockNumber(self.RawBlocks, index, new_block[0], self.AllocateDataBlock) == -1:
+                self.FreeDataBlocks(new_block)
+                return -1
+            released.append(block_numbers[index])
+            block_numbers[index] = new_block[0]
+        self.FreeDataBlocks(released)
+        return block_numbers
 
-        logging.debug('FileName::AllocateDataBlock: no free data blocks available')
-        return -1
 
     ## This inserts a (filename,inodenumber) entry into the tail end of the table in a directory data block of insert_to
     ## insert_to is an InodeNumber() object - the inode number of the directory where this entry is to be inserted
@@ -113,15 +329,15 @@ class FileName():
     ## insert_into is an InodeNumber() object; filename is a string; inodenumber is an integer
 
     def InsertFilenameInodeNumber(self, insert_to, filename, inodenumber):
-        logging.debug('FileName::InsertFilenameInodeNumber: ' + str(filename) + ', ' + str(inodenumber))
+        logger.debug('FileName::InsertFilenameInodeNumber: %s, %s', filename, inodenumber)
 
         # bound and type checks first
         if len(filename) > fsconfig.MAX_FILENAME:
-            logging.error('FileName::InsertFilenameInodeNumber: file name exceeds maximum')
+            logger.error('FileName::InsertFilenameInodeNumber: file name exceeds maximum')
             raise ValueError('FileName::InsertFilenameInodeNumber: file name exceeds maximum')
 
         if insert_to.inode.type != fsconfig.INODE_TYPE_DIR:
-            logging.error('FileName::InsertFilenameInodeNumber: not a directory inode: ' + str(insert_to.inode.type))
+            logger.error('FileName::InsertFilenameInodeNumber: not a directory inode: %s', insert_to.inode.type)
             raise ValueError('FileName::InsertFilenameInodeNumber: not a directory inode: ' + str(insert_to.inode.type))
 
         # We need to insert this new entry at the end of the existing directory table
@@ -130,7 +346,7 @@ class FileName():
         # If there's no space for another entry in the directory, we abort
         # Note that a directory or file can be at most fsconfig.MAX_FILE_SIZE bytes
         if index >= fsconfig.MAX_FILE_SIZE:
-            logging.error('FileName::InsertFilenameInodeNumber: no space for another entry in inode')
+            logger.error('FileName::InsertFilenameInodeNumber: no space for another entry in inode')
             raise RuntimeError('FileName::InsertFilenameInodeNumber: no space for another entry in inode')
 
         # Check if we need to allocate another data block for this inode
@@ -140,15 +356,33 @@ class FileName():
         if index % fsconfig.BLOCK_SIZE == 0:
             # index == 0 is a special case as an inode is initialized with one data block; so no need to allocate
             if index != 0:
-                # Allocate the data block to store this binding
-                new_block = self.AllocateDataBlock()
-                # update directory inode to add this new block to the list of block_numbers
-                # note: inode will be written to raw storage before the method returns
-                insert_to.inode.block_numbers[block_number_index] = new_block
+                # the block mapping changes: indirect blocks shared with a snapshot are copied first
+                if self.UnshareIndirectBlocks(insert_to) == -1:
+                    logger.error('FileName::InsertFilenameInodeNumber: no free block for indirect block')
+                    raise RuntimeError('FileName::InsertFilenameInodeNumber: no free block for indirect block')
+                # Allocate the data block to store this binding, next to the directory's previous block if possible
+                goal = insert_to.IndexToBlockNumber(self.RawBlocks, block_number_index - 1) + 1
+                new_block = self.AllocateDataBlocks(1, goal, insert_to.inode_number)
+                if new_block != -1:
+                    new_block = new_block[0]
+                if new_block == -1:
+                    logger.error('FileName::InsertFilenameInodeNumber: no free data block for directory')
+                    raise RuntimeError('FileName::InsertFilenameInodeNumber: no free data block for directory')
+                # update directory inode to add this new block to its block mapping
+                # note: inode (and any indirect block) will be written to raw storage before the method returns
+                if insert_to.SetIndexBlockNumber(self.RawBlocks, block_number_index, new_block, self.AllocateDataBlock) == -1:
+                    logger.error('FileName::InsertFilenameInodeNumber: no free block for indirect block')
+                    raise RuntimeError('FileName::InsertFilenameInodeNumber: no free block for indirect block')
 
         # Retrieve the full data block where the new (filename,inodenumber) will be stored
-        block_number = insert_to.inode.block_numbers[block_number_index]
+        block_number = insert_to.IndexToBlockNumber(self.RawBlocks, block_number_index)
         block = self.RawBlocks.Get(block_number)
+        # a block shared with a snapshot is not modified in place: the updated copy goes to a block of its own
+        block_number = self.UnshareBlocks(insert_to, [block_number_index])
+        if block_number == -1:
+            logger.error('FileName::InsertFilenameInodeNumber: no free data block for directory')
+            raise RuntimeError('FileName::InsertFilenameInodeNumber: no free data block for directory')
+        block_number = block_number[block_number_index]
 
         # Compute modulo of index to locate within this data block where the new entry should be added
         index_modulo = index % fsconfig.BLOCK_SIZE
@@ -165,9 +399,10 @@ class FileName():
         inode_start = index_modulo + fsconfig.MAX_FILENAME
         inode_end = inode_start + fsconfig.INODE_NUMBER_DIRENTRY_SIZE
 
-        logging.debug('FileName::InsertFilenameInodeNumber: block read \n' + str(block.hex()))
-        logging.debug('FileName::InsertFilenameInodeNumber: string_start ' + str(string_start) + ', string_end ' + str(string_end))
-        logging.debug('FileName::InsertFilenameInodeNumber: inode_start ' + str(inode_start) + ', inode_end ' + str(inode_end))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('FileName::InsertFilenameInodeNumber: block read \n%s', block.hex())
+        logger.debug('FileName::InsertFilenameInodeNumber: string_start %s, string_end %s', string_start, string_end)
+        logger.debug('FileName::InsertFilenameInodeNumber: inode_start %s, inode_end %s', inode_start, inode_end)
 
         # Update and write data block with (filename,inode) mapping
         # pad the bytearray representation of the string with zeroes if the filename is smaller than MAX_FILENAME
@@ -178,7 +413,7 @@ class FileName():
 
         # Now update the inode of the directory - need to increment its size
         # Increment size to reflect that a new entry has been appended
-        logging.debug('FileName::InsertFilenameInodeNumber: insert_to.inode.size ' + str(insert_to.inode.size))
+        logger.debug('FileName::InsertFilenameInodeNumber: insert_to.inode.size %s', insert_to.inode.size)
         insert_to.inode.size += fsconfig.FILE_NAME_DIRENTRY_SIZE
         # Write updated inode back to inode table in raw block storage
         insert_to.StoreInode(self.RawBlocks)
@@ -189,23 +424,27 @@ class FileName():
 
     def InitRootInode(self):
 
-        logging.debug('FileName::InitRootInode')
+        logger.debug('FileName::InitRootInode')
 
         # Root inode has well-known value 0; create an InodeNumber object
         root_inode = InodeNumber(0)
         root_inode.InodeNumberToInode(self.RawBlocks)
+        # Another client sharing the block servers may have initialized it already
+        if root_inode.inode.type == fsconfig.INODE_TYPE_DIR:
+            logger.info('FileName::InitRootInode: root directory found, mounting it')
+            return
         root_inode.inode.type = fsconfig.INODE_TYPE_DIR
         root_inode.inode.size = 0
         root_inode.inode.refcnt = 1
         # Allocate one data block and set as first entry in block_numbers[]
-        logging.debug('FileName::InitRootInode: calling AllocateDataBlock')
+        logger.debug('FileName::InitRootInode: calling AllocateDataBlock')
         root_inode.inode.block_numbers[0] = self.AllocateDataBlock()
         # Add a binding from "." to 0 in this newly created data block
-        logging.debug('FileName::InitRootInode: calling InsertFilenameInodeNumber')
+        logger.debug('FileName::InitRootInode: calling InsertFilenameInodeNumber')
         self.InsertFilenameInodeNumber(root_inode, ".", 0)
         ## print for debugging
         # root_inode.inode.Print()
-        logging.debug('FileName::InitRootInode: calling StoreInode')
+        logger.debug('FileName::InitRootInode: calling StoreInode')
         root_inode.StoreInode(self.RawBlocks)
 
 
@@ -213,15 +452,23 @@ class FileName():
     ## This follows the same logic as the textbook's LOOKUP in p98
 
     def Lookup(self, filename, dir):
-        logging.debug('FileName::Lookup: ' + str(filename) + ', ' + str(dir))
+        fileinode, _ = self.LookupEntry(filename, dir)
+        return fileinode
+
+
+    ## Same as Lookup, but also returns the byte offset of the matching entry within the directory
+    ## Returns a tuple (inode number, entry offset); (-1, -1) if not found
+
+    def LookupEntry(self, filename, dir):
+        logger.debug('FileName::Lookup: %s, %s', filename, dir)
 
         # Initialize inode_number object for directory from raw storage
         inode_number = InodeNumber(dir)
         inode_number.InodeNumberToInode(self.RawBlocks)
 
         if inode_number.inode.type != fsconfig.INODE_TYPE_DIR:
-            logging.error("FileName::Lookup: not a directory inode: " + str(dir) + " , " + str(inode_number.inode.type))
-            return -1
+            logger.error("FileName::Lookup: not a directory inode: %s , %s", dir, inode_number.inode.type)
+            return -1, -1
 
         # Iterate over all data blocks indexed by directory inode, until we reach inode's size
         offset = 0
@@ -240,7 +487,7 @@ class FileName():
 
                     # Extract padded MAX_FILENAME string as a bytearray from data block for comparison
                     filestring = self.HelperGetFilenameString(b, i)
-                    logging.debug("FileName::Lookup for " + filename + " in " + str(dir) + ": searching string " + str(filestring))
+                    logger.debug("FileName::Lookup for %s in %s: searching string %s", filename, dir, filestring)
                     # Pad filename with zeroes and make it a byte array
                     padded_filename = bytearray(filename, "utf-8")
                     padded_filename = bytearray(padded_filename.ljust(fsconfig.MAX_FILENAME, b'\x00'))
@@ -249,12 +496,111 @@ class FileName():
                     if filestring == padded_filename:
                         # On a match, lookup is successful - retrieve the inode number and return it
                         fileinode = self.HelperGetFilenameInodeNumber(b, i)
-                        logging.debug("FileName::Lookup successful: " + str(fileinode))
-                        return fileinode
+                        logger.debug("FileName::Lookup successful: %s", fileinode)
+                        return fileinode, offset + i * fsconfig.FILE_NAME_DIRENTRY_SIZE
 
             # Skip to the search on next block, and back to while loop
             offset += fsconfig.BLOCK_SIZE
 
-        logging.debug("FileName::Lookup: file not found: " + str(filename) + " in " + str(dir))
-        return -1
+        logger.debug("FileName::Lookup: file not found: %s in %s", filename, dir)
+        return -1, -1
+
+
+    ## Reads all entries of directory dir together with their decoded inodes (readdir-plus)
+    ## Returns a list of (name, inode number, Inode object, symlink target string or None), or -1 if dir is not a directory
+    ## Each directory block and each distinct inode table block is fetched once, in batches,
+    ## and the targets of all symlinks in the directory are read in one more batch
+
+    def ReadDirPlus(self, dir):
+        logger.debug('FileName::ReadDirPlus: %s', dir)
+
+        dir_inode = InodeNumber(dir)
+        dir_inode.InodeNumberToInode(self.RawBlocks)
+        if dir_inode.inode.type != fsconfig.INODE_TYPE_DIR:
+            logger.error("FileName::ReadDirPlus: not a directory inode: %s , %s", dir, dir_inode.inode.type)
+            return -1
+
+        # Fetch all directory data blocks in one batch
+        num_blocks = (dir_inode.inode.size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        dir_block_numbers = dir_inode.IndexRangeToBlockNumbers(self.RawBlocks, 0, num_blocks)
+        dir_blocks = self.RawBlocks.GetBlocks(dir_block_numbers)
+
+        # Decode (filename, inode number) pairs, up to the directory's size
+        names = []
+        num_entries = dir_inode.inode.size // fsconfig.FILE_NAME_DIRENTRY_SIZE
+        for entry in range(0, num_entries):
+            block = dir_blocks[dir_block_numbers[entry // fsconfig.FILE_ENTRIES_PER_DATA_BLOCK]]
+            index = entry % fsconfig.FILE_ENTRIES_PER_DATA_BLOCK
+            filename = self.HelperGetFilenameString(block, index).rstrip(b'\x00').decode()
+            names.append((filename, self.HelperGetFilenameInodeNumber(block, index)))
+
+        # Fetch every distinct inode table block holding one of these inodes, once
+        def inode_table_block(inode_number):
+            return fsconfig.INODE_BLOCK_OFFSET + ((inode_number * fsconfig.INODE_SIZE) // fsconfig.BLOCK_SIZE)
+
+        inode_blocks = self.RawBlocks.GetBlocks([inode_table_block(n) for _, n in names])
+
+        entries = []
+        for filename, entry_inode_number in names:
+            start = (entry_inode_number * fsconfig.INODE_SIZE) % fsconfig.BLOCK_SIZE
+            inode = Inode()
+            inode.InodeFromBytearray(inode_blocks[inode_table_block(entry_inode_number)][start:start + fsconfig.INODE_SIZE])
+            entries.append((filename, entry_inode_number, inode, None))
+
+        # Batch the symlink target reads
+        symlinks = [i for i, entry in enumerate(entries) if entry[2].type == fsconfig.INODE_TYPE_SYM]
+        if symlinks:
+            target_blocks = self.RawBlocks.GetBlocks([entries[i][2].block_numbers[0] for i in symlinks])
+            for i in symlinks:
+                filename, entry_inode_number, inode, _ = entries[i]
+                target = target_blocks[inode.block_numbers[0]][0:inode.size].decode()
+                entries[i] = (filename, entry_inode_number, inode, target)
+
+        return entries
+
+
+    ## Lookup string filename in the context of inode dir, consulting the dentry cache first
+    ## Returns a tuple (inode number, inode type); (-1, INODE_TYPE_INVALID) if not found
+    ## On a cache miss, the directory is scanned with Lookup() and the inode is read once to learn its type
+
+    def LookupDentry(self, filename, dir):
+        logger.debug('FileName::LookupDentry: %s, %s', filename, dir)
+
+        cached = self.dentry_cache.get((dir, filename))
+        if cached is not None:
+            logger.debug('FileName::LookupDentry: cache hit %s', cached)
+            return cached
+
+        fileinode = self.Lookup(filename, dir)
+        if fileinode == -1:
+            return -1, fsconfig.INODE_TYPE_INVALID
+
+        inode_number = InodeNumber(fileinode)
+        inode_number.InodeNumberToInode(self.RawBlocks)
+        self.dentry_cache[(dir, filename)] = (fileinode, inode_number.inode.type)
+        return fileinode, inode_number.inode.type
+
+
+    ## Drops the dentry cache entry for (dir, filename)
+    ## Called with no arguments, drops every entry (e.g. after the raw storage is reloaded)
+
+    def InvalidateDentry(self, dir=None, filename=None):
+        logger.debug('FileName::InvalidateDentry: %s, %s', filename, dir)
+
+        if dir is None:
+            self.dentry_cache.clear()
+        else:
+            self.dentry_cache.pop((dir, filename), None)
+
+
+    ## Drops everything cached from raw storage: dentries, block fingerprints, the superblock's shared flag and
+    ## block reservations (called by the block layer when another client wrote the raw storage, or after a load)
+
+    def InvalidateCaches(self):
+        logger.debug('FileName::InvalidateCaches')
 
+        self.InvalidateDentry()
+        if self.dedup is not None:
+            self.dedup.Clear()
+        self.shared = None
+        self.reservations.clear()
@@ -4,11 +4,279 @@ from inode import Inode
 from inodenumber import InodeNumber
 from filename import FileName
 
+logger = logging.getLogger(__name__)
+
 ## This class implements methods for file operations
 
 class FileOperations():
     def __init__(self, FileNameObject):
         self.FileNameObject = FileNameObject
+        # Readahead state of files being read: inode number -> [next block index expected if the reader
+        # is sequential, readahead window in stripes, block index up to which blocks were prefetched]
+        self.readahead = {}
+
+    ## Makes sure count block indices of file_inode starting at first_index are backed by data blocks
+    ## Missing blocks are allocated with the stripe-aligned policy (each run continues after the preceding block)
+    ## and recorded in the inode's block mapping (written back by StoreInode)
+    ## Returns the list of raw block numbers for the range, or -1 if the file system is out of blocks
+
+    def _AllocateRange(self, file_inode, first_index, count):
+        RawBlocks = self.FileNameObject.RawBlocks
+        for index, block_number, length in file_inode.MapExtents(RawBlocks, first_index, count):
+            if block_number != 0:
+                continue
+            goal = 0
+            if index > 0:
+                previous = file_inode.IndexToBlockNumber(RawBlocks, index - 1)
+                if previous != 0:
+                    goal = previous + 1
+            new_blocks = self.FileNameObject.AllocateDataBlocks(length, goal, file_inode.inode_number)
+            if new_blocks == -1:
+                return -1
+            for i, new_block in enumerate(new_blocks):
+                if file_inode.SetIndexBlockNumber(RawBlocks, index + i, new_block, self.FileNameObject.AllocateDataBlock) == -1:
+                    self.FileNameObject.FreeDataBlocks(new_blocks[i:])
+                    return -1
+        return file_inode.IndexRangeToBlockNumbers(RawBlocks, first_index, count)
+
+    ## Reads the raw blocks backing a file; block number 0 stands for a hole (an unallocated block index)
+    ## and is served as a block of zeroes without any I/O. prefetch is passed on to GetBlocks
+    ## Returns a dict: block_number -> bytearray (the zero block for 0 is shared and must not be modified)
+
+    def _GetFileBlocks(self, block_numbers, prefetch=()):
+        blocks = self.FileNameObject.RawBlocks.GetBlocks([b for b in block_numbers if b != 0], prefetch)
+        blocks[0] = bytearray(fsconfig.BLOCK_SIZE)
+        return blocks
+
+    ## Writes whole blocks of file_inode, given as a dict: block index -> bytearray, with one PutBlocks
+    ## This is the single path by which file data blocks are stored:
+    ##   - zero blocks over holes stay holes (with deduplication, every zero block becomes a hole)
+    ##   - holes that receive data are allocated, run by run, with the stripe-aligned policy
+    ##   - with deduplication, a block whose contents are already stored somewhere only points the block
+    ##     index at that block and adds a reference to it, without writing anything
+    ##   - a raw block shared by several references (deduplicated, or shared with a snapshot or a reflink
+    ##     copy) is never overwritten in place: the block index gets a copy of its own
+    ## old_blocks optionally gives the current contents of raw blocks (block_number -> bytearray), which
+    ## saves reading them back for the parity update
+    ## The inode's block mapping is updated in memory (the caller stores the inode)
+    ## Returns 0, or -1 if the file system is out of blocks
+
+    def _PutFileBlocks(self, file_inode, blocks_by_index, old_blocks=None):
+        RawBlocks = self.FileNameObject.RawBlocks
+        dedup = self.FileNameObject.dedup
+        allocate = self.FileNameObject.AllocateDataBlock
+
+        shared = self.FileNameObject.SharedBlocks()
+        if shared and self.FileNameObject.UnshareIndirectBlocks(file_inode) == -1:
+            return -1
+
+        current = dict((index, file_inode.IndexToBlockNumber(RawBlocks, index)) for index in blocks_by_index)
+
+        fingerprints = {}
+        refcounts = {}
+        if dedup is not None:
+            for index, block in blocks_by_index.items():
+                if any(block):
+                    fingerprints[index] = dedup.Fingerprint(block)
+        if shared:
+            candidates = [b for b in current.values() if b != 0]
+            if dedup is not None:
+                candidates += [dedup.Lookup(f) for f in fingerprints.values() if dedup.Lookup(f) != 0]
+            refcounts = self.FileNameObject.GetBlockRefCounts(candidates)
+
+        # blocks gaining and losing a reference, and blocks to write (by block index)
+        referenced = []
+        released = []
+        writes = {}
+        for index in sorted(blocks_by_index):
+            block = blocks_by_index[index]
+            block_number = current[index]
+
+            if dedup is None:
+                if block_number == 0 and not any(block):
+                    continue
+                if block_number != 0 and shared and refcounts[block_number] > 1:
+                    # shared: copy on write
+                    if file_inode.SetIndexBlockNumber(RawBlocks, index, 0, allocate) == -1:
+                        return -1
+                    released.append(block_number)
+                writes[index] = block
+                continue
+
+            if index not in fingerprints:
+                # zero block: becomes a hole
+                if block_number != 0:
+                    if file_inode.SetIndexBlockNumber(RawBlocks, index, 0, allocate) == -1:
+                        return -1
+                    released.append(block_number)
+                continue
+
+            match = dedup.Lookup(fingerprints[index])
+            if match != 0 and match == block_number:
+                # contents unchanged
+                continue
+            if match != 0 and refcounts[match] + referenced.count(match) < fsconfig.MAX_BLOCK_REFCNT:
+                if file_inode.SetIndexBlockNumber(RawBlocks, index, match, allocate) == -1:
+                    return -1
+                referenced.append(match)
+                if block_number != 0:
+                    released.append(block_number)
+                continue
+
+            if block_number != 0:
+                if refcounts[block_number] > 1 or block_number in referenced:
+                    # shared: copy on write
+                    if file_inode.SetIndexBlockNumber(RawBlocks, index, 0, allocate) == -1:
+                        return -1
+                    released.append(block_number)
+                else:
+                    # overwritten in place: its old contents are no longer available for sharing
+                    dedup.Remove([block_number])
+            writes[index] = block
+
+        # allocate the holes being written, one run of consecutive block indices at a time
+        runs = []
+        for index in sorted(writes):
+            if file_inode.IndexToBlockNumber(RawBlocks, index) != 0:
+                continue
+            if runs and runs[-1][0] + runs[-1][1] == index:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+        for first_index, count in runs:
+            if self._AllocateRange(file_inode, first_index, count) == -1:
+                return -1
+
+        blocks = {}
+        for index, block in writes.items():
+            block_number = file_inode.IndexToBlockNumber(RawBlocks, index)
+            blocks[block_number] = block
+            if dedup is not None:
+                dedup.Insert(block_number, fingerprints[index])
+        if old_blocks is not None:
+            old_blocks = dict((b, old) for b, old in old_blocks.items() if b in blocks)
+        RawBlocks.PutBlocks(blocks, old_blocks)
+
+        # references are added before any are dropped, so a block moving between indices is never freed
+        self.FileNameObject.IncrementBlockRefCounts(referenced)
+        if released:
+            self.FileNameObject.FreeDataBlocks(released)
+        return 0
+
+    ## Writes data into file_inode at offset
+    ## Only blocks the data covers partially are read (to keep their other bytes); blocks fully overwritten
+    ## are not, and blocks that were holes or past the old end of file start out zeroed. The blocks are
+    ## stored by _PutFileBlocks, which reuses the contents read here for the parity update
+    ## Does not update the inode's size; returns 0, or -1 if the file system is out of blocks
+
+    def _WriteRange(self, file_inode, offset, data):
+        RawBlocks = self.FileNameObject.RawBlocks
+        end = offset + len(data)
+        first_index = offset // fsconfig.BLOCK_SIZE
+        num_blocks = (end + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE - first_index
+        block_numbers = file_inode.IndexRangeToBlockNumbers(RawBlocks, first_index, num_blocks)
+
+        partial = set()
+        if offset % fsconfig.BLOCK_SIZE != 0:
+            partial.add(first_index)
+        if end % fsconfig.BLOCK_SIZE != 0:
+            partial.add(first_index + num_blocks - 1)
+        partial = [block_numbers[i - first_index] for i in partial
+                   if i * fsconfig.BLOCK_SIZE < file_inode.inode.size and block_numbers[i - first_index] != 0]
+        old_blocks = RawBlocks.GetBlocks(partial) if partial else {}
+        old_blocks = dict((b, old) for b, old in old_blocks.items() if old is not None)
+
+        blocks_by_index = {}
+        for i, block_number in enumerate(block_numbers):
+            block_start = (first_index + i) * fsconfig.BLOCK_SIZE
+            start = max(offset, block_start)
+            stop = min(end, block_start + fsconfig.BLOCK_SIZE)
+            block = bytearray(old_blocks.get(block_number, fsconfig.BLOCK_SIZE))
+            block[start - block_start:stop - block_start] = data[start - offset:stop - offset]
+            blocks_by_index[first_index + i] = block
+        return self._PutFileBlocks(file_inode, blocks_by_index, old_blocks)
+
+    ## Prepares file_inode for a write at offset past its end, so that the gap reads as zeroes: the bytes
+    ## after the old end of file in its last block (which may hold stale data) are zeroed, and blocks lying
+    ## entirely in the gap that are still allocated (a write may have shortened the file) are released,
+    ## leaving holes
+    ## Returns 0, or -1 if the file system is out of blocks
+
+    def _ZeroFillTail(self, file_inode, offset):
+        RawBlocks = self.FileNameObject.RawBlocks
+        size = file_inode.inode.size
+        if offset <= size:
+            return 0
+
+        first_gap_index = (size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        end_gap_index = offset // fsconfig.BLOCK_SIZE
+        if first_gap_index < end_gap_index:
+            if self.FileNameObject.UnshareIndirectBlocks(file_inode) == -1:
+                return -1
+            released = []
+            for index, block_number, length in file_inode.MapExtents(RawBlocks, first_gap_index, end_gap_index - first_gap_index):
+                if block_number == 0:
+                    continue
+                for i in range(0, length):
+                    file_inode.SetIndexBlockNumber(RawBlocks, index + i, 0, self.FileNameObject.AllocateDataBlock)
+                    released.append(block_number + i)
+            if released:
+                self.FileNameObject.FreeDataBlocks(released)
+
+        if size % fsconfig.BLOCK_SIZE == 0 or file_inode.IndexToBlockNumber(RawBlocks, size // fsconfig.BLOCK_SIZE) == 0:
+            return 0
+        fill_end = min(offset, (size // fsconfig.BLOCK_SIZE + 1) * fsconfig.BLOCK_SIZE)
+        return self._WriteRange(file_inode, size, bytearray(fill_end - size))
+
+    ## Detaches the blocks of file_inode at block index first_index and beyond (and the indirect blocks left
+    ## empty) and releases them, with one free bitmap update
+    ## Returns 0, or -1 if the file system is out of blocks (indirect blocks shared with a snapshot are copied)
+
+    def _ReleaseTail(self, file_inode, first_index):
+        if self.FileNameObject.UnshareIndirectBlocks(file_inode) == -1:
+            return -1
+        released = file_inode.ReleaseBlocks(self.FileNameObject.RawBlocks, first_index)
+        if released:
+            self.FileNameObject.FreeDataBlocks(released)
+        return 0
+
+    ## Readahead for a read of block indices [first_index, end_index) of file_inode
+    ## A read that continues where the previous read of the file stopped (or the first read from the start
+    ## of the file) is sequential: the window doubles, up to READAHEAD_MAX_STRIPES stripes, and the blocks
+    ## of the window past end_index that were not prefetched yet are returned once it runs low. Any other
+    ## read resets it
+    ## Returns the list of raw block numbers to prefetch (possibly empty)
+
+    def _Readahead(self, file_inode, first_index, end_index):
+        state = self.readahead.get(file_inode.inode_number)
+        if state is None:
+            state = [0, 0, 0]
+            self.readahead[file_inode.inode_number] = state
+
+        # a read may start inside the last block of the previous read
+        if state[0] - 1 <= first_index <= state[0]:
+            state[1] = min(max(state[1] * 2, 1), fsconfig.READAHEAD_MAX_STRIPES)
+        else:
+            state[1] = 0
+            state[2] = 0
+        state[0] = end_index
+        if state[1] == 0:
+            return []
+
+        # top the window up only once less than half of it is left unread, so that a sequential reader
+        # mostly finds its blocks in the cache and the prefetches are issued in large batches
+        window = state[1] * self.FileNameObject.RawBlocks.layout.data_per_stripe
+        if state[2] - end_index >= (window + 1) // 2:
+            return []
+        file_blocks = (file_inode.inode.size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        prefetch_start = max(end_index, state[2])
+        prefetch_end = min(end_index + window, file_blocks)
+        if prefetch_start >= prefetch_end:
+            return []
+        state[2] = prefetch_end
+        block_numbers = file_inode.IndexRangeToBlockNumbers(self.FileNameObject.RawBlocks, prefetch_start,
+                                                            prefetch_end - prefetch_start)
+        return [b for b in block_numbers if b != 0]
 
     ## Create an object in the file system
     ## name is the string name of the object to be created
@@ -17,38 +285,38 @@ class FileOperations():
     ## This function returns two values: an integer status (0=success, -1=error) and a string message
 
     def Create(self, dir, name, type):
-        logging.debug("FileOperations::Create: dir: " + str(dir) + ", name: " + str(name) + ", type: " + str(type))
+        logger.debug("FileOperations::Create: dir: %s, name: %s, type: %s", dir, name, type)
 
         # Ensure type is valid, otherwise return
         if not (type == fsconfig.INODE_TYPE_FILE or type == fsconfig.INODE_TYPE_DIR):
-            logging.debug("ERROR_CREATE_INVALID_TYPE " + str(type))
+            logger.debug("ERROR_CREATE_INVALID_TYPE %s", type)
             return -1, "ERROR_CREATE_INVALID_TYPE"
 
         # Find if there is an available inode
         inode_position = self.FileNameObject.FindAvailableInode()
         if inode_position == -1:
-            logging.debug("ERROR_CREATE_INODE_NOT_AVAILABLE")
+            logger.debug("ERROR_CREATE_INODE_NOT_AVAILABLE")
             return -1, "ERROR_CREATE_INODE_NOT_AVAILABLE"
 
         # Obtain dir_inode_number_inode, ensure it is a directory
         dir_inode = InodeNumber(dir)
         dir_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
         if dir_inode.inode.type != fsconfig.INODE_TYPE_DIR:
-            logging.debug("ERROR_CREATE_INVALID_DIR " + str(dir))
+            logger.debug("ERROR_CREATE_INVALID_DIR %s", dir)
             return -1, "ERROR_CREATE_INVALID_DIR"
 
         # Find available slot in directory data block
         fileentry_position = self.FileNameObject.FindAvailableFileEntry(dir)
         if fileentry_position == -1:
-            logging.debug("ERROR_CREATE_DATA_BLOCK_NOT_AVAILABLE")
+            logger.debug("ERROR_CREATE_DATA_BLOCK_NOT_AVAILABLE")
             return -1, "ERROR_CREATE_DATA_BLOCK_NOT_AVAILABLE"
 
         # Ensure it's not a duplicate - if Lookup returns anything other than -1
         if self.FileNameObject.Lookup(name, dir) != -1:
-            logging.debug("ERROR_CREATE_ALREADY_EXISTS " + str(name))
+            logger.debug("ERROR_CREATE_ALREADY_EXISTS %s", name)
             return -1, "ERROR_CREATE_ALREADY_EXISTS"
 
-        logging.debug("FileOperations::Create: inode_position: " + str(inode_position) + ", fileentry_position: " + str(fileentry_position))
+        logger.debug("FileOperations::Create: inode_position: %s, fileentry_position: %s", inode_position, fileentry_position)
 
         if type == fsconfig.INODE_TYPE_DIR:
             # We're creating a new directory (e.g. mkdir)
@@ -98,20 +366,21 @@ class FileOperations():
             dir_inode.inode.refcnt += 1
             dir_inode.StoreInode(self.FileNameObject.RawBlocks)
 
+        # Drop any cached binding for this name now that the directory changed
+        self.FileNameObject.InvalidateDentry(dir, name)
+
         # Return new object's inode number
         return inode_position, "SUCCESS"
 
 
     ## Writes data to a file, starting at offset
-    ## offset must be less than or equal to the file's size
+    ## offset may be past the file's size: the range in between becomes a hole (reads as zeroes, not allocated)
     ## data is a bytearray
     ## returns number of bytes written
 
     def Write(self, file_inode_number, offset, data):
 
-        logging.debug(
-            "FileOperations::Write: file_inode_number: " + str(file_inode_number) + ", offset: " + str(offset) + ", len(data): " + str(
-                len(data)))
+        logger.debug("FileOperations::Write: file_inode_number: %s, offset: %s, len(data): %s", file_inode_number, offset, len(data))
         # logging.debug (str(data))
 
         file_inode = InodeNumber(file_inode_number)
@@ -119,108 +388,117 @@ class FileOperations():
 
         # perform checks on type and bounds
         if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
-            logging.debug("ERROR_WRITE_NOT_FILE " + str(file_inode_number))
+            logger.debug("ERROR_WRITE_NOT_FILE %s", file_inode_number)
             return -1, "ERROR_WRITE_NOT_FILE"
 
-        if offset > file_inode.inode.size:
-            logging.debug("ERROR_WRITE_OFFSET_LARGER_THAN_SIZE " + str(offset))
-            return -1, "ERROR_WRITE_OFFSET_LARGER_THAN_SIZE"
-
         if offset + len(data) > fsconfig.MAX_FILE_SIZE:
-            logging.debug("ERROR_WRITE_EXCEEDS_FILE_SIZE " + str(offset + len(data)))
+            logger.debug("ERROR_WRITE_EXCEEDS_FILE_SIZE %s", offset + len(data))
             return -1, "ERROR_WRITE_EXCEEDS_FILE_SIZE"
 
-        # initialize variables used in the while loop
-        # current_offset keeps track of the current offset where data is going to be written
-        # start from the requested offset argument
-        current_offset = offset
-        # bytes_written keeps track of the total number of bytes written
-        # start with zero
-        bytes_written = 0
-
-        # the data to be written may span multiple blocks
-        # this loop iterates through one or more blocks, ending when all data is written
-        while bytes_written < len(data):
-            # determine block index corresponding to the current offset where the write should take place
-            current_block_index = current_offset // fsconfig.BLOCK_SIZE
+        # Writing past the end of file leaves a hole between the old end and offset
+        if self._ZeroFillTail(file_inode, offset) == -1:
+            logger.debug("ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+            return -1, "ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE"
 
-            # determine the next block's boundary (in Bytes relative to the file's offset 0)
-            next_block_boundary = (current_block_index + 1) * fsconfig.BLOCK_SIZE
+        # Write the data, allocating the blocks that are missing; blocks the write covers entirely are not read
+        if self._WriteRange(file_inode, offset, data) == -1:
+            # keep the blocks allocated so far attached to the file
+            file_inode.StoreInode(self.FileNameObject.RawBlocks)
+            logger.debug("ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+            return -1, "ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE"
+        bytes_written = len(data)
 
-            logging.debug('FileOperations::Write: current_block_index: ' + str(current_block_index) + ' , next_block_boundary: ' + str(
-                next_block_boundary))
-
-            # byte position where the slice of data to write should start, within a block
-            # we use modulo arithmetic
-            # the first time around in the loop, this may not be aligned with block boundary (i.e. 0) depending on offset
-            # in subsequent iterations of this loop, it will always be 0
-            write_start = current_offset % fsconfig.BLOCK_SIZE
-
-            # determine byte position where the writing ends
-            # this may be BLOCK_SIZE if the data yet to be written spills over to the next block
-            # or, it may be smaller than BLOCK_SIZE if the data ends in this bloc
-            if (offset + len(data)) >= next_block_boundary:
-                # the data length is such that it goes beyond this block, so we're writing this entire block
-                write_end = fsconfig.BLOCK_SIZE
-            else:
-                # otherwise, the data is truncated within this block
-                write_end = (offset + len(data)) % fsconfig.BLOCK_SIZE
+        # Update inode's metadata to increment size by bytes_written, and write inode back to inode table in raw storage
+        file_inode.inode.size = offset + bytes_written
+        file_inode.StoreInode(self.FileNameObject.RawBlocks)
 
-            logging.debug('FileOperations::Write: write_start: ' + str(write_start) + ' , write_end: ' + str(write_end))
+        return bytes_written, "SUCCESS"
 
-            # retrieve index of block to be written from inode's list
-            block_number = file_inode.inode.block_numbers[current_block_index]
+    ## Appends data to the end of a file
+    ## Unlike Write at the file's size, the inode is read once and only the tail block(s) are touched
+    ## data is a bytearray
+    ## Returns (bytes_written, "SUCCESS") or (-1, "ERROR_...")
 
-            # if the data block to be written is not allocated (i.e. the block_numbers list in the inode is zero at
-            # current_block_index), we need to allocate it
-            if block_number == 0:
-                # allocate new data block
-                new_block = self.FileNameObject.AllocateDataBlock()
-                # update inode's block number list (it will be written to raw storage before the method returns)
-                file_inode.inode.block_numbers[current_block_index] = new_block
-                block_number = new_block
+    def Append(self, file_inode_number, data):
+        logger.debug("FileOperations::Append: file_inode_number: %s, len(data): %s", file_inode_number, len(data))
+
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
-            # now we have either an existing block, or a newly allocated one
-            # either way, first, we read the whole block from raw storage
-            # (if it's a newly allocated block, it's full of zeroes)
-            block = self.FileNameObject.RawBlocks.Get(block_number)
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_APPEND_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_APPEND_NOT_FILE"
+
+        size = file_inode.inode.size
+        if size + len(data) > fsconfig.MAX_FILE_SIZE:
+            logger.debug("ERROR_APPEND_EXCEEDS_FILE_SIZE %s", size + len(data))
+            return -1, "ERROR_APPEND_EXCEEDS_FILE_SIZE"
+        if len(data) == 0:
+            return 0, "SUCCESS"
 
-            # copy slice of data into the right position in this block
-            block[write_start:write_end] = data[bytes_written:bytes_written + (write_end - write_start)]
+        # The partial last block, if any, is the only one read; the others are new
+        if self._WriteRange(file_inode, size, data) == -1:
+            file_inode.StoreInode(self.FileNameObject.RawBlocks)
+            logger.debug("ERROR_APPEND_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+            return -1, "ERROR_APPEND_DATA_BLOCK_NOT_AVAILABLE"
 
-            # now write modified block back to disk
-            self.FileNameObject.RawBlocks.Put(block_number, block)
+        file_inode.inode.size = size + len(data)
+        file_inode.StoreInode(self.FileNameObject.RawBlocks)
 
-            # update offset, bytes written
-            current_offset += write_end - write_start
-            bytes_written += write_end - write_start
+        return len(data), "SUCCESS"
 
-            logging.debug('FileOperations::Write: current_offset: ' + str(current_offset) + ' , bytes_written: ' + str(
-                bytes_written) + ' , len(data): ' + str(len(data)))
+    ## Sets the size of a file to size
+    ## Shrinking releases the blocks past the new end of file; no data block is read or written (the stale
+    ## bytes left in the new last block are zeroed if the file grows again). Growing leaves a hole
+    ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
 
-        # Update inode's metadata to increment size by bytes_written, and write inode back to inode table in raw storage
-        file_inode.inode.size = offset + bytes_written
+    def Truncate(self, file_inode_number, size):
+        logger.debug("FileOperations::Truncate: file_inode_number: %s, size: %s", file_inode_number, size)
+
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
+
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_TRUNCATE_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_TRUNCATE_NOT_FILE"
+
+        if size < 0 or size > fsconfig.MAX_FILE_SIZE:
+            logger.debug("ERROR_TRUNCATE_INVALID_SIZE %s", size)
+            return -1, "ERROR_TRUNCATE_INVALID_SIZE"
+
+        if size < file_inode.inode.size:
+            num_blocks = (size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+            if self._ReleaseTail(file_inode, num_blocks) == -1:
+                logger.debug("ERROR_TRUNCATE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+                return -1, "ERROR_TRUNCATE_DATA_BLOCK_NOT_AVAILABLE"
+        # growing: the gap extends to the end of the new last block, since nothing is written to it
+        elif self._ZeroFillTail(file_inode, size + (-size % fsconfig.BLOCK_SIZE)) == -1:
+            file_inode.StoreInode(self.FileNameObject.RawBlocks)
+            logger.debug("ERROR_TRUNCATE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+            return -1, "ERROR_TRUNCATE_DATA_BLOCK_NOT_AVAILABLE"
+
+        file_inode.inode.size = size
         file_inode.StoreInode(self.FileNameObject.RawBlocks)
 
-        return bytes_written, "SUCCESS"
+        return 0, "SUCCESS"
 
     ## Reads data from a file, starting at offset
     ## offset must be less than or equal to the file's size
     ## returns a bytearray with the data read, if successful
 
     def Read(self, file_inode_number, offset, count):
-        logging.debug("FileOperations::Read: file_inode_number: " + str(file_inode_number) + ", offset: " + str(offset) + ", count: " + str(count))
+        logger.debug("FileOperations::Read: file_inode_number: %s, offset: %s, count: %s", file_inode_number, offset, count)
 
         file_inode = InodeNumber(file_inode_number)
         file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
         # type and bounds check
         if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
-            logging.debug("ERROR_READ_NOT_FILE " + str(file_inode_number))
+            logger.debug("ERROR_READ_NOT_FILE %s", file_inode_number)
             return -1, "ERROR_READ_NOT_FILE"
 
         if offset > file_inode.inode.size:
-            logging.debug("ERROR_READ_OFFSET_LARGER_THAN_SIZE " + str(offset))
+            logger.debug("ERROR_READ_OFFSET_LARGER_THAN_SIZE %s", offset)
             return -1, "ERROR_READ_OFFSET_LARGER_THAN_SIZE"
 
         # initialize variables used in the while loop
@@ -235,6 +513,14 @@ class FileOperations():
 
         read_data = bytearray(bytes_to_read)
 
+        # Map the range being read to raw blocks (extent by extent) and fetch them all in one batch
+        # (holes read as zeroes, without I/O)
+        first_index = offset // fsconfig.BLOCK_SIZE
+        num_blocks = (offset + bytes_to_read + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE - first_index
+        block_numbers = file_inode.IndexRangeToBlockNumbers(self.FileNameObject.RawBlocks, first_index, num_blocks)
+        prefetch = self._Readahead(file_inode, first_index, first_index + num_blocks)
+        blocks = self._GetFileBlocks(block_numbers, prefetch)
+
         # this loop iterates through one or more blocks, ending when all data is read
         while bytes_read < bytes_to_read:
 
@@ -244,8 +530,7 @@ class FileOperations():
             # next block's boundary (in Bytes relative to file 0)
             next_block_boundary = (current_block_index + 1) * fsconfig.BLOCK_SIZE
 
-            logging.debug('FileOperations::Read: current_block_index: ' + str(current_block_index) + ' , next_block_boundary: ' + str(
-                next_block_boundary))
+            logger.debug('FileOperations::Read: current_block_index: %s , next_block_boundary: %s', current_block_index, next_block_boundary)
 
             read_start = current_offset % fsconfig.BLOCK_SIZE
 
@@ -256,13 +541,11 @@ class FileOperations():
                 # otherwise, the data is truncated within this block
                 read_end = (offset + bytes_to_read) % fsconfig.BLOCK_SIZE
 
-            logging.debug('FileOperations::Read: read_start: ' + str(read_start) + ' , read_end: ' + str(read_end))
+            logger.debug('FileOperations::Read: read_start: %s , read_end: %s', read_start, read_end)
 
-         # retrieve index of block to be written from inode's list
-            block_number = file_inode.inode.block_numbers[current_block_index]
-
-            # first, we read the whole block from raw storage
-            block = self.FileNameObject.RawBlocks.Get(block_number)
+            # retrieve the raw block backing this block index, fetched above
+            block_number = block_numbers[current_block_index - first_index]
+            block = blocks[block_number]
 
             # copy slice of data from block into the right position in the read_block
             read_data[bytes_read:bytes_read + (read_end - read_start)] = block[read_start:read_end]
@@ -270,100 +553,298 @@ class FileOperations():
             bytes_read += read_end - read_start
             current_offset += read_end - read_start
 
-            logging.debug('FileOperations::Read: current_offset: ' + str(current_offset) + ' , bytes_read: ' + str(bytes_read))
+            logger.debug('FileOperations::Read: current_offset: %s , bytes_read: %s', current_offset, bytes_read)
 
         return read_data, "SUCCESS"
 
 
-    ## Removes count bytes from a file starting at offset
-    ## The data after (offset+count) is shifted left to fill the gap
-    ## Returns (bytes_removed, "SUCCESS") or (-1, "ERROR_...")
+    ## Reads a file as a stream, starting at offset
+    ## Data is fetched and yielded one window at a time: chunk bytes (rounded up to whole blocks, one stripe
+    ## width of blocks, i.e. whole stripes, by default), with the windows aligned to block boundaries of the file, so memory
+    ## use does not grow with the size of the file
+    ## Returns a generator of memoryviews and "SUCCESS", or (-1, "ERROR_...")
 
-    def Slice(self, file_inode_number, offset, count):
-        logging.debug("FileOperations::Slice: file_inode_number: " + str(file_inode_number) + ", offset: " + str(offset) + ", count: " + str(count))
+    def ReadStream(self, file_inode_number, offset, chunk=None):
+        logger.debug("FileOperations::ReadStream: file_inode_number: %s, offset: %s, chunk: %s", file_inode_number, offset, chunk)
 
-        # Load the file inode
         file_inode = InodeNumber(file_inode_number)
         file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
-        # Verify it's a file
+        # type and bounds check
         if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
-            logging.debug("ERROR_SLICE_NOT_FILE " + str(file_inode_number))
-            return -1, "ERROR_SLICE_NOT_FILE"
+            logger.debug("ERROR_READ_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_READ_NOT_FILE"
 
-        # Validate offset is within file size
-        if offset >= file_inode.inode.size:
-            logging.debug("ERROR_SLICE_OFFSET_LARGER_THAN_SIZE " + str(offset))
-            return -1, "ERROR_SLICE_OFFSET_LARGER_THAN_SIZE"
+        if offset > file_inode.inode.size:
+            logger.debug("ERROR_READ_OFFSET_LARGER_THAN_SIZE %s", offset)
+            return -1, "ERROR_READ_OFFSET_LARGER_THAN_SIZE"
 
-        # Validate offset+count does not exceed file size
-        if offset + count > file_inode.inode.size:
-            logging.debug("ERROR_SLICE_COUNT_EXCEEDS_SIZE " + str(offset + count))
-            return -1, "ERROR_SLICE_COUNT_EXCEEDS_SIZE"
+        if chunk is None:
+            chunk = self.FileNameObject.RawBlocks.layout.stripe_width * fsconfig.BLOCK_SIZE
+        window = max((chunk + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE, 1)
+
+        return self._ReadStreamWindows(file_inode, offset, window), "SUCCESS"
+
+    def _ReadStreamWindows(self, file_inode, offset, window):
+        RawBlocks = self.FileNameObject.RawBlocks
+        size = file_inode.inode.size
+        end_index = (size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        window_start = (offset // fsconfig.BLOCK_SIZE) // window * window
+
+        while window_start < end_index:
+            window_end = min(window_start + window, end_index)
+            block_numbers = file_inode.IndexRangeToBlockNumbers(RawBlocks, window_start, window_end - window_start)
+            prefetch = self._Readahead(file_inode, max(window_start, offset // fsconfig.BLOCK_SIZE), window_end)
+            blocks = self._GetFileBlocks(block_numbers, prefetch)
+
+            data = bytearray((window_end - window_start) * fsconfig.BLOCK_SIZE)
+            for i, block_number in enumerate(block_numbers):
+                data[i * fsconfig.BLOCK_SIZE:(i + 1) * fsconfig.BLOCK_SIZE] = blocks[block_number]
 
-        # Read all data from the file
-        file_data, errorcode = self.Read(file_inode_number, 0, file_inode.inode.size)
-        if file_data == -1:
-            logging.debug("ERROR_SLICE_READ_FAILED")
-            return -1, "ERROR_SLICE_READ_FAILED"
+            # trim to the requested offset and to the end of file
+            first_byte = max(offset - window_start * fsconfig.BLOCK_SIZE, 0)
+            last_byte = min(size, window_end * fsconfig.BLOCK_SIZE) - window_start * fsconfig.BLOCK_SIZE
+            yield memoryview(data)[first_byte:last_byte]
 
-        # Remove the sliced portion: keep data before offset, skip count bytes, keep data after offset+count
-        new_data = file_data[0:offset] + file_data[offset + count:]
-        new_size = len(new_data)
+            window_start = window_end
+
+    ## Writes a stream of data to a file, starting at offset
+    ## chunks is an iterable of bytes-like objects; they are gathered into windows of one stripe width of
+    ## blocks (whole stripes), aligned to block boundaries of the file, and each window is written as soon as it is full,
+    ## so memory use does not grow with the amount of data
+    ## Same offset and size semantics as Write; returns (bytes_written, "SUCCESS") or (-1, "ERROR_...")
+
+    def WriteStream(self, file_inode_number, offset, chunks):
+        logger.debug("FileOperations::WriteStream: file_inode_number: %s, offset: %s", file_inode_number, offset)
 
-        # Reload the inode (Read may have changed state)
         file_inode = InodeNumber(file_inode_number)
         file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
-        # Write the modified data back to the file's blocks
-        current_offset = 0
-        bytes_written = 0
+        # perform checks on type and bounds
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_WRITE_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_WRITE_NOT_FILE"
 
-        while bytes_written < new_size:
-            current_block_index = current_offset // fsconfig.BLOCK_SIZE
-            next_block_boundary = (current_block_index + 1) * fsconfig.BLOCK_SIZE
+        if offset > fsconfig.MAX_FILE_SIZE:
+            logger.debug("ERROR_WRITE_EXCEEDS_FILE_SIZE %s", offset)
+            return -1, "ERROR_WRITE_EXCEEDS_FILE_SIZE"
+
+        # Writing past the end of file leaves a hole between the old end and offset
+        if self._ZeroFillTail(file_inode, offset) == -1:
+            logger.debug("ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+            return -1, "ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE"
 
-            write_start = current_offset % fsconfig.BLOCK_SIZE
+        window_size = self.FileNameObject.RawBlocks.layout.stripe_width * fsconfig.BLOCK_SIZE
 
-            if new_size >= next_block_boundary:
-                write_end = fsconfig.BLOCK_SIZE
+        # bytes received but not yet written, starting at file offset buffer_offset
+        buffer = bytearray()
+        buffer_offset = offset
+        errorcode = "SUCCESS"
+
+        for chunk in chunks:
+            if buffer_offset + len(buffer) + len(chunk) > fsconfig.MAX_FILE_SIZE:
+                logger.debug("ERROR_WRITE_EXCEEDS_FILE_SIZE %s", buffer_offset + len(buffer) + len(chunk))
+                errorcode = "ERROR_WRITE_EXCEEDS_FILE_SIZE"
+                break
+            buffer += chunk
+
+            # write out every window that is now complete
+            window_end = (buffer_offset // window_size + 1) * window_size
+            while buffer_offset + len(buffer) >= window_end:
+                with memoryview(buffer) as view, view[:window_end - buffer_offset] as window:
+                    ret = self._WriteRange(file_inode, buffer_offset, window)
+                if ret == -1:
+                    errorcode = "ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE"
+                    break
+                del buffer[:window_end - buffer_offset]
+                buffer_offset = window_end
+                window_end += window_size
+            if errorcode != "SUCCESS":
+                break
+
+        if errorcode == "SUCCESS" and len(buffer) > 0:
+            if self._WriteRange(file_inode, buffer_offset, buffer) == -1:
+                errorcode = "ERROR_WRITE_DATA_BLOCK_NOT_AVAILABLE"
+            else:
+                buffer_offset += len(buffer)
+
+        # the file ends where the data written so far ends, as with Write
+        if errorcode == "SUCCESS" or buffer_offset > offset:
+            file_inode.inode.size = buffer_offset
+        file_inode.StoreInode(self.FileNameObject.RawBlocks)
+
+        if errorcode != "SUCCESS":
+            logger.debug("%s %s", errorcode, file_inode_number)
+            return -1, errorcode
+        return buffer_offset - offset, "SUCCESS"
+
+
+    ## Finds data and holes in a sparse file, like lseek() with SEEK_DATA and SEEK_HOLE
+    ## SeekData returns the first offset at or after offset that lies in an allocated block, and SeekHole
+    ## the first offset at or after offset that lies in a hole (the end of file counts as a hole)
+    ## Returns (position, "SUCCESS") or (-1, "ERROR_...")
+
+    def SeekData(self, file_inode_number, offset):
+        return self._Seek(file_inode_number, offset, True)
+
+    def SeekHole(self, file_inode_number, offset):
+        return self._Seek(file_inode_number, offset, False)
+
+    def _Seek(self, file_inode_number, offset, data):
+        logger.debug("FileOperations::Seek: file_inode_number: %s, offset: %s, data: %s", file_inode_number, offset, data)
+
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
+
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_SEEK_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_SEEK_NOT_FILE"
+
+        if offset >= file_inode.inode.size:
+            logger.debug("ERROR_SEEK_OFFSET_PAST_END %s", offset)
+            return -1, "ERROR_SEEK_OFFSET_PAST_END"
+
+        for start, length in self._DataRanges(file_inode, offset):
+            if data:
+                return max(start, offset), "SUCCESS"
+            if offset < start:
+                return offset, "SUCCESS"
+            offset = start + length
+        if data:
+            logger.debug("ERROR_SEEK_NO_DATA %s", offset)
+            return -1, "ERROR_SEEK_NO_DATA"
+        return min(offset, file_inode.inode.size), "SUCCESS"
+
+    ## Returns the allocated byte ranges of a file, as a list of (offset, length) tuples within its size
+
+    def DataRanges(self, file_inode_number):
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_SEEK_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_SEEK_NOT_FILE"
+        return self._DataRanges(file_inode, 0), "SUCCESS"
+
+    def _DataRanges(self, file_inode, offset):
+        size = file_inode.inode.size
+        first_index = offset // fsconfig.BLOCK_SIZE
+        end_index = (size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        ranges = []
+        for index, block_number, length in file_inode.MapExtents(self.FileNameObject.RawBlocks, first_index,
+                                                                 end_index - first_index):
+            if block_number == 0:
+                continue
+            start = index * fsconfig.BLOCK_SIZE
+            end = min((index + length) * fsconfig.BLOCK_SIZE, size)
+            # extents of consecutive raw blocks that follow each other in the file are one range
+            if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
             else:
-                write_end = new_size % fsconfig.BLOCK_SIZE
+                ranges.append((start, end - start))
+        return ranges
+
 
-            block_number = file_inode.inode.block_numbers[current_block_index]
+    ## Removes count bytes from a file starting at offset
+    ## The data after (offset+count) is shifted left to fill the gap
+    ## Returns (bytes_removed, "SUCCESS") or (-1, "ERROR_...")
 
-            # Read the existing block
-            block = self.FileNameObject.RawBlocks.Get(block_number)
+    def Slice(self, file_inode_number, offset, count):
+        logger.debug("FileOperations::Slice: file_inode_number: %s, offset: %s, count: %s", file_inode_number, offset, count)
 
-            # Copy the new data into the block
-            block[write_start:write_end] = new_data[bytes_written:bytes_written + (write_end - write_start)]
+        # Load the file inode
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
-            # If writing less than a full block, zero out the remainder
-            if write_end < fsconfig.BLOCK_SIZE:
-                block[write_end:fsconfig.BLOCK_SIZE] = bytearray(fsconfig.BLOCK_SIZE - write_end)
+        # Verify it's a file
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_SLICE_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_SLICE_NOT_FILE"
 
-            # Write the block back to raw storage
-            self.FileNameObject.RawBlocks.Put(block_number, block)
+        # Validate offset is within file size
+        if offset >= file_inode.inode.size:
+            logger.debug("ERROR_SLICE_OFFSET_LARGER_THAN_SIZE %s", offset)
+            return -1, "ERROR_SLICE_OFFSET_LARGER_THAN_SIZE"
 
-            current_offset += write_end - write_start
-            bytes_written += write_end - write_start
+        # Validate offset+count does not exceed file size
+        if offset + count > file_inode.inode.size:
+            logger.debug("ERROR_SLICE_COUNT_EXCEEDS_SIZE %s", offset + count)
+            return -1, "ERROR_SLICE_COUNT_EXCEEDS_SIZE"
 
-        # Free any blocks that are no longer needed
+        RawBlocks = self.FileNameObject.RawBlocks
+        new_size = file_inode.inode.size - count
+
+        # Blocks before offset are left alone. Every byte at or after offset moves left by count:
+        # new[p] = old[p + count]. Destination blocks are rebuilt in windows of one stripe width of blocks;
+        # each window reads only the source blocks it needs (never ones already rewritten, since sources lie
+        # at or beyond their destination) and is written back with one PutBlocks
+        first_dest = offset // fsconfig.BLOCK_SIZE
+        end_dest = (new_size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        window = self.FileNameObject.RawBlocks.layout.stripe_width
+
+        # source blocks read so far, by block index; only the last one is carried into the next window
+        source_blocks = {}
+
+        for window_start in range(first_dest, end_dest, window):
+            window_end = min(window_start + window, end_dest)
+
+            # byte range [dest_start, dest_end) of the file rewritten by this window
+            dest_start = max(offset, window_start * fsconfig.BLOCK_SIZE)
+            dest_end = min(new_size, window_end * fsconfig.BLOCK_SIZE)
+
+            # source block indices holding old[dest_start + count : dest_end + count]
+            needed = set()
+            if dest_end > dest_start:
+                needed = set(range((dest_start + count) // fsconfig.BLOCK_SIZE,
+                                   (dest_end + count - 1) // fsconfig.BLOCK_SIZE + 1))
+            # the block holding offset keeps its head, so it must be read as well
+            if window_start == first_dest and offset % fsconfig.BLOCK_SIZE != 0:
+                needed.add(first_dest)
+
+            for index in [i for i in source_blocks if i not in needed]:
+                del source_blocks[index]
+            missing = sorted(i for i in needed if i not in source_blocks)
+            if missing:
+                block_numbers = file_inode.IndexRangeToBlockNumbers(RawBlocks, missing[0], missing[-1] - missing[0] + 1)
+                fetched = self._GetFileBlocks([block_numbers[i - missing[0]] for i in missing])
+                for i in missing:
+                    source_blocks[i] = fetched[block_numbers[i - missing[0]]]
+
+            # rebuild the destination blocks of this window
+            modified = {}
+            for index in range(window_start, window_end):
+                block_start = index * fsconfig.BLOCK_SIZE
+                block = bytearray(fsconfig.BLOCK_SIZE)
+                if index == first_dest and offset > block_start:
+                    block[0:offset - block_start] = source_blocks[first_dest][0:offset - block_start]
+                # copy the shifted bytes, one source block piece at a time; the rest of the block stays zero
+                position = max(offset, block_start)
+                while position < min(new_size, block_start + fsconfig.BLOCK_SIZE):
+                    source = position + count
+                    source_index = source // fsconfig.BLOCK_SIZE
+                    length = min(fsconfig.BLOCK_SIZE - source % fsconfig.BLOCK_SIZE,
+                                 block_start + fsconfig.BLOCK_SIZE - position, new_size - position)
+                    source_start = source % fsconfig.BLOCK_SIZE
+                    block[position - block_start:position - block_start + length] = \
+                        source_blocks[source_index][source_start:source_start + length]
+                    position += length
+                modified[index] = block
+
+            if self._PutFileBlocks(file_inode, modified) == -1:
+                file_inode.StoreInode(RawBlocks)
+                logger.debug("ERROR_SLICE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+                return -1, "ERROR_SLICE_DATA_BLOCK_NOT_AVAILABLE"
+
+        # Free the trailing blocks that are no longer needed, with one bitmap update
         old_num_blocks = (file_inode.inode.size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
-        new_num_blocks = (new_size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
-        if new_size == 0:
-            new_num_blocks = 0
+        new_num_blocks = end_dest
 
-        for i in range(new_num_blocks, old_num_blocks):
-            block_number = file_inode.inode.block_numbers[i]
-            if block_number != 0:
-                # Mark block as free in bitmap
-                bitmap_block = fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)
-                block = self.FileNameObject.RawBlocks.Get(bitmap_block)
-                block[block_number % fsconfig.BLOCK_SIZE] = 0
-                self.FileNameObject.RawBlocks.Put(bitmap_block, block)
-                # Clear block number from inode
-                file_inode.inode.block_numbers[i] = 0
+        if new_num_blocks < old_num_blocks:
+            # Detach the blocks (and emptied indirect blocks) from the inode and mark them free in bitmap
+            # (indirect blocks shared with a snapshot are copied rather than modified)
+            if self._ReleaseTail(file_inode, new_num_blocks) == -1:
+                file_inode.StoreInode(RawBlocks)
+                logger.debug("ERROR_SLICE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+                return -1, "ERROR_SLICE_DATA_BLOCK_NOT_AVAILABLE"
 
         # Update inode size
         file_inode.inode.size = new_size
@@ -376,7 +857,7 @@ class FileOperations():
     ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
 
     def Mirror(self, file_inode_number):
-        logging.debug("FileOperations::Mirror: file_inode_number: " + str(file_inode_number))
+        logger.debug("FileOperations::Mirror: file_inode_number: %s", file_inode_number)
 
         # Load the file inode
         file_inode = InodeNumber(file_inode_number)
@@ -384,57 +865,126 @@ class FileOperations():
 
         # Verify it's a file
         if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
-            logging.debug("ERROR_MIRROR_NOT_FILE " + str(file_inode_number))
+            logger.debug("ERROR_MIRROR_NOT_FILE %s", file_inode_number)
             return -1, "ERROR_MIRROR_NOT_FILE"
 
         # If file is empty, nothing to reverse
         if file_inode.inode.size == 0:
             return 0, "SUCCESS"
 
-        # Read all file data
-        file_data, errorcode = self.Read(file_inode_number, 0, file_inode.inode.size)
-        if file_data == -1:
-            logging.debug("ERROR_MIRROR_READ_FAILED")
-            return -1, "ERROR_MIRROR_READ_FAILED"
-
-        # Reverse the data
-        reversed_data = bytearray(reversed(file_data))
-
-        # Write the reversed data back using the same block-level approach as Write
-        # Reload the inode (Read may have changed state)
-        file_inode = InodeNumber(file_inode_number)
-        file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
-
-        current_offset = 0
-        bytes_written = 0
-        total_size = file_inode.inode.size
-
-        while bytes_written < total_size:
-            current_block_index = current_offset // fsconfig.BLOCK_SIZE
-            next_block_boundary = (current_block_index + 1) * fsconfig.BLOCK_SIZE
+        RawBlocks = self.FileNameObject.RawBlocks
+        size = file_inode.inode.size
+        num_blocks = (size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+
+        # Byte p of the mirrored file is byte size-1-p of the original, so destination block i draws from
+        # (at most two) source blocks at the other end of the file. Blocks are rewritten in pairs, first and
+        # last working inward; only the old blocks still needed by the next pair are kept in memory, and
+        # every destination block is rebuilt whole, so it is never read before being written
+        def SourceIndices(index):
+            first = size - min(size, (index + 1) * fsconfig.BLOCK_SIZE)
+            last = size - index * fsconfig.BLOCK_SIZE - 1
+            return set(range(first // fsconfig.BLOCK_SIZE, last // fsconfig.BLOCK_SIZE + 1))
+
+        # old block contents, by block index
+        source_blocks = {}
+
+        low = 0
+        high = num_blocks - 1
+        while low <= high:
+            destinations = sorted(set([low, high]))
+
+            missing = set()
+            for index in destinations:
+                missing |= SourceIndices(index)
+            missing = sorted(i for i in missing if i not in source_blocks)
+            if missing:
+                block_numbers = dict((i, file_inode.IndexToBlockNumber(RawBlocks, i)) for i in missing)
+                fetched = self._GetFileBlocks(list(block_numbers.values()))
+                for i in missing:
+                    source_blocks[i] = fetched[block_numbers[i]]
+
+            modified = {}
+            for index in destinations:
+                block_start = index * fsconfig.BLOCK_SIZE
+                block = bytearray(fsconfig.BLOCK_SIZE)
+                # fill the block one source block piece at a time; bytes past the end of file stay zero
+                position = block_start
+                while position < min(size, block_start + fsconfig.BLOCK_SIZE):
+                    source = size - 1 - position
+                    source_start = source % fsconfig.BLOCK_SIZE
+                    length = min(source_start + 1, block_start + fsconfig.BLOCK_SIZE - position, size - position)
+                    piece = source_blocks[source // fsconfig.BLOCK_SIZE][source_start - length + 1:source_start + 1]
+                    block[position - block_start:position - block_start + length] = piece[::-1]
+                    position += length
+                modified[index] = block
+
+            if self._PutFileBlocks(file_inode, modified) == -1:
+                file_inode.StoreInode(RawBlocks)
+                logger.debug("ERROR_MIRROR_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+                return -1, "ERROR_MIRROR_DATA_BLOCK_NOT_AVAILABLE"
+
+            # keep only the old blocks the next pair still needs
+            low += 1
+            high -= 1
+            needed = set()
+            if low <= high:
+                needed = SourceIndices(low) | SourceIndices(high)
+            for index in [i for i in source_blocks if i not in needed]:
+                del source_blocks[index]
+
+        # holes that received data were allocated
+        file_inode.StoreInode(RawBlocks)
 
-            write_start = current_offset % fsconfig.BLOCK_SIZE
-
-            if total_size >= next_block_boundary:
-                write_end = fsconfig.BLOCK_SIZE
-            else:
-                write_end = total_size % fsconfig.BLOCK_SIZE
-
-            block_number = file_inode.inode.block_numbers[current_block_index]
+        return 0, "SUCCESS"
 
-            # Read the existing block from raw storage
-            block = self.FileNameObject.RawBlocks.Get(block_number)
 
-            # Copy the reversed data into the block
-            block[write_start:write_end] = reversed_data[bytes_written:bytes_written + (write_end - write_start)]
+    ## Creates file name in directory dir as a copy-on-write clone of a file (cp --reflink)
+    ## The clone shares the file's data blocks, which are copied only when either file writes to them
+    ## Returns (inode number of the clone, "SUCCESS") or (-1, "ERROR_...")
 
-            # Write the block back to raw storage
-            self.FileNameObject.RawBlocks.Put(block_number, block)
+    def Clone(self, file_inode_number, dir, name):
+        logger.debug("FileOperations::Clone: file_inode_number: %s, dir: %s, name: %s", file_inode_number, dir, name)
 
-            current_offset += write_end - write_start
-            bytes_written += write_end - write_start
+        RawBlocks = self.FileNameObject.RawBlocks
 
-        return 0, "SUCCESS"
+        # Load the file inode, verify it's a file
+        file_inode = InodeNumber(file_inode_number)
+        file_inode.InodeNumberToInode(RawBlocks)
+        if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
+            logger.debug("ERROR_CLONE_NOT_FILE %s", file_inode_number)
+            return -1, "ERROR_CLONE_NOT_FILE"
+
+        clone_inode_number, errorcode = self.Create(dir, name, fsconfig.INODE_TYPE_FILE)
+        if clone_inode_number == -1:
+            return -1, errorcode
+
+        num_blocks = (file_inode.inode.size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        block_numbers = dict((index, file_inode.IndexToBlockNumber(RawBlocks, index)) for index in range(0, num_blocks))
+        block_numbers = dict((index, b) for index, b in block_numbers.items() if b != 0)
+
+        # From now on writers must check reference counts; the clone then takes its references
+        self.FileNameObject.MarkSharedBlocks()
+        if self.FileNameObject.IncrementBlockRefCounts(list(block_numbers.values())) == -1:
+            self.Unlink(dir, name)
+            logger.debug("ERROR_CLONE_TOO_MANY_REFERENCES %s", file_inode_number)
+            return -1, "ERROR_CLONE_TOO_MANY_REFERENCES"
+
+        clone_inode = InodeNumber(clone_inode_number)
+        clone_inode.InodeNumberToInode(RawBlocks)
+        for index in sorted(block_numbers):
+            if clone_inode.SetIndexBlockNumber(RawBlocks, index, block_numbers[index], self.FileNameObject.AllocateDataBlock) == -1:
+                # drop the references taken above, along with those already mapped
+                released = clone_inode.ReleaseBlocks(RawBlocks, 0)
+                self.FileNameObject.FreeDataBlocks(released + [block_numbers[i] for i in block_numbers if i >= index])
+                clone_inode.StoreInode(RawBlocks)
+                self.Unlink(dir, name)
+                logger.debug("ERROR_CLONE_DATA_BLOCK_NOT_AVAILABLE %s", file_inode_number)
+                return -1, "ERROR_CLONE_DATA_BLOCK_NOT_AVAILABLE"
+
+        clone_inode.inode.size = file_inode.inode.size
+        clone_inode.StoreInode(RawBlocks)
+
+        return clone_inode_number, "SUCCESS"
 
 
     ## Removes a file from directory
@@ -443,12 +993,12 @@ class FileOperations():
     ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
 
     def Unlink(self, dir, name):
-        logging.debug("FileOperations::Unlink: dir: " + str(dir) + ", name: " + str(name))
+        logger.debug("FileOperations::Unlink: dir: %s, name: %s", dir, name)
 
-        # Lookup the name in the directory to get the inode number
-        file_inode_number = self.FileNameObject.Lookup(name, dir)
+        # Lookup the name in the directory to get the inode number and the position of its entry
+        file_inode_number, entry_offset = self.FileNameObject.LookupEntry(name, dir)
         if file_inode_number == -1:
-            logging.debug("ERROR_UNLINK_NOT_FOUND " + str(name))
+            logger.debug("ERROR_UNLINK_NOT_FOUND %s", name)
             return -1, "ERROR_UNLINK_NOT_FOUND"
 
         # Load the inode and verify it's a file (not a directory)
@@ -456,25 +1006,22 @@ class FileOperations():
         file_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
         if file_inode.inode.type != fsconfig.INODE_TYPE_FILE:
-            logging.debug("ERROR_UNLINK_NOT_FILE " + str(file_inode_number))
+            logger.debug("ERROR_UNLINK_NOT_FILE %s", file_inode_number)
             return -1, "ERROR_UNLINK_NOT_FILE"
 
+        # The binding is going away; drop it from the dentry cache before the inode can be reused
+        self.FileNameObject.InvalidateDentry(dir, name)
+
         # Decrement reference count
         file_inode.inode.refcnt -= 1
 
         # If refcnt reaches 0, free the data blocks and invalidate the inode
         if file_inode.inode.refcnt == 0:
-            # Free all allocated data blocks
-            for i in range(0, fsconfig.MAX_INODE_BLOCK_NUMBERS):
-                block_number = file_inode.inode.block_numbers[i]
-                if block_number != 0:
-                    # Mark block as free in bitmap (set bitmap entry to 0)
-                    bitmap_block = fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)
-                    block = self.FileNameObject.RawBlocks.Get(bitmap_block)
-                    block[block_number % fsconfig.BLOCK_SIZE] = 0
-                    self.FileNameObject.RawBlocks.Put(bitmap_block, block)
-                    # Clear block number from inode
-                    file_inode.inode.block_numbers[i] = 0
+            # Free all allocated data blocks, including indirect blocks, and clear them from the inode
+            released = file_inode.ReleaseBlocks(self.FileNameObject.RawBlocks, 0)
+            self.FileNameObject.FreeDataBlocks(released)
+            self.FileNameObject.ReleaseReservation(file_inode_number)
+            self.readahead.pop(file_inode_number, None)
 
             # Invalidate the inode
             file_inode.inode.type = fsconfig.INODE_TYPE_INVALID
@@ -483,83 +1030,53 @@ class FileOperations():
         # Store updated inode back to raw storage
         file_inode.StoreInode(self.FileNameObject.RawBlocks)
 
-        # Remove the directory entry by finding it and shifting subsequent entries
+        # Remove the directory entry by moving the directory's last entry into its slot
+        # This touches at most two directory blocks: the one holding the entry and the last one
         dir_inode = InodeNumber(dir)
         dir_inode.InodeNumberToInode(self.FileNameObject.RawBlocks)
 
-        # Read all directory data into a single bytearray
         dir_size = dir_inode.inode.size
-        dir_data = bytearray()
-
-        offset = 0
-        while offset < dir_size:
-            block_index = offset // fsconfig.BLOCK_SIZE
-            block_number = dir_inode.inode.block_numbers[block_index]
-            block = self.FileNameObject.RawBlocks.Get(block_number)
-            if offset + fsconfig.BLOCK_SIZE <= dir_size:
-                dir_data += block[0:fsconfig.BLOCK_SIZE]
-            else:
-                dir_data += block[0:dir_size - offset]
-            offset += fsconfig.BLOCK_SIZE
-
-        # Find the entry to remove
-        entry_offset = -1
-        num_entries = dir_size // fsconfig.FILE_NAME_DIRENTRY_SIZE
-        padded_name = bytearray(name, "utf-8")
-        padded_name = bytearray(padded_name.ljust(fsconfig.MAX_FILENAME, b'\x00'))
-
-        for i in range(0, num_entries):
-            entry_start = i * fsconfig.FILE_NAME_DIRENTRY_SIZE
-            entry_name = dir_data[entry_start:entry_start + fsconfig.MAX_FILENAME]
-            if entry_name == padded_name:
-                entry_offset = entry_start
-                break
-
-        if entry_offset == -1:
-            logging.debug("ERROR_UNLINK_DIR_ENTRY_NOT_FOUND " + str(name))
-            return -1, "ERROR_UNLINK_DIR_ENTRY_NOT_FOUND"
-
-        # Remove the entry by shifting subsequent entries left
-        new_dir_data = dir_data[0:entry_offset] + dir_data[entry_offset + fsconfig.FILE_NAME_DIRENTRY_SIZE:]
-        new_dir_size = len(new_dir_data)
-
-        # Write the modified directory data back to the directory's blocks
-        write_offset = 0
-        while write_offset < new_dir_size:
-            block_index = write_offset // fsconfig.BLOCK_SIZE
-            block_number = dir_inode.inode.block_numbers[block_index]
-            block = self.FileNameObject.RawBlocks.Get(block_number)
-
-            block_start = 0
-            if write_offset + fsconfig.BLOCK_SIZE <= new_dir_size:
-                block_end = fsconfig.BLOCK_SIZE
-            else:
-                block_end = new_dir_size - write_offset
-
-            block[block_start:block_end] = new_dir_data[write_offset:write_offset + block_end]
-
-            # Zero out remainder of block if this is the last block
-            if block_end < fsconfig.BLOCK_SIZE:
-                block[block_end:fsconfig.BLOCK_SIZE] = bytearray(fsconfig.BLOCK_SIZE - block_end)
-
-            self.FileNameObject.RawBlocks.Put(block_number, block)
-            write_offset += fsconfig.BLOCK_SIZE
-
-        # Free any directory blocks that are no longer needed
-        old_num_blocks = (dir_size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+        new_dir_size = dir_size - fsconfig.FILE_NAME_DIRENTRY_SIZE
+        last_offset = new_dir_size
+
+        entry_block_number = dir_inode.IndexToBlockNumber(self.FileNameObject.RawBlocks, entry_offset // fsconfig.BLOCK_SIZE)
+        last_block_number = dir_inode.IndexToBlockNumber(self.FileNameObject.RawBlocks, last_offset // fsconfig.BLOCK_SIZE)
+        blocks = self.FileNameObject.RawBlocks.GetBlocks([entry_block_number, last_block_number])
+
+        entry_start = entry_offset % fsconfig.BLOCK_SIZE
+        last_start = last_offset % fsconfig.BLOCK_SIZE
+        entry_block = blocks[entry_block_number]
+        last_block = blocks[last_block_number]
+
+        # Copy the last entry over the removed one, then clear the last slot
+        entry_block[entry_start:entry_start + fsconfig.FILE_NAME_DIRENTRY_SIZE] = \
+            last_block[last_start:last_start + fsconfig.FILE_NAME_DIRENTRY_SIZE]
+        last_block[last_start:last_start + fsconfig.FILE_NAME_DIRENTRY_SIZE] = bytearray(fsconfig.FILE_NAME_DIRENTRY_SIZE)
+
+        # If the last block is left empty it is freed instead of written
+        # (blocks shared with a snapshot are written to copies of their own)
+        written = []
+        if entry_offset != last_offset:
+            written.append(entry_offset // fsconfig.BLOCK_SIZE)
+        if last_start != 0:
+            written.append(last_offset // fsconfig.BLOCK_SIZE)
+        private_blocks = self.FileNameObject.UnshareBlocks(dir_inode, written)
+        if private_blocks == -1:
+            logger.debug("ERROR_UNLINK_DATA_BLOCK_NOT_AVAILABLE %s", dir)
+            return -1, "ERROR_UNLINK_DATA_BLOCK_NOT_AVAILABLE"
+        modified = {}
+        if entry_offset != last_offset:
+            modified[private_blocks[entry_offset // fsconfig.BLOCK_SIZE]] = entry_block
+        if last_start != 0:
+            modified[private_blocks[last_offset // fsconfig.BLOCK_SIZE]] = last_block
+        self.FileNameObject.RawBlocks.PutBlocks(modified)
+
+        # Free the directory block that is no longer needed
         new_num_blocks = (new_dir_size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
-        if new_dir_size == 0:
-            new_num_blocks = 0
-
-        for i in range(new_num_blocks, old_num_blocks):
-            block_number = dir_inode.inode.block_numbers[i]
-            if block_number != 0:
-                # Mark block as free in bitmap
-                bitmap_block = fsconfig.FREEBITMAP_BLOCK_OFFSET + (block_number // fsconfig.BLOCK_SIZE)
-                block = self.FileNameObject.RawBlocks.Get(bitmap_block)
-                block[block_number % fsconfig.BLOCK_SIZE] = 0
-                self.FileNameObject.RawBlocks.Put(bitmap_block, block)
-                dir_inode.inode.block_numbers[i] = 0
+        if last_start == 0:
+            self.FileNameObject.UnshareIndirectBlocks(dir_inode)
+            released = dir_inode.ReleaseBlocks(self.FileNameObject.RawBlocks, new_num_blocks)
+            self.FileNameObject.FreeDataBlocks(released)
 
         # Update directory inode size and decrement refcnt
         dir_inode.inode.size = new_dir_size
@@ -4,8 +4,15 @@ import logging, argparse
 global TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE, NO_OF_SERVERS, STARTPORT
 global INODE_TYPE_INVALID, INODE_TYPE_FILE, INODE_TYPE_DIR, INODE_TYPE_SYM
 global INODES_PER_BLOCK, FREEBITMAP_NUM_BLOCKS, INODE_BLOCK_OFFSET, INODE_NUM_BLOCKS, MAX_INODE_BLOCK_NUMBERS, \
-        MAX_FILE_SIZE, DATA_BLOCKS_OFFSET, DATA_NUM_BLOCKS, FILE_NAME_DIRENTRY_SIZE, FILE_ENTRIES_PER_DATA_BLOCK
+        MAX_FILE_SIZE, DATA_BLOCKS_OFFSET, DATA_NUM_BLOCKS, FILE_NAME_DIRENTRY_SIZE, FILE_ENTRIES_PER_DATA_BLOCK, \
+        MAX_SNAPSHOTS
+global BLOCK_NUMBERS_PER_BLOCK, INODE_DIRECT_BLOCK_NUMBERS, INODE_SINGLE_INDIRECT_SLOT, INODE_DOUBLE_INDIRECT_SLOT, \
+        MAX_FILE_BLOCKS, INODE_FLAG_INDIRECT
 global CID, PORT, MAX_CLIENTS, SERVER_ADDRESS, RSM_UNLOCKED, RSM_LOCKED, SOCKET_TIMEOUT, RETRY_INTERVAL
+global READAHEAD_MAX_STRIPES, BLOCK_CACHE_SIZE, DEDUP, INTENT_LOG, INTENT_LOG_MAX_DIRTY, \
+        INTENT_LOG_MAX_BYTES, PARITY_FLUSH_INTERVAL, DIRTY_REGION_STRIPES, DIRTY_REGION_MAX_IDLE, RAID_LAYOUT, \
+        LOG_PROFILE, LOG_LEVELS, RPC_TRACE, STRIPE_UNIT, \
+        LEASE_TIME, LEASE_LOCK_NUMBER, LEASE_POLL_INTERVAL
 
 # Useful variables that are derived from the above
 # Call this function to compute derived file system parameters
@@ -16,6 +23,9 @@ def ConfigureFSConstants(args):
 
     global TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE, NO_OF_SERVERS, STARTPORT
     global CID, PORT, MAX_CLIENTS, SERVER_ADDRESS, RSM_UNLOCKED, RSM_LOCKED, SOCKET_TIMEOUT, RETRY_INTERVAL
+    global READAHEAD_MAX_STRIPES, BLOCK_CACHE_SIZE, DEDUP, INTENT_LOG, INTENT_LOG_MAX_DIRTY, \
+        INTENT_LOG_MAX_BYTES, PARITY_FLUSH_INTERVAL, DIRTY_REGION_STRIPES, DIRTY_REGION_MAX_IDLE, RAID_LAYOUT, \
+        LOG_PROFILE, LOG_LEVELS, RPC_TRACE, STRIPE_UNIT, LEASE_TIME, LEASE_LOCK_NUMBER, LEASE_POLL_INTERVAL
     # Default values
     # Total number of blocks in raw storage
     TOTAL_NUM_BLOCKS = 256
@@ -29,6 +39,33 @@ def ConfigureFSConstants(args):
     PORT = 8000
     NO_OF_SERVERS = 4
     STARTPORT = 8000
+    # Largest readahead window for sequential reads (in stripes; 0 disables readahead)
+    READAHEAD_MAX_STRIPES = 8
+    # Number of blocks the client keeps in its block cache
+    BLOCK_CACHE_SIZE = 64
+    # Deduplicate file data blocks by contents
+    DEDUP = False
+    # Local file logging the stripes with writes in flight, replayed at startup (None disables it)
+    INTENT_LOG = None
+    # Dirty-region bitmap (used when there is no intent log): stripes per region (0 disables it)
+    DIRTY_REGION_STRIPES = 0
+    # Deferred parity: seconds between two folds of the pending parity updates into the parity blocks
+    # (0 disables deferred parity: each write updates its stripe's parity right away)
+    PARITY_FLUSH_INTERVAL = 0
+    # Placement of blocks and parity on the servers (see raidlayout.LAYOUTS): raid0, raid1, raid4,
+    # raid5 (right-asymmetric), raid5-left-asymmetric, raid5-left-symmetric, raid5-right-symmetric or raid6
+    RAID_LAYOUT = 'raid5'
+    # Stripe unit: consecutive logical blocks stored on the same server before moving on to the next one
+    STRIPE_UNIT = 1
+    # Logging (see fslog.py): profile (debug, info or production), levels of given modules' loggers
+    # ({module: level}), and tracing of one in every RPC_TRACE calls to the block servers (0 disables it)
+    LOG_PROFILE = 'debug'
+    LOG_LEVELS = {}
+    RPC_TRACE = 0
+    # File system lock shared by the clients: seconds a lease on it lasts unless renewed, so a crashed client
+    # holds it at most this long. 0 (the default) disables the lock: a single client mounts the file system,
+    # with no lock RPCs; several clients must all run with the same LEASE_TIME > 0
+    LEASE_TIME = 0
 
     # Override defaults if provided in command line arguments (args)
     if args.total_num_blocks:
@@ -49,18 +86,51 @@ def ConfigureFSConstants(args):
         NO_OF_SERVERS = args.no_of_servers
     if hasattr(args, 'server_address') and args.server_address:
         SERVER_ADDRESS = args.server_address
+    if hasattr(args, 'readahead') and args.readahead is not None:
+        READAHEAD_MAX_STRIPES = args.readahead
+    if hasattr(args, 'block_cache_size') and args.block_cache_size is not None:
+        BLOCK_CACHE_SIZE = args.block_cache_size
+    if hasattr(args, 'dedup') and args.dedup:
+        DEDUP = True
+    if hasattr(args, 'intent_log') and args.intent_log:
+        INTENT_LOG = args.intent_log
+    if hasattr(args, 'dirty_region_stripes') and args.dirty_region_stripes is not None:
+        DIRTY_REGION_STRIPES = args.dirty_region_stripes
+    if hasattr(args, 'parity_flush_interval') and args.parity_flush_interval is not None:
+        PARITY_FLUSH_INTERVAL = args.parity_flush_interval
+    if hasattr(args, 'raid_layout') and args.raid_layout:
+        RAID_LAYOUT = args.raid_layout
+    if hasattr(args, 'stripe_unit') and args.stripe_unit:
+        STRIPE_UNIT = args.stripe_unit
+    if hasattr(args, 'log_profile') and args.log_profile:
+        LOG_PROFILE = args.log_profile
+    if hasattr(args, 'log_levels') and args.log_levels:
+        LOG_LEVELS = args.log_levels
+    if hasattr(args, 'rpc_trace') and args.rpc_trace is not None:
+        RPC_TRACE = args.rpc_trace
+    if hasattr(args, 'lease_time') and args.lease_time is not None:
+        LEASE_TIME = args.lease_time
 
     # These are constants that SHOULD NEVER BE MODIFIED
     global MAX_FILENAME, INODE_NUMBER_DIRENTRY_SIZE, FREEBITMAP_BLOCK_OFFSET, INODE_BYTES_SIZE_TYPE_REFCNT, \
-            INODE_BYTES_STORE_BLOCK_NUMBER
+            INODE_BYTES_STORE_BLOCK_NUMBER, MAX_BLOCK_REFCNT, SUPERBLOCK_BLOCK_NUMBER, SUPERBLOCK_FLAG_SHARED, \
+            DIRTY_REGION_BLOCK_NUMBER, DUMP_MAGIC, DUMP_VERSION, DUMP_CHUNK_STRIPES
 
     # Maximum file name (in characters)
     MAX_FILENAME = 12
     # Number of Bytes to store an inode number in directory entry
     INODE_NUMBER_DIRENTRY_SIZE = 4
     # To be consistent with book, block 0 is root block, 1 superblock
+    # Block 0 is otherwise unused by the file system; it holds the dirty-region bitmap
+    DIRTY_REGION_BLOCK_NUMBER = 0
+    SUPERBLOCK_BLOCK_NUMBER = 1
+    # Superblock flags (byte 0 of the superblock): data blocks may be shared (snapshots, reflink copies)
+    SUPERBLOCK_FLAG_SHARED = 0x01
     # Bitmap of free blocks starts at offset 2
     FREEBITMAP_BLOCK_OFFSET = 2
+    # Each bitmap entry is the reference count of its block: 0 means free, and a data block shared by
+    # several files (e.g. deduplicated) counts each of them, up to this many
+    MAX_BLOCK_REFCNT = 255
     # Number of bytes used to store size, type, refcnt in an inode
     #   4 bytes for size
     #   2 bytes for type
@@ -68,6 +138,10 @@ def ConfigureFSConstants(args):
     INODE_BYTES_SIZE_TYPE_REFCNT = 8
     # Number of bytes used in an inode to store a block number
     INODE_BYTES_STORE_BLOCK_NUMBER = 4
+    # Dump files (save/load): magic number and format version in their header, and stripes per chunk
+    DUMP_MAGIC = b'RAID5FSD'
+    DUMP_VERSION = 2
+    DUMP_CHUNK_STRIPES = 16
 
     # Supported inode types
     global INODE_TYPE_INVALID, INODE_TYPE_FILE, INODE_TYPE_DIR, INODE_TYPE_SYM
@@ -76,6 +150,11 @@ def ConfigureFSConstants(args):
     INODE_TYPE_DIR = 2
     INODE_TYPE_SYM = 3
 
+    # Inode flags (stored in the high byte of the 2-byte type field)
+    global INODE_FLAG_INDIRECT
+    # block_numbers[] uses the direct + single indirect + double indirect layout
+    INODE_FLAG_INDIRECT = 0x01
+
 
     # Parameters derived from the above
     global INODES_PER_BLOCK, FREEBITMAP_NUM_BLOCKS, INODE_BLOCK_OFFSET, INODE_NUM_BLOCKS, MAX_INODE_BLOCK_NUMBERS, \
@@ -99,9 +178,30 @@ def ConfigureFSConstants(args):
     # In total, 4+2+2=8 bytes are used for size+type+refcnt, remaining bytes for block numbers
     MAX_INODE_BLOCK_NUMBERS = (INODE_SIZE - INODE_BYTES_SIZE_TYPE_REFCNT) // INODE_BYTES_STORE_BLOCK_NUMBER
 
+    # Block mapping of inodes with INODE_FLAG_INDIRECT set: all but the last two entries of block_numbers[]
+    # are direct pointers, the next-to-last entry points to a single indirect block and the last entry
+    # to a double indirect block. Inodes without the flag use every entry as a direct pointer.
+    global BLOCK_NUMBERS_PER_BLOCK, INODE_DIRECT_BLOCK_NUMBERS, INODE_SINGLE_INDIRECT_SLOT, INODE_DOUBLE_INDIRECT_SLOT, \
+        MAX_FILE_BLOCKS
+
+    # Number of block numbers that fit in an indirect block
+    BLOCK_NUMBERS_PER_BLOCK = BLOCK_SIZE // INODE_BYTES_STORE_BLOCK_NUMBER
+    if MAX_INODE_BLOCK_NUMBERS >= 2:
+        INODE_DIRECT_BLOCK_NUMBERS = MAX_INODE_BLOCK_NUMBERS - 2
+        INODE_SINGLE_INDIRECT_SLOT = MAX_INODE_BLOCK_NUMBERS - 2
+        INODE_DOUBLE_INDIRECT_SLOT = MAX_INODE_BLOCK_NUMBERS - 1
+        MAX_FILE_BLOCKS = max(MAX_INODE_BLOCK_NUMBERS, INODE_DIRECT_BLOCK_NUMBERS + BLOCK_NUMBERS_PER_BLOCK
+                              + BLOCK_NUMBERS_PER_BLOCK * BLOCK_NUMBERS_PER_BLOCK)
+    else:
+        # not enough room in the inode for indirect pointers
+        INODE_DIRECT_BLOCK_NUMBERS = MAX_INODE_BLOCK_NUMBERS
+        INODE_SINGLE_INDIRECT_SLOT = -1
+        INODE_DOUBLE_INDIRECT_SLOT = -1
+        MAX_FILE_BLOCKS = MAX_INODE_BLOCK_NUMBERS
+
     # maximum size of a file
-    # maximum number of entries in an inode's block_numbers[], times block size
-    MAX_FILE_SIZE = MAX_INODE_BLOCK_NUMBERS*BLOCK_SIZE
+    # maximum number of blocks reachable from an inode, times block size
+    MAX_FILE_SIZE = MAX_FILE_BLOCKS*BLOCK_SIZE
 
     # Data blocks start at INODE_BLOCK_OFFSET + INODE_NUM_BLOCKS
     DATA_BLOCKS_OFFSET = INODE_BLOCK_OFFSET + INODE_NUM_BLOCKS
@@ -115,6 +215,11 @@ def ConfigureFSConstants(args):
     # Number of filename+inode entries that can be stored in a single block
     FILE_ENTRIES_PER_DATA_BLOCK = BLOCK_SIZE // FILE_NAME_DIRENTRY_SIZE
 
+    # Snapshot table, in the superblock after a first entry-sized slot holding the superblock flags:
+    # one (name, index block of the snapshot's inode table copy) entry per snapshot, laid out like directory entries
+    global MAX_SNAPSHOTS
+    MAX_SNAPSHOTS = FILE_ENTRIES_PER_DATA_BLOCK - 1
+
     # For locks: RSM_UNLOCKED=0 , RSM_LOCKED=1
     RSM_UNLOCKED = bytearray(b'\x00') * 1
     RSM_LOCKED = bytearray(b'\x01') * 1
@@ -123,8 +228,19 @@ def ConfigureFSConstants(args):
     if 'SERVER_ADDRESS' not in dir() or not SERVER_ADDRESS:
         SERVER_ADDRESS = '127.0.0.1'
     MAX_CLIENTS = 8
+    # Stripes the intent log keeps marked dirty after their writes completed, at most (and so resynchronizes
+    # after a crash, at most, besides those with writes in flight)
+    INTENT_LOG_MAX_DIRTY = 32
+    # Idle regions the dirty-region bitmap keeps marked dirty, at most
+    DIRTY_REGION_MAX_IDLE = 4
+    # The intent log is compacted (rewritten with only its live entries) once it grows past this size
+    INTENT_LOG_MAX_BYTES = 65536
     SOCKET_TIMEOUT = 5
     RETRY_INTERVAL = 10
+    # Lock of the file system on the first block server, and how often (in seconds) a client waiting for
+    # another one's lease tries again
+    LEASE_LOCK_NUMBER = 0
+    LEASE_POLL_INTERVAL = 0.05
 
 
 ## Prints out file system information
@@ -140,9 +256,20 @@ def PrintFSConstants():
     print ('Free bitmap size (blocks) : ' + str(FREEBITMAP_NUM_BLOCKS))
     print ('Inode table offset        : ' + str(INODE_BLOCK_OFFSET))
     print ('Inode table size (blocks) : ' + str(INODE_NUM_BLOCKS))
-    print ('Max blocks per file       : ' + str(MAX_INODE_BLOCK_NUMBERS))
+    print ('Block numbers per inode   : ' + str(MAX_INODE_BLOCK_NUMBERS))
+    print ('Max blocks per file       : ' + str(MAX_FILE_BLOCKS))
     print ('Data blocks offset        : ' + str(DATA_BLOCKS_OFFSET))
     print ('Data block size (blocks)  : ' + str(DATA_NUM_BLOCKS))
+    print ('Readahead (stripes)       : ' + str(READAHEAD_MAX_STRIPES))
+    print ('Block cache (blocks)      : ' + str(BLOCK_CACHE_SIZE))
+    print ('Deduplication             : ' + str(DEDUP))
+    print ('Intent log                : ' + str(INTENT_LOG))
+    print ('Dirty region (stripes)    : ' + str(DIRTY_REGION_STRIPES))
+    print ('Parity flush interval (s) : ' + str(PARITY_FLUSH_INTERVAL))
+    print ('RAID layout               : ' + str(RAID_LAYOUT))
+    print ('Stripe unit (blocks)      : ' + str(STRIPE_UNIT))
+    print ('Log profile               : ' + str(LOG_PROFILE))
+    print ('Lease time (s)            : ' + str(LEASE_TIME))
     print ('Raw block layer layout: (B: boot, S: superblock, F: free bitmap, I: inode, D: data')
     Layout = "BS"
     Id = "01"
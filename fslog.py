@@ -0,0 +1,93 @@
+import fsconfig
+import logging
+import argparse, itertools, time
+import xmlrpc.client
+
+#### LOGGING
+
+
+## Logging of the client, set up by ConfigureLogging() from fsconfig:
+##   LOG_PROFILE: the level of every module's logger, and where the messages go
+##     debug: DEBUG and above (hex dumps of blocks included) to LOG_FILE, INFO and above on the console
+##     info: INFO and above, to LOG_FILE and the console
+##     production: WARNING and above, to LOG_FILE and the console. Each debug message on the Get/Put
+##       paths then costs a (cached) level check: its arguments are not formatted, and hex dumps not made
+##   LOG_LEVELS: levels of given modules' loggers, overriding the profile, as {module: level}; on the
+##     command line (-ll), e.g. 'block=INFO,filename=WARNING'
+##   RPC_TRACE: trace one in every RPC_TRACE calls to the block servers in LOG_FILE (0 disables the trace)
+## Modules log through their own logger (logging.getLogger(__name__)), with %-style arguments so that a
+## message is only formatted if it is emitted; hex dumps are guarded by a level check
+
+PROFILES = {'debug': logging.DEBUG, 'info': logging.INFO, 'production': logging.WARNING}
+LOG_FILE = 'memoryfs.log'
+
+# logger of the RPC trace
+rpc_logger = logging.getLogger('rpc')
+
+
+## Returns {module name: level} from a -ll argument
+
+def ParseLogLevels(log_levels):
+    levels = {}
+    for entry in log_levels.split(','):
+        if not entry.strip():
+            continue
+        module, _, level = entry.partition('=')
+        level = level.strip().upper()
+        if not module.strip() or not isinstance(logging.getLevelName(level), int):
+            raise argparse.ArgumentTypeError('malformed module log level ' + repr(entry) + ', expected module=LEVEL')
+        levels[module.strip()] = logging.getLevelName(level)
+    return levels
+
+
+def ConfigureLogging():
+    level = PROFILES[fsconfig.LOG_PROFILE]
+    root = logging.getLogger()
+    root.setLevel(level)
+    file_handler = logging.FileHandler(LOG_FILE, mode='a')
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(file_handler)
+
+    # Console: INFO and above, unless the profile asks for less
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(max(level, logging.INFO))
+    root.addHandler(console_handler)
+
+    for module, module_level in fsconfig.LOG_LEVELS.items():
+        logging.getLogger(module).setLevel(module_level)
+
+    # The trace is logged at DEBUG: it goes to the log file, not to the console
+    if fsconfig.RPC_TRACE > 0:
+        rpc_logger.setLevel(logging.DEBUG)
+
+
+## Transport of the block servers' XML-RPC proxies when the RPC trace is on: every RPC_TRACE-th call (counted
+## over all servers) is logged with its method (and the methods of a multicall), its size and its duration.
+## Calls that are not sampled only pay for incrementing the counter
+
+class TracingTransport(xmlrpc.client.Transport):
+    calls = itertools.count()
+
+    def request(self, host, handler, request_body, verbose=False):
+        if next(self.calls) % fsconfig.RPC_TRACE:
+            return super().request(host, handler, request_body, verbose)
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return super().request(host, handler, request_body, verbose)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            params, method = xmlrpc.client.loads(request_body)
+            if method == 'system.multicall':
+                method += '[' + ','.join(call['methodName'] for call in params[0]) + ']'
+            rpc_logger.debug('RPC %s %s: %d bytes, %.3f ms, %s', host, method, len(request_body), elapsed * 1000, outcome)
+
+
+## Returns the XML-RPC proxy of the block server at server_url, tracing its calls if the RPC trace is on
+
+def ServerProxy(server_url):
+    transport = TracingTransport(use_builtin_types=True) if fsconfig.RPC_TRACE > 0 else None
+    return xmlrpc.client.ServerProxy(server_url, transport=transport, use_builtin_types=True)
@@ -1,8 +1,10 @@
 import pickle, logging
 import argparse
 import fsconfig
+import fslog
 
 from block import DiskBlocks
+from raidlayout import LAYOUTS
 from shell import FSShell
 from filename import FileName
 from fileoperations import FileOperations
@@ -12,16 +14,6 @@ import os.path
 
 if __name__ == "__main__":
 
-    # Initialize file for logging
-    # Change logging level to INFO to remove debugging messages
-    logging.basicConfig(filename='memoryfs.log', filemode='a', level=logging.DEBUG)
-
-
-    # Redirect INFO logs to console as well
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    logging.getLogger().addHandler(console_handler)
-
     # Construct the argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument('-nb', '--total_num_blocks', type=int, help='an integer value')
@@ -33,6 +25,18 @@ if __name__ == "__main__":
     ap.add_argument('-startport', '--startport', type=int, help='server port')
     ap.add_argument('-ns', '--no_of_servers',type=int, help='no of servers')
     ap.add_argument('-sa', '--server_address', type=str, help='server address')
+    ap.add_argument('-ra', '--readahead', type=int, help='max readahead window in stripes (0 disables)')
+    ap.add_argument('-bc', '--block_cache_size', type=int, help='client block cache size in blocks')
+    ap.add_argument('-dd', '--dedup', action='store_true', help='deduplicate file data blocks')
+    ap.add_argument('-il', '--intent_log', type=str, help='local file logging stripes with writes in flight')
+    ap.add_argument('-dr', '--dirty_region_stripes', type=int, help='stripes per region of the dirty-region bitmap (0 disables)')
+    ap.add_argument('-pf', '--parity_flush_interval', type=float, help='defer parity updates, folding them every this many seconds')
+    ap.add_argument('-rl', '--raid_layout', type=str, choices=sorted(LAYOUTS), help='placement of blocks and parity on the servers')
+    ap.add_argument('-su', '--stripe_unit', type=int, help='consecutive blocks stored on one server (stripe unit)')
+    ap.add_argument('-lp', '--log_profile', type=str, choices=sorted(fslog.PROFILES), help='logging profile (production: warnings and errors only)')
+    ap.add_argument('-ll', '--log_levels', type=fslog.ParseLogLevels, help='log levels of given modules, e.g. block=INFO,filename=WARNING')
+    ap.add_argument('-lt', '--lease_time', type=float, help='seconds a lease on the file system lock lasts (default 0: single client, no lock)')
+    ap.add_argument('-rt', '--rpc_trace', type=int, help='log one in every this many RPCs to the block servers (0 disables)')
 
     # Other than FS args, consecutive args will be captured in by 'arg' as list
     ap.add_argument('arg', nargs='*')
@@ -43,6 +47,9 @@ if __name__ == "__main__":
     # Initialize file system configuration
     fsconfig.ConfigureFSConstants(args)
 
+    # Initialize logging: to memoryfs.log, and INFO and above to the console as well
+    fslog.ConfigureLogging()
+
     # Show file system information
     # fsconfig.PrintFSConstants()
 
@@ -50,9 +57,11 @@ if __name__ == "__main__":
     RawBlocks = DiskBlocks()
     # RawBlocks.PrintBlocks("Initialized", 0, 16)
 
-    # Create a FileName object and initialize the root's inode
+    # Create a FileName object and initialize the root's inode (unless another client did)
     FileObject = FileName(RawBlocks)
+    RawBlocks.Acquire()
     FileObject.InitRootInode()
+    RawBlocks.Release()
 
     # Create a FileOperations object
     FileOperationsObject = FileOperations(FileObject)
@@ -62,5 +71,9 @@ if __name__ == "__main__":
 
     # Run the interactive shell interpreter
     myshell = FSShell(RawBlocks, FileOperationsObject, AbsolutePathObject)
-    myshell.Interpreter()
+    try:
+        myshell.Interpreter()
+    finally:
+        # Fold the parity updates still pending (deferred parity) before exiting
+        RawBlocks.FlushParity()
 
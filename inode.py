@@ -1,6 +1,8 @@
 import fsconfig
 import logging
 
+logger = logging.getLogger(__name__)
+
 #### INODE LAYER
 
 
@@ -9,7 +11,7 @@ import logging
 #  0. Initialize the object
 #  1. Read an Inode object from a byte array read from raw block storage (InodeFromBytearray)
 #     An inode is stored in a raw block as a byte array:
-#       size (bytes 0..3), type (bytes 4..5), refcnt (bytes 6..7), block_numbers (bytes 8..)
+#       size (bytes 0..3), flags (byte 4), type (byte 5), refcnt (bytes 6..7), block_numbers (bytes 8..)
 #  2. Update inode (e.g. size, refcnt, block numbers) depending on file system operation
 #     Using various Set() methods
 #  3. Serialize and write Inode object back to raw block storage (InodeToBytearray)
@@ -19,6 +21,7 @@ class Inode():
 
         # an inode is initialized empty: invalid, zero size, no block numbers
         self.type = fsconfig.INODE_TYPE_INVALID
+        self.flags = 0
         self.size = 0
         self.refcnt = 0
         # We store inode block_numbers as a list
@@ -35,19 +38,22 @@ class Inode():
     def InodeFromBytearray(self,b):
 
         if len(b) > fsconfig.INODE_SIZE:
-            logging.error ('InodeFromBytearray: exceeds inode size ' + str(b))
+            logger.error('InodeFromBytearray: exceeds inode size %s', b)
             raise ValueError('InodeFromBytearray: byte array exceeds inode size')
 
         # slice the raw bytes for the different fields
-        # size is 4 bytes, type 2 bytes, refcnt 2 bytes
+        # size is 4 bytes, flags 1 byte, type 1 byte, refcnt 2 bytes
         # these add up to INODE_BYTES_SIZE_TYPE_REFCNT=8
+        # (flags and type share the original 2-byte type field, so inodes written without flags read back unchanged)
         size_slice = b[0:4]
-        type_slice = b[4:6]
+        flags_slice = b[4:5]
+        type_slice = b[5:6]
         refcnt_slice = b[6:8]
 
         # converts from raw bytes to integers using big-endian
         # store scalars
         self.size = int.from_bytes(size_slice, byteorder='big')
+        self.flags = int.from_bytes(flags_slice, byteorder='big')
         self.type = int.from_bytes(type_slice, byteorder='big')
         self.refcnt = int.from_bytes(refcnt_slice, byteorder='big')
 
@@ -74,9 +80,11 @@ class Inode():
         intsize = self.size
         temparray[0:4] = intsize.to_bytes(4, 'big')
 
-        # We assume type is 2 bytes, and we store it in Big Endian format
+        # flags take the first byte of the 2-byte type field, and type the second
+        intflags = self.flags
+        temparray[4:5] = intflags.to_bytes(1, 'big')
         inttype = self.type
-        temparray[4:6] = inttype.to_bytes(2, 'big')
+        temparray[5:6] = inttype.to_bytes(1, 'big')
 
         # We assume refcnt is 2 bytes, and we store it in Big Endian format
         intrefcnt = self.refcnt
@@ -95,12 +103,13 @@ class Inode():
     ## Prints out this inode object's information to the log
 
     def Print(self):
-        logging.info ('Inode size   : ' + str(self.size))
-        logging.info ('Inode type   : ' + str(self.type))
-        logging.info ('Inode refcnt : ' + str(self.refcnt))
-        logging.info ('Block numbers: ')
+        logger.info('Inode size   : %s', self.size)
+        logger.info('Inode type   : %s', self.type)
+        logger.info('Inode flags  : %s', self.flags)
+        logger.info('Inode refcnt : %s', self.refcnt)
+        logger.info('Block numbers: ')
         s = ""
         for i in range(0,fsconfig.MAX_INODE_BLOCK_NUMBERS):
             s += str(self.block_numbers[i])
             s += ","
-        logging.info (s)
+        logger.info(s)
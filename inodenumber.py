@@ -3,6 +3,8 @@ import logging
 from block import DiskBlocks
 from inode import Inode
 
+logger = logging.getLogger(__name__)
+
 #### Inode number layer
 
 
@@ -14,10 +16,15 @@ class InodeNumber():
 
         # This stores the inode number
         if number >= fsconfig.MAX_NUM_INODES:
-            logging.error ('InodeNumber::Init: inode number exceeds limit: ' + str(number))
+            logger.error('InodeNumber::Init: inode number exceeds limit: %s', number)
             raise ValueError('InodeNumber::Init: inode number ' + str(number) + ' exceeds limit ' + str(fsconfig.MAX_NUM_INODES - 1))
         self.inode_number = number
 
+        # Indirect blocks read or updated while this object is in use, as lists of block numbers
+        # Dirty indirect blocks are written back by StoreInode()
+        self.indirect_blocks = {}
+        self.dirty_indirect_blocks = set()
+
 
     ## Load an inode data structure from raw storage, indexed by inode number
     ## The inode data structure loaded from raw storage goes in the self.inode object
@@ -25,7 +32,7 @@ class InodeNumber():
 
     def InodeNumberToInode(self, RawBlocks):
 
-        logging.debug('InodeNumber::InodeNumberToInode: ' + str(self.inode_number))
+        logger.debug('InodeNumber::InodeNumberToInode: %s', self.inode_number)
 
         # locate which block (in the inode table) has the inode we want
         inode_table_raw_block_number = fsconfig.INODE_BLOCK_OFFSET + ((self.inode_number * fsconfig.INODE_SIZE) // fsconfig.BLOCK_SIZE)
@@ -43,8 +50,10 @@ class InodeNumber():
         # load inode from byte array
         self.inode.InodeFromBytearray(inode_slice)
 
-        logging.debug ('InodeNumber::InodeNumberToInode: inode_number ' + str(self.inode_number) + ' raw_block_number: ' + str(inode_table_raw_block_number) + ' slice start: ' + str(start) + ' end: ' + str(end))
-        logging.debug ('inode_slice: ' + str(inode_slice.hex()))
+        logger.debug('InodeNumber::InodeNumberToInode: inode_number %s raw_block_number: %s slice start: %s end: %s',
+                     self.inode_number, inode_table_raw_block_number, start, end)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('inode_slice: %s', inode_slice.hex())
 
 
     ## Stores (Put) this inode into raw storage
@@ -52,27 +61,32 @@ class InodeNumber():
 
     def StoreInode(self, RawBlocks):
 
-        logging.debug('InodeNumber::StoreInode: ' + str(self.inode_number))
+        logger.debug('InodeNumber::StoreInode: %s', self.inode_number)
+
+        # Indirect blocks must reach raw storage before the inode that points to them
+        self.FlushIndirectBlocks(RawBlocks)
 
         # locate which block has the inode we want
         inode_table_raw_block_number = fsconfig.INODE_BLOCK_OFFSET + ((self.inode_number * fsconfig.INODE_SIZE) // fsconfig.BLOCK_SIZE)
-        logging.debug('InodeNumber::StoreInode: inode_table_raw_block_number ' + str(inode_table_raw_block_number))
+        logger.debug('InodeNumber::StoreInode: inode_table_raw_block_number %s', inode_table_raw_block_number)
 
         # Get the entire block containing inode from raw storage
         inode_table_raw_block = RawBlocks.Get(inode_table_raw_block_number)
-        logging.debug('InodeNumber::StoreInode: inode_table_raw_block:\n' + str(inode_table_raw_block.hex()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('InodeNumber::StoreInode: inode_table_raw_block:\n%s', inode_table_raw_block.hex())
 
         # Find the start:end byte slice of the block retrieved from the inode table for this particular inode_number
         start = (self.inode_number * fsconfig.INODE_SIZE) % fsconfig.BLOCK_SIZE
         end = start + fsconfig.INODE_SIZE
-        logging.debug('InodeNumber::StoreInode: start: ' + str(start) + ', end: ' + str(end))
+        logger.debug('InodeNumber::StoreInode: start: %s, end: %s', start, end)
 
         # serialize inode into byte array
         inode_bytearray = self.inode.InodeToBytearray()
 
         # Update slice of block with this inode's serialized bytearray
         inode_table_raw_block[start:end] = inode_bytearray
-        logging.debug('InodeNumber::StoreInode: tempblock:\n' + str(inode_table_raw_block.hex()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('InodeNumber::StoreInode: tempblock:\n%s', inode_table_raw_block.hex())
 
         # Update raw storage with new inode
         RawBlocks.Put(inode_table_raw_block_number, inode_table_raw_block)
@@ -83,7 +97,7 @@ class InodeNumber():
 
     def InodeNumberToBlock(self, RawBlocks, offset):
 
-        logging.debug ('InodeNumber::InodeNumberToBlock: ' + str(offset))
+        logger.debug('InodeNumber::InodeNumberToBlock: %s', offset)
 
         # Load object's inode
         self.InodeNumberToInode(RawBlocks)
@@ -93,10 +107,411 @@ class InodeNumber():
 
         # Retrieve block indexed by offset
         # as in the textbook's INDEX_TO_BLOCK_NUMBER - here self.inode is equivalent to the book's i
-        b = self.inode.block_numbers[o]
+        b = self.IndexToBlockNumber(RawBlocks, o)
 
         # Read the block from raw storage - here Get() is equivalent to BLOCK_NUMBER_TO_BLOCK
         block = RawBlocks.Get(b)
 
         # return the block
         return block
+
+
+    #### Block index mapping
+    ## An inode without INODE_FLAG_INDIRECT uses every block_numbers[] entry as a direct pointer (the original layout)
+    ## When a file outgrows them, the inode switches to the indirect layout:
+    ##   block_numbers[0 .. INODE_DIRECT_BLOCK_NUMBERS-1] are direct pointers
+    ##   block_numbers[INODE_SINGLE_INDIRECT_SLOT] points to a block of BLOCK_NUMBERS_PER_BLOCK pointers
+    ##   block_numbers[INODE_DOUBLE_INDIRECT_SLOT] points to a block of pointers to single indirect blocks
+    ## In both layouts, a block number of 0 means "not allocated"
+
+
+    ## Decodes a raw indirect block into a list of block numbers
+
+    def _DecodeIndirectBlock(self, raw_block):
+        size = fsconfig.INODE_BYTES_STORE_BLOCK_NUMBER
+        return [int.from_bytes(raw_block[i * size:(i + 1) * size], byteorder='big')
+                for i in range(0, fsconfig.BLOCK_NUMBERS_PER_BLOCK)]
+
+
+    ## Returns the (cached) list of block numbers stored in indirect block block_number
+
+    def _GetIndirectBlock(self, RawBlocks, block_number):
+        if block_number not in self.indirect_blocks:
+            self.indirect_blocks[block_number] = self._DecodeIndirectBlock(RawBlocks.Get(block_number))
+        return self.indirect_blocks[block_number]
+
+
+    ## Allocates a new, zeroed indirect block with allocate(); returns its block number or -1
+
+    def _NewIndirectBlock(self, allocate):
+        block_number = allocate()
+        if block_number == -1:
+            logger.error('InodeNumber::_NewIndirectBlock: no free block for indirect block')
+            return -1
+        self.indirect_blocks[block_number] = [0] * fsconfig.BLOCK_NUMBERS_PER_BLOCK
+        self.dirty_indirect_blocks.add(block_number)
+        return block_number
+
+
+    ## Reads, in at most two batches, the indirect blocks needed to map count block indices starting at first_index
+
+    def _PrefetchIndirectBlocks(self, RawBlocks, first_index, count):
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT) or count <= 0:
+            return
+
+        last_index = first_index + count - 1
+        single_base = fsconfig.INODE_DIRECT_BLOCK_NUMBERS
+        double_base = single_base + fsconfig.BLOCK_NUMBERS_PER_BLOCK
+
+        # first level: the single and double indirect blocks
+        wanted = []
+        if first_index < double_base and last_index >= single_base:
+            wanted.append(self.inode.block_numbers[fsconfig.INODE_SINGLE_INDIRECT_SLOT])
+        if last_index >= double_base:
+            wanted.append(self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT])
+        self._FetchIndirectBlocks(RawBlocks, wanted)
+
+        # second level: the single indirect blocks below the double indirect block
+        double = self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]
+        if last_index >= double_base and double != 0:
+            pointers = self.indirect_blocks[double]
+            first_child = max(first_index - double_base, 0) // fsconfig.BLOCK_NUMBERS_PER_BLOCK
+            last_child = (last_index - double_base) // fsconfig.BLOCK_NUMBERS_PER_BLOCK
+            self._FetchIndirectBlocks(RawBlocks, pointers[first_child:last_child + 1])
+
+
+    def _FetchIndirectBlocks(self, RawBlocks, block_numbers):
+        missing = [b for b in block_numbers if b != 0 and b not in self.indirect_blocks]
+        if not missing:
+            return
+        raw_blocks = RawBlocks.GetBlocks(missing)
+        for block_number in missing:
+            self.indirect_blocks[block_number] = self._DecodeIndirectBlock(raw_blocks[block_number])
+
+
+    ## Returns the raw block number that holds block index index of this inode (0 if not allocated)
+    ## Equivalent to the textbook's INDEX_TO_BLOCK_NUMBER
+
+    def IndexToBlockNumber(self, RawBlocks, index):
+
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT):
+            if index < fsconfig.MAX_INODE_BLOCK_NUMBERS:
+                return self.inode.block_numbers[index]
+            return 0
+
+        if index < fsconfig.INODE_DIRECT_BLOCK_NUMBERS:
+            return self.inode.block_numbers[index]
+        index -= fsconfig.INODE_DIRECT_BLOCK_NUMBERS
+
+        if index < fsconfig.BLOCK_NUMBERS_PER_BLOCK:
+            single = self.inode.block_numbers[fsconfig.INODE_SINGLE_INDIRECT_SLOT]
+            if single == 0:
+                return 0
+            return self._GetIndirectBlock(RawBlocks, single)[index]
+        index -= fsconfig.BLOCK_NUMBERS_PER_BLOCK
+
+        double = self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]
+        if double == 0:
+            return 0
+        child = self._GetIndirectBlock(RawBlocks, double)[index // fsconfig.BLOCK_NUMBERS_PER_BLOCK]
+        if child == 0:
+            return 0
+        return self._GetIndirectBlock(RawBlocks, child)[index % fsconfig.BLOCK_NUMBERS_PER_BLOCK]
+
+
+    ## Maps count block indices starting at first_index to contiguous extents
+    ## Returns a list of (first block index, first raw block number, length) tuples, where consecutive
+    ## indices map to consecutive raw blocks; unallocated runs are returned with raw block number 0
+
+    def MapExtents(self, RawBlocks, first_index, count):
+
+        self._PrefetchIndirectBlocks(RawBlocks, first_index, count)
+
+        extents = []
+        for index in range(first_index, first_index + count):
+            block_number = self.IndexToBlockNumber(RawBlocks, index)
+            if extents:
+                start_index, start_block, length = extents[-1]
+                if (block_number == 0 and start_block == 0) or \
+                        (block_number != 0 and start_block != 0 and block_number == start_block + length):
+                    extents[-1][2] += 1
+                    continue
+            extents.append([index, block_number, 1])
+
+        return [tuple(extent) for extent in extents]
+
+
+    ## Returns the raw block numbers for count block indices starting at first_index (0 where not allocated)
+
+    def IndexRangeToBlockNumbers(self, RawBlocks, first_index, count):
+        block_numbers = []
+        for index, block_number, length in self.MapExtents(RawBlocks, first_index, count):
+            for i in range(0, length):
+                block_numbers.append(block_number + i if block_number != 0 else 0)
+        return block_numbers
+
+
+    ## Points block index index of this inode at raw block block_number
+    ## allocate() is called to obtain blocks for any indirect block that must be created
+    ## The inode (and dirty indirect blocks) reach raw storage on the next StoreInode()
+    ## Returns 0 on success, -1 if an indirect block could not be allocated
+
+    def SetIndexBlockNumber(self, RawBlocks, index, block_number, allocate):
+
+        logger.debug('InodeNumber::SetIndexBlockNumber: %s -> %s', index, block_number)
+
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT):
+            if index < fsconfig.MAX_INODE_BLOCK_NUMBERS:
+                self.inode.block_numbers[index] = block_number
+                return 0
+            if block_number == 0:
+                return 0
+            if self._ConvertToIndirect(RawBlocks, allocate) == -1:
+                return -1
+
+        if index < fsconfig.INODE_DIRECT_BLOCK_NUMBERS:
+            self.inode.block_numbers[index] = block_number
+            return 0
+        index -= fsconfig.INODE_DIRECT_BLOCK_NUMBERS
+
+        if index < fsconfig.BLOCK_NUMBERS_PER_BLOCK:
+            single = self._GetOrCreateSlot(fsconfig.INODE_SINGLE_INDIRECT_SLOT, block_number, allocate)
+            if single <= 0:
+                return single
+            self._SetPointer(RawBlocks, single, index, block_number)
+            return 0
+        index -= fsconfig.BLOCK_NUMBERS_PER_BLOCK
+
+        double = self._GetOrCreateSlot(fsconfig.INODE_DOUBLE_INDIRECT_SLOT, block_number, allocate)
+        if double <= 0:
+            return double
+        pointers = self._GetIndirectBlock(RawBlocks, double)
+        child = pointers[index // fsconfig.BLOCK_NUMBERS_PER_BLOCK]
+        if child == 0:
+            if block_number == 0:
+                return 0
+            child = self._NewIndirectBlock(allocate)
+            if child == -1:
+                return -1
+            self._SetPointer(RawBlocks, double, index // fsconfig.BLOCK_NUMBERS_PER_BLOCK, child)
+        self._SetPointer(RawBlocks, child, index % fsconfig.BLOCK_NUMBERS_PER_BLOCK, block_number)
+        return 0
+
+
+    ## Returns the indirect block referenced by inode slot, creating it unless block_number is 0 (clearing a pointer)
+    ## Returns the block number, 0 if there is nothing to clear, or -1 on allocation failure
+
+    def _GetOrCreateSlot(self, slot, block_number, allocate):
+        if self.inode.block_numbers[slot] == 0:
+            if block_number == 0:
+                return 0
+            new_block = self._NewIndirectBlock(allocate)
+            if new_block == -1:
+                return -1
+            self.inode.block_numbers[slot] = new_block
+        return self.inode.block_numbers[slot]
+
+
+    def _SetPointer(self, RawBlocks, indirect_block, position, block_number):
+        self._GetIndirectBlock(RawBlocks, indirect_block)[position] = block_number
+        self.dirty_indirect_blocks.add(indirect_block)
+
+
+    ## Switches a direct-layout inode to the indirect layout, moving its existing pointers
+
+    def _ConvertToIndirect(self, RawBlocks, allocate):
+
+        logger.debug('InodeNumber::_ConvertToIndirect: %s', self.inode_number)
+
+        if fsconfig.INODE_SINGLE_INDIRECT_SLOT < 0:
+            logger.error('InodeNumber::_ConvertToIndirect: inode too small for indirect blocks')
+            return -1
+
+        old_block_numbers = list(self.inode.block_numbers)
+        self.inode.block_numbers = [0] * fsconfig.MAX_INODE_BLOCK_NUMBERS
+        self.inode.flags |= fsconfig.INODE_FLAG_INDIRECT
+        for index, block_number in enumerate(old_block_numbers):
+            if block_number != 0 and self.SetIndexBlockNumber(RawBlocks, index, block_number, allocate) == -1:
+                self.inode.block_numbers = old_block_numbers
+                self.inode.flags &= ~fsconfig.INODE_FLAG_INDIRECT
+                return -1
+        return 0
+
+
+    ## Detaches every block at index first_index and beyond from this inode
+    ## Returns the raw block numbers no longer referenced (data blocks and emptied indirect blocks);
+    ## the caller releases them in the free bitmap
+
+    def ReleaseBlocks(self, RawBlocks, first_index):
+
+        logger.debug('InodeNumber::ReleaseBlocks: %s from %s', self.inode_number, first_index)
+
+        released = []
+
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT):
+            for i in range(first_index, fsconfig.MAX_INODE_BLOCK_NUMBERS):
+                if self.inode.block_numbers[i] != 0:
+                    released.append(self.inode.block_numbers[i])
+                    self.inode.block_numbers[i] = 0
+            return released
+
+        for i in range(first_index, fsconfig.INODE_DIRECT_BLOCK_NUMBERS):
+            if self.inode.block_numbers[i] != 0:
+                released.append(self.inode.block_numbers[i])
+                self.inode.block_numbers[i] = 0
+
+        self._PrefetchIndirectBlocks(RawBlocks, first_index, fsconfig.MAX_FILE_BLOCKS - first_index)
+
+        # single indirect block
+        single_base = fsconfig.INODE_DIRECT_BLOCK_NUMBERS
+        slot = fsconfig.INODE_SINGLE_INDIRECT_SLOT
+        start = max(first_index - single_base, 0)
+        if self.inode.block_numbers[slot] != 0 and start < fsconfig.BLOCK_NUMBERS_PER_BLOCK:
+            released += self._ReleaseFromIndirect(RawBlocks, self.inode.block_numbers[slot], start)
+            if start == 0:
+                released.append(self.inode.block_numbers[slot])
+                self._DropIndirectBlock(self.inode.block_numbers[slot])
+                self.inode.block_numbers[slot] = 0
+
+        # double indirect block
+        double_base = single_base + fsconfig.BLOCK_NUMBERS_PER_BLOCK
+        slot = fsconfig.INODE_DOUBLE_INDIRECT_SLOT
+        start = max(first_index - double_base, 0)
+        double = self.inode.block_numbers[slot]
+        if double != 0:
+            pointers = self._GetIndirectBlock(RawBlocks, double)
+            for k in range(start // fsconfig.BLOCK_NUMBERS_PER_BLOCK, fsconfig.BLOCK_NUMBERS_PER_BLOCK):
+                child = pointers[k]
+                if child == 0:
+                    continue
+                child_start = max(start - k * fsconfig.BLOCK_NUMBERS_PER_BLOCK, 0)
+                released += self._ReleaseFromIndirect(RawBlocks, child, child_start)
+                if child_start == 0:
+                    released.append(child)
+                    self._DropIndirectBlock(child)
+                    self._SetPointer(RawBlocks, double, k, 0)
+            if start == 0:
+                released.append(double)
+                self._DropIndirectBlock(double)
+                self.inode.block_numbers[slot] = 0
+
+        # an inode with nothing left goes back to the direct layout
+        if first_index == 0:
+            self.inode.flags &= ~fsconfig.INODE_FLAG_INDIRECT
+
+        return released
+
+
+    ## Returns every raw block this inode references: data blocks and indirect blocks
+    ## (a block referenced twice, e.g. a deduplicated one, is listed twice)
+
+    def ReferencedBlocks(self, RawBlocks):
+
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT):
+            return [b for b in self.inode.block_numbers if b != 0]
+
+        blocks = [b for b in self.inode.block_numbers[0:fsconfig.INODE_DIRECT_BLOCK_NUMBERS] if b != 0]
+        self._PrefetchIndirectBlocks(RawBlocks, 0, fsconfig.MAX_FILE_BLOCKS)
+
+        single = self.inode.block_numbers[fsconfig.INODE_SINGLE_INDIRECT_SLOT]
+        if single != 0:
+            blocks.append(single)
+            blocks += [b for b in self._GetIndirectBlock(RawBlocks, single) if b != 0]
+
+        double = self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]
+        if double != 0:
+            blocks.append(double)
+            for child in self._GetIndirectBlock(RawBlocks, double):
+                if child != 0:
+                    blocks.append(child)
+                    blocks += [b for b in self._GetIndirectBlock(RawBlocks, child) if b != 0]
+
+        return blocks
+
+
+    ## Gives this inode private copies of its indirect blocks that are shared with other inodes or snapshots
+    ## (reference count above 1), so that its block mapping can be changed without affecting them
+    ## get_refcounts(block_numbers) returns a dict of reference counts, allocate() a new block, and
+    ## release(block_numbers) drops a reference to each block listed
+    ## The copies reach raw storage on the next StoreInode(); returns 0, or -1 if a block could not be allocated
+
+    def UnshareIndirectBlocks(self, RawBlocks, get_refcounts, allocate, release):
+
+        if not (self.inode.flags & fsconfig.INODE_FLAG_INDIRECT):
+            return 0
+
+        candidates = [b for b in (self.inode.block_numbers[fsconfig.INODE_SINGLE_INDIRECT_SLOT],
+                                  self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]) if b != 0]
+        double = self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]
+        if double != 0:
+            candidates += [b for b in self._GetIndirectBlock(RawBlocks, double) if b != 0]
+        if not candidates:
+            return 0
+
+        refcounts = get_refcounts(candidates)
+        shared = [b for b in candidates if refcounts[b] > 1]
+        if not shared:
+            return 0
+
+        logger.debug('InodeNumber::UnshareIndirectBlocks: %s copies %s', self.inode_number, shared)
+
+        # copy each shared indirect block into a new one
+        copies = {}
+        for block_number in shared:
+            new_block = allocate()
+            if new_block == -1:
+                logger.error('InodeNumber::UnshareIndirectBlocks: no free block for indirect block')
+                for copy in copies.values():
+                    self._DropIndirectBlock(copy)
+                release(list(copies.values()))
+                return -1
+            self.indirect_blocks[new_block] = list(self._GetIndirectBlock(RawBlocks, block_number))
+            self.dirty_indirect_blocks.add(new_block)
+            copies[block_number] = new_block
+
+        # point the inode, and the double indirect block, at the copies
+        for slot in (fsconfig.INODE_SINGLE_INDIRECT_SLOT, fsconfig.INODE_DOUBLE_INDIRECT_SLOT):
+            if self.inode.block_numbers[slot] in copies:
+                self.inode.block_numbers[slot] = copies[self.inode.block_numbers[slot]]
+        double = self.inode.block_numbers[fsconfig.INODE_DOUBLE_INDIRECT_SLOT]
+        if double != 0:
+            pointers = self.indirect_blocks[double]
+            for k in range(0, fsconfig.BLOCK_NUMBERS_PER_BLOCK):
+                if pointers[k] in copies:
+                    self._SetPointer(RawBlocks, double, k, copies[pointers[k]])
+
+        for block_number in shared:
+            self._DropIndirectBlock(block_number)
+        release(shared)
+        return 0
+
+
+    def _ReleaseFromIndirect(self, RawBlocks, indirect_block, start):
+        released = []
+        pointers = self._GetIndirectBlock(RawBlocks, indirect_block)
+        for i in range(start, fsconfig.BLOCK_NUMBERS_PER_BLOCK):
+            if pointers[i] != 0:
+                released.append(pointers[i])
+                pointers[i] = 0
+                self.dirty_indirect_blocks.add(indirect_block)
+        return released
+
+
+    def _DropIndirectBlock(self, block_number):
+        self.indirect_blocks.pop(block_number, None)
+        self.dirty_indirect_blocks.discard(block_number)
+
+
+    ## Writes back indirect blocks modified through SetIndexBlockNumber() or ReleaseBlocks(), in one batch
+
+    def FlushIndirectBlocks(self, RawBlocks):
+        if not self.dirty_indirect_blocks:
+            return
+        blocks = {}
+        for block_number in sorted(self.dirty_indirect_blocks):
+            raw_block = bytearray()
+            for pointer in self.indirect_blocks[block_number]:
+                raw_block += pointer.to_bytes(fsconfig.INODE_BYTES_STORE_BLOCK_NUMBER, 'big')
+            blocks[block_number] = raw_block
+        RawBlocks.PutBlocks(blocks)
+        self.dirty_indirect_blocks.clear()
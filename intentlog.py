@@ -0,0 +1,214 @@
+import fsconfig
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+#### WRITE INTENT LOGGING
+
+
+## This class implements the bookkeeping shared by the write intent records that close the RAID-5 write hole
+## A stripe's data and parity blocks live on different servers and are not updated atomically: a client
+## crashing between the two writes leaves the parity stale. Before a stripe is written, it is recorded
+## as dirty on stable storage; at startup, the stripes recorded as dirty are resynchronized (parity
+## recomputed from the data) instead of verifying the whole array.
+## Records are kept cheap: a batch of stripes is recorded with a single write, and a stripe already
+## recorded as dirty costs nothing. Stripes whose writes completed are cleaned lazily, by the next record
+## that has to be written anyway, and only as far as needed to keep at most max_dirty entries dirty,
+## least recently written first: hot stripes (free bitmap, inode table) stay dirty and are not recorded
+## again on every write.
+## Subclasses choose what an entry is (_Entries, _Stripes) and where records are stored (_Record, _Rewrite)
+
+class WriteIntents():
+    def __init__(self, max_dirty):
+        self.max_dirty = max_dirty
+        # entries recorded as dirty, least recently written first
+        self.dirty = OrderedDict()
+        # entries with writes in flight: entry -> number of writers
+        self.active = {}
+
+
+    ## Returns the entries covering stripes (by default, the stripes themselves)
+
+    def _Entries(self, stripes):
+        return set(stripes)
+
+
+    ## Returns the sorted list of stripes covered by entries
+
+    def _Stripes(self, entries):
+        return sorted(entries)
+
+
+    ## Starts afresh, with stripes still_dirty recorded as dirty (e.g. those that could not be resynchronized)
+
+    def Reset(self, still_dirty=()):
+        self.dirty = OrderedDict.fromkeys(sorted(self._Entries(still_dirty)))
+        self._Rewrite()
+
+
+    ## Records that stripes are about to be written; returns 0 once the record is on stable storage
+    ## Must then be paired with a call to End() with the same stripes
+    ## Returns -1 if the record could not be written: the stripes must not be written
+
+    def Begin(self, stripes):
+        entries = self._Entries(stripes)
+        for entry in entries:
+            self.active[entry] = self.active.get(entry, 0) + 1
+            if entry in self.dirty:
+                self.dirty.move_to_end(entry)
+        new = [e for e in sorted(entries) if e not in self.dirty]
+        if not new:
+            return 0
+
+        # completed entries are cleaned in the same record
+        excess = len(self.dirty) + len(new) - self.max_dirty
+        clean = []
+        for entry in self.dirty:
+            if excess <= 0:
+                break
+            if entry not in self.active:
+                clean.append(entry)
+                excess -= 1
+        logger.debug('WriteIntents::Begin: dirty %s, clean %s', new, clean)
+        for entry in clean:
+            del self.dirty[entry]
+        for entry in new:
+            self.dirty[entry] = None
+        if self._Record(new, sorted(clean)) == -1:
+            # the new entries are not recorded: a later Begin must record them again
+            logger.error('WriteIntents::Begin: could not record dirty entries %s', new)
+            for entry in new:
+                del self.dirty[entry]
+            self.End(stripes)
+            return -1
+        return 0
+
+
+    ## Records that the writes to stripes are done (cleaned by a later record)
+
+    def End(self, stripes):
+        for entry in self._Entries(stripes):
+            self.active[entry] -= 1
+            if self.active[entry] == 0:
+                del self.active[entry]
+
+
+## This class records write intents in a local log file, one entry per stripe
+## The log is a text file with one record per line; each record lists stripe numbers prefixed with
+## + (dirty) or - (clean), and is flushed to stable storage before the writes start. A record torn by a
+## crash (no trailing newline) is ignored: its stripes had not been written yet
+
+class IntentLog(WriteIntents):
+    def __init__(self, filename):
+        WriteIntents.__init__(self, fsconfig.INTENT_LOG_MAX_DIRTY)
+        self.filename = filename
+        self.file = None
+
+
+    ## Reads the log left by the previous run
+    ## Returns the sorted list of stripes that were dirty (their parity may be stale)
+
+    def Replay(self):
+        dirty = set()
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as file:
+                for line in file:
+                    if not line.endswith('\n'):
+                        logger.warning('IntentLog::Replay: ignoring torn record %r', line)
+                        break
+                    for entry in line.split():
+                        if entry[0] == '+':
+                            dirty.add(int(entry[1:]))
+                        elif entry[0] == '-':
+                            dirty.discard(int(entry[1:]))
+        logger.info('IntentLog::Replay: %s dirty stripes in %s', len(dirty), self.filename)
+        return sorted(dirty)
+
+
+    ## Writes the live entries to a new log file, which atomically replaces the current one
+
+    def _Rewrite(self):
+        if self.file is not None:
+            self.file.close()
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as file:
+            if self.dirty:
+                file.write(' '.join('+' + str(s) for s in sorted(self.dirty)) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.filename)
+        self.file = open(self.filename, 'a')
+        return 0
+
+
+    ## Appends a record (compacting the log once it grows past INTENT_LOG_MAX_BYTES)
+
+    def _Record(self, new, clean):
+        if self.file.tell() > fsconfig.INTENT_LOG_MAX_BYTES:
+            self._Rewrite()
+            return
+        self.file.write(' '.join(['+' + str(s) for s in new] + ['-' + str(s) for s in clean]) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return 0
+
+
+## This class records write intents in a dirty-region bitmap kept in a reserved block of the array
+## (DIRTY_REGION_BLOCK_NUMBER, the otherwise unused boot block), so the record survives the loss of the
+## client machine. An entry is a region of DIRTY_REGION_STRIPES consecutive stripes (more if needed for
+## the bitmap to fit in one block): a coarse region stays dirty while its stripes are being written, so
+## marking it rarely costs a write of the bitmap, and resynchronization after a crash covers at most
+## DIRTY_REGION_MAX_IDLE regions, besides the regions with writes in flight
+
+class DirtyRegionBitmap(WriteIntents):
+    def __init__(self, RawBlocks):
+        WriteIntents.__init__(self, fsconfig.DIRTY_REGION_MAX_IDLE)
+        self.RawBlocks = RawBlocks
+        self.total_stripes = RawBlocks.layout.total_stripes
+        bits = fsconfig.BLOCK_SIZE * 8
+        self.region_stripes = max(fsconfig.DIRTY_REGION_STRIPES, (self.total_stripes + bits - 1) // bits)
+        self.num_regions = (self.total_stripes + self.region_stripes - 1) // self.region_stripes
+
+
+    def _Entries(self, stripes):
+        return set(s // self.region_stripes for s in stripes)
+
+
+    def _Stripes(self, entries):
+        stripes = []
+        for region in sorted(entries):
+            stripes += range(region * self.region_stripes, min((region + 1) * self.region_stripes, self.total_stripes))
+        return stripes
+
+
+    ## Reads the bitmap left by the previous run
+    ## Returns the sorted list of stripes in dirty regions (their parity may be stale)
+
+    def Replay(self):
+        block = self.RawBlocks.Get(fsconfig.DIRTY_REGION_BLOCK_NUMBER)
+        if block is None:
+            logger.error('DirtyRegionBitmap::Replay: bitmap unreadable, every stripe is dirty')
+            return list(range(0, self.total_stripes))
+        dirty = set(r for r in range(0, self.num_regions) if block[r // 8] & (1 << (r % 8)))
+        logger.info('DirtyRegionBitmap::Replay: %s dirty regions of %s stripes', len(dirty), self.region_stripes)
+        # the bitmap's own stripe is stale if the client crashed while writing the bitmap
+        own_stripe = self.RawBlocks.getServerBlockAndParity(fsconfig.DIRTY_REGION_BLOCK_NUMBER)[1]
+        return sorted(set(self._Stripes(dirty)) | {own_stripe})
+
+
+    ## Writes the bitmap (its own stripe is not recorded: Replay() always resynchronizes it), with both
+    ## parity blocks updated in a RAID-6 layout; returns -1 if it could not be written
+
+    def _Rewrite(self):
+        block = bytearray(fsconfig.BLOCK_SIZE)
+        for region in self.dirty:
+            block[region // 8] |= 1 << (region % 8)
+        if self.RawBlocks.layout.q_parity:
+            return self.RawBlocks.RAID6PutBlocks({fsconfig.DIRTY_REGION_BLOCK_NUMBER: block})
+        return self.RawBlocks.RAID5Put(fsconfig.DIRTY_REGION_BLOCK_NUMBER, block)
+
+
+    def _Record(self, new, clean):
+        return self._Rewrite()
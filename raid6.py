@@ -0,0 +1,129 @@
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+#### RAID-6 ARITHMETIC
+
+
+## P and Q parity of RAID-6 stripes, and recovery of up to two missing blocks of a stripe
+## The arithmetic is over GF(2^8), with the polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11d) and the generator
+## g = 2, as in the Linux md driver. For the data blocks D_0 ... D_k-1 of a stripe (+ is XOR):
+##   P = D_0 + D_1 + ... + D_k-1
+##   Q = g^0 D_0 + g^1 D_1 + ... + g^k-1 D_k-1
+## With NumPy, a stripe is a 2-D array: P is one XOR reduction, and Q is computed by Horner's rule,
+## Q = ((D_k-1 g + D_k-2) g + ...) g + D_0, multiplying a whole block by g with shifts and XORs. Without it,
+## multiplying a block by a constant is bytes.translate() with a 256-byte table, and XOR works on whole
+## blocks as integers. Either way, no Python code runs per byte
+
+GF_POLYNOMIAL = 0x11d
+
+
+## Returns the exponential (doubled, so that EXP[LOG[a] + LOG[b]] needs no modulo) and logarithm tables of g
+
+def _ExpLogTables():
+    exp = bytearray(512)
+    log = [0] * 256
+    value = 1
+    for i in range(0, 255):
+        exp[i] = value
+        log[value] = i
+        value <<= 1
+        if value & 0x100:
+            value ^= GF_POLYNOMIAL
+    for i in range(255, 512):
+        exp[i] = exp[i - 255]
+    return exp, log
+
+
+EXP, LOG = _ExpLogTables()
+
+
+def Multiply(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def Inverse(a):
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c][x] = c * x: the bytes.translate() table multiplying a block by c
+MUL_TABLES = [bytes(Multiply(c, x) for x in range(0, 256)) for c in range(0, 256)]
+
+
+## Returns block multiplied by the constant c
+
+def Scale(c, block):
+    return bytearray(bytes(block).translate(MUL_TABLES[c]))
+
+
+def _Xor(a, b):
+    return bytearray((int.from_bytes(a, byteorder='big') ^ int.from_bytes(b, byteorder='big')).to_bytes(len(a), byteorder='big'))
+
+
+## Returns the P and Q parity blocks of a stripe, given its data blocks (equally sized), in order
+
+def SyndromesPython(data):
+    p = 0
+    q = 0
+    for i, block in enumerate(data):
+        p ^= int.from_bytes(block, byteorder='big')
+        q ^= int.from_bytes(bytes(block).translate(MUL_TABLES[EXP[i]]), byteorder='big')
+    size = len(data[0])
+    return bytearray(p.to_bytes(size, byteorder='big')), bytearray(q.to_bytes(size, byteorder='big'))
+
+
+def SyndromesNumPy(data):
+    blocks = numpy.frombuffer(b''.join(bytes(block) for block in data), dtype=numpy.uint8).reshape(len(data), -1)
+    p = numpy.bitwise_xor.reduce(blocks, axis=0)
+    q = blocks[-1].copy()
+    for block in blocks[-2::-1]:
+        # q * g: shift left, reducing the bytes that overflow by the polynomial
+        q = (q << 1) ^ ((q >> 7) * numpy.uint8(GF_POLYNOMIAL & 0xff)) ^ block
+    return bytearray(p.tobytes()), bytearray(q.tobytes())
+
+
+Syndromes = SyndromesNumPy if numpy is not None else SyndromesPython
+
+
+## Recovers the missing blocks of a stripe: data is the list of its data blocks, p and q its parity blocks,
+## with None for each missing one
+## Returns (data, p, q) with the missing blocks filled in, or None if more than two blocks are missing
+
+def Recover(data, p, q):
+    missing = [i for i, block in enumerate(data) if block is None]
+    if len(missing) + (p is None) + (q is None) > 2:
+        logger.error('raid6::Recover: %s blocks missing', len(missing) + (p is None) + (q is None))
+        return None
+
+    data = list(data)
+    if missing:
+        size = len([block for block in data + [p, q] if block is not None][0])
+        # parity of the surviving data blocks: P and Q less the missing blocks' terms
+        partial_p, partial_q = Syndromes([block if block is not None else bytearray(size) for block in data])
+        if len(missing) == 2:
+            # D_x + D_y = Pxy and g^x D_x + g^y D_y = Qxy, so D_x = (g^(y-x) Pxy + g^-x Qxy) / (g^(y-x) + 1)
+            x, y = missing
+            pxy = _Xor(p, partial_p)
+            qxy = _Xor(q, partial_q)
+            denominator = Inverse(EXP[y - x] ^ 1)
+            data[x] = _Xor(Scale(Multiply(EXP[y - x], denominator), pxy), Scale(Multiply(EXP[255 - x], denominator), qxy))
+            data[y] = _Xor(pxy, data[x])
+        elif p is not None:
+            data[missing[0]] = _Xor(p, partial_p)
+        else:
+            # Q less the surviving terms is g^x D_x
+            x = missing[0]
+            data[x] = Scale(EXP[255 - x], _Xor(q, partial_q))
+
+    if p is None or q is None:
+        new_p, new_q = Syndromes(data)
+        p = new_p if p is None else p
+        q = new_q if q is None else q
+    return data, p, q
@@ -0,0 +1,237 @@
+import fsconfig
+import logging
+from itertools import repeat
+from operator import add, floordiv, mod, mul
+
+logger = logging.getLogger(__name__)
+
+#### RAID LAYOUTS
+
+
+## This class is the base of the RAID layouts: the strategies placing logical blocks on the block servers
+## Logical blocks are grouped in stripes. The blocks of a stripe are stored on distinct servers, at the
+## same offset (block number) on each of them, and in the redundant layouts the stripe has a parity block
+## on yet another server: the XOR of its data blocks (with a single data block, a mirror copy).
+## Logical blocks go to the servers in stripe units of stripe_unit consecutive blocks (fsconfig.STRIPE_UNIT),
+## at consecutive offsets: stripe_unit consecutive stripes share a placement, and a stripe's data blocks
+## are stripe_unit logical blocks apart. Its stripe_width = stripe_unit * data_per_stripe consecutive
+## logical blocks fill whole stripes. With a stripe unit of one block, a stripe is data_per_stripe
+## consecutive logical blocks; larger units turn a run of logical blocks into fewer, larger transfers
+## per server, at the cost of spreading it over fewer servers.
+## The placement is computed once, into tables the block layer looks up on every access:
+##   stripe_data_servers[s]: the servers of stripe s's data blocks, in logical block order
+##   stripe_parity_server[s]: the server of stripe s's parity block (None in a layout without parity)
+##   stripe_q_server[s]: the server of stripe s's second parity block, Q (RAID-6 only, None otherwise)
+##   stripe_offset[s]: the block number of stripe s's blocks on their servers
+##   block_map[b]: (data server, stripe, parity server) of logical block b
+##   block_server[b], block_stripe[b], block_offset[b]: the same by column, for the mapping of block ranges
+## A layout repeats itself every rotation: after _Rotation() placements, the placement starts over with the
+## offsets moved up by the number of offsets the rotation used. Only the first rotation is placed
+## (_Stripe); the tables are these placements repeated, so that a lookup is one index, with no
+## arithmetic and nothing allocated
+## Subclasses choose the number of data blocks per stripe (_DataPerStripe), the placements per rotation
+## (_Rotation) and where each placement of the first rotation goes (_Stripe): placement n is the n-th group
+## of stripe_unit stripes, at stripe_unit consecutive offsets from the offset _Stripe returns
+
+class RAIDLayout():
+    name = None
+    # whether stripes have a parity block, and a second one (Q)
+    parity = True
+    q_parity = False
+
+    def __init__(self):
+        self.num_servers = fsconfig.NO_OF_SERVERS
+        self.data_per_stripe = self._DataPerStripe()
+        if self.data_per_stripe < 1:
+            logger.error('RAIDLayout: %s needs more than %s servers', self.name, self.num_servers)
+            raise RuntimeError('RAIDLayout: ' + self.name + ' needs more than ' + str(self.num_servers) + ' servers')
+        self.stripe_unit = fsconfig.STRIPE_UNIT
+        self.stripe_width = self.stripe_unit * self.data_per_stripe
+        # (the stripes of the last, partial group only go as far as its first stripe unit)
+        self.total_stripes = (fsconfig.TOTAL_NUM_BLOCKS // self.stripe_width) * self.stripe_unit + \
+            min(self.stripe_unit, fsconfig.TOTAL_NUM_BLOCKS % self.stripe_width)
+        groups = (fsconfig.TOTAL_NUM_BLOCKS + self.stripe_width - 1) // self.stripe_width
+        units = range(0, self.stripe_unit)
+
+        # placement of the first rotation, and the offsets it spans
+        rotation = min(self._Rotation(), groups)
+        placements = [self._Stripe(stripe_number) for stripe_number in range(0, rotation)]
+        q_servers = [self._QServer(stripe_number) for stripe_number in range(0, rotation)]
+        rotation_offsets = (max(offset for _, _, offset in placements) + 1) * self.stripe_unit
+
+        repeats = (groups + rotation - 1) // rotation
+        self.stripe_data_servers = ([tuple(data_servers) for data_servers, _, _ in placements for _ in units] * repeats)[:self.total_stripes]
+        self.stripe_parity_server = ([parity_server for _, parity_server, _ in placements for _ in units] * repeats)[:self.total_stripes]
+        self.stripe_q_server = ([q_server for q_server in q_servers for _ in units] * repeats)[:self.total_stripes]
+        self.stripe_offset = list(map(add, [offset * self.stripe_unit + unit for _, _, offset in placements for unit in units] * repeats,
+                                      [r * rotation_offsets for r in range(0, repeats) for _ in range(0, rotation * self.stripe_unit)]))[:self.total_stripes]
+
+        # (built with map() over the stripe tables rather than per block in Python code)
+        # block b is block b % stripe_unit of its stripe unit; the stripe units of a group go to its data servers in turn
+        self.block_server = ([server for data_servers, _, _ in placements for server in data_servers for _ in units] * repeats)[:fsconfig.TOTAL_NUM_BLOCKS]
+        blocks = range(0, fsconfig.TOTAL_NUM_BLOCKS)
+        self.block_stripe = list(map(add, map(mul, map(floordiv, blocks, repeat(self.stripe_width)), repeat(self.stripe_unit)),
+                                     map(mod, blocks, repeat(self.stripe_unit))))
+        self.block_offset = list(map(self.stripe_offset.__getitem__, self.block_stripe))
+        self.block_map = list(zip(self.block_server, self.block_stripe, map(self.stripe_parity_server.__getitem__, self.block_stripe)))
+
+        # blocks each server must hold
+        self.server_num_blocks = max(self.stripe_offset, default=-1) + 1
+        logger.info('RAIDLayout: %s, %s data blocks per stripe, stripe unit of %s blocks, %s blocks per server',
+                    self.name, self.data_per_stripe, self.stripe_unit, self.server_num_blocks)
+
+    def _DataPerStripe(self):
+        return self.num_servers - 1
+
+    def _Rotation(self):
+        return self.num_servers
+
+    ## Returns the data servers, parity server (or None) and server offset of placement stripe_number (the
+    ## stripe itself with a one-block stripe unit); offsets count placements, of stripe_unit blocks each
+
+    def _Stripe(self, stripe_number):
+        raise NotImplementedError
+
+    def _QServer(self, stripe_number):
+        return None
+
+    ## Returns the logical block numbers of stripe stripe_number's data blocks, in order (a range)
+
+    def StripeBlocks(self, stripe_number):
+        group, unit = divmod(stripe_number, self.stripe_unit)
+        return range(group * self.stripe_width + unit,
+                     min((group + 1) * self.stripe_width, fsconfig.TOTAL_NUM_BLOCKS), self.stripe_unit)
+
+    ## Returns the data servers, stripe numbers and server offsets of count logical blocks from first_block,
+    ## as three lists (slices of the block tables)
+
+    def MapRange(self, first_block, count):
+        last_block = min(first_block + count, fsconfig.TOTAL_NUM_BLOCKS)
+        return (self.block_server[first_block:last_block], self.block_stripe[first_block:last_block],
+                self.block_offset[first_block:last_block])
+
+
+## RAID-0: blocks striped over every server, no parity (no tolerance to a failed server)
+
+class RAID0Layout(RAIDLayout):
+    name = 'raid0'
+    parity = False
+
+    def _DataPerStripe(self):
+        return self.num_servers
+
+    def _Rotation(self):
+        return 1
+
+    def _Stripe(self, stripe_number):
+        return range(0, self.num_servers), None, stripe_number
+
+
+## RAID-1: servers paired up, each block stored on both servers of a pair (a stripe is one block and its
+## mirror copy). Consecutive blocks go to consecutive pairs; within a pair, the server holding the primary
+## copy (the one read) alternates from one offset to the next. With an odd number of servers, the last one
+## is unused
+
+class RAID1Layout(RAIDLayout):
+    name = 'raid1'
+
+    def _DataPerStripe(self):
+        return 1 if self.num_servers >= 2 else 0
+
+    def _Rotation(self):
+        return 2 * (self.num_servers // 2)
+
+    def _Stripe(self, stripe_number):
+        pairs = self.num_servers // 2
+        pair = stripe_number % pairs
+        offset = stripe_number // pairs
+        primary = 2 * pair + offset % 2
+        mirror = 2 * pair + 1 - offset % 2
+        return [primary], mirror, offset
+
+
+## RAID-4: parity always on the last server
+
+class RAID4Layout(RAIDLayout):
+    name = 'raid4'
+
+    def _Rotation(self):
+        return 1
+
+    def _Stripe(self, stripe_number):
+        return range(0, self.num_servers - 1), self.num_servers - 1, stripe_number
+
+
+## RAID-5: parity rotating over the servers, one stripe after the other
+## Parity moves right (server 0, 1, ...) or left (server N-1, N-2, ...) from a stripe to the next. In the
+## asymmetric layouts, data blocks fill the other servers in server order; in the symmetric ones, they start
+## on the server after the parity server and wrap around, so that any N consecutive blocks are on N
+## distinct servers. The default RAID-5 layout is right-asymmetric
+
+class RAID5Layout(RAIDLayout):
+    name = 'raid5'
+    # parity rotation
+    left = False
+    symmetric = False
+
+    def _Stripe(self, stripe_number):
+        parity_server = stripe_number % self.num_servers
+        if self.left:
+            parity_server = self.num_servers - 1 - parity_server
+        if self.symmetric:
+            data_servers = [(parity_server + 1 + i) % self.num_servers for i in range(0, self.num_servers - 1)]
+        else:
+            data_servers = [i for i in range(0, self.num_servers) if i != parity_server]
+        return data_servers, parity_server, stripe_number
+
+
+class RAID5LeftAsymmetricLayout(RAID5Layout):
+    name = 'raid5-left-asymmetric'
+    left = True
+
+
+class RAID5LeftSymmetricLayout(RAID5Layout):
+    name = 'raid5-left-symmetric'
+    left = True
+    symmetric = True
+
+
+class RAID5RightSymmetricLayout(RAID5Layout):
+    name = 'raid5-right-symmetric'
+    symmetric = True
+
+
+## RAID-6: two parity blocks per stripe, P (XOR) and Q (Reed-Solomon, see raid6.py), so that any two
+## servers may fail. Parity rotates as in the left-symmetric RAID-5 layout: P moves left by one server per
+## stripe, Q is on the server after P, and data blocks start on the server after Q and wrap around
+
+class RAID6Layout(RAIDLayout):
+    name = 'raid6'
+    q_parity = True
+
+    def _DataPerStripe(self):
+        return self.num_servers - 2
+
+    def _Stripe(self, stripe_number):
+        parity_server = self.num_servers - 1 - stripe_number % self.num_servers
+        data_servers = [(parity_server + 2 + i) % self.num_servers for i in range(0, self.num_servers - 2)]
+        return data_servers, parity_server, stripe_number
+
+    def _QServer(self, stripe_number):
+        return (self.num_servers - stripe_number % self.num_servers) % self.num_servers
+
+
+## Layouts by name (fsconfig.RAID_LAYOUT)
+
+LAYOUTS = dict((layout.name, layout) for layout in [RAID0Layout, RAID1Layout, RAID4Layout, RAID5Layout,
+                                                    RAID5LeftAsymmetricLayout, RAID5LeftSymmetricLayout,
+                                                    RAID5RightSymmetricLayout, RAID6Layout])
+
+
+## Returns the layout selected in fsconfig
+
+def ConfiguredLayout():
+    if fsconfig.RAID_LAYOUT not in LAYOUTS:
+        logger.error('RAIDLayout: unknown layout %s', fsconfig.RAID_LAYOUT)
+        raise RuntimeError('RAIDLayout: unknown layout ' + str(fsconfig.RAID_LAYOUT))
+    return LAYOUTS[fsconfig.RAID_LAYOUT]()
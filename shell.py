@@ -1,11 +1,13 @@
 import fsconfig
 import os.path
+import sys, codecs
 from block import DiskBlocks
 from inode import Inode
 from inodenumber import InodeNumber
 from filename import FileName
 from fileoperations import FileOperations
 from absolutepath import AbsolutePathName
+from snapshot import Snapshots
 
 ## This class implements an interactive shell to navigate the file system
 
@@ -17,6 +19,7 @@ class FSShell():
         self.FileOperationsObject = FileOperationsObject
         self.AbsolutePathObject = AbsolutePathObject
         self.RawBlocks = RawBlocks
+        self.SnapshotsObject = Snapshots(AbsolutePathObject.FileNameObject)
 
     # block-layer inspection, load/save, and debugging shell commands
     # implements showfsconfig (log fs config contents)
@@ -41,19 +44,25 @@ class FSShell():
         inode.Print()
         return 0
 
-    # implements load (load the specified dump file)
-    def load(self, dumpfilename):
-        if not os.path.isfile(dumpfilename):
-            print("Error: Please provide valid file")
-            return -1
-        self.RawBlocks.LoadFromDump(dumpfilename)
+    # implements load (load the specified dump file, then each incremental dump chained onto it)
+    def load(self, dumpfilename, *deltafilenames):
+        for filename in (dumpfilename,) + deltafilenames:
+            if not os.path.isfile(filename):
+                print("Error: Please provide valid file")
+                return -1
+        status = 0
+        for filename in (dumpfilename,) + deltafilenames:
+            status = self.RawBlocks.LoadFromDump(filename)
+            if status == -1:
+                break
+        # Cached blocks, directory bindings and block fingerprints refer to the previous contents of raw storage
+        self.RawBlocks.InvalidateCaches()
         self.cwd = 0
-        return 0
+        return status
 
-    # implements save (save the file system contents to specified dump file)
-    def save(self, dumpfilename):
-        self.RawBlocks.DumpToDisk(dumpfilename)
-        return 0
+    # implements save [--incremental] (save the file system contents, or the blocks written since the last save or load, to specified dump file)
+    def save(self, dumpfilename, incremental=False):
+        return self.RawBlocks.DumpToDisk(dumpfilename, incremental)
 
     # implements showblock (log block n contents)
     def showblock(self, n):
@@ -118,34 +127,17 @@ class FSShell():
 
     # implements ls (lists files in directory)
     def ls(self):
-        inobj = InodeNumber(self.cwd)
-        inobj.InodeNumberToInode(self.RawBlocks)
-        block_index = 0
-        while block_index <= (inobj.inode.size // fsconfig.BLOCK_SIZE):
-            block = self.RawBlocks.Get(inobj.inode.block_numbers[block_index])
-            if block_index == (inobj.inode.size // fsconfig.BLOCK_SIZE):
-                end_position = inobj.inode.size % fsconfig.BLOCK_SIZE
+        entries = self.FileOperationsObject.FileNameObject.ReadDirPlus(self.cwd)
+        if entries == -1:
+            print("Error: not a directory\n")
+            return -1
+        for entryname, entryinodenumber, inode, target in entries:
+            if inode.type == fsconfig.INODE_TYPE_DIR:
+                print("[" + str(inode.refcnt) + "]:" + entryname + "/")
+            elif inode.type == fsconfig.INODE_TYPE_SYM:
+                print("[" + str(inode.refcnt) + "]:" + entryname + "@ -> " + target)
             else:
-                end_position = fsconfig.BLOCK_SIZE
-            current_position = 0
-            while current_position < end_position:
-                entryname = block[current_position:current_position + fsconfig.MAX_FILENAME]
-                entryinode = block[current_position + fsconfig.MAX_FILENAME:current_position + fsconfig.FILE_NAME_DIRENTRY_SIZE]
-                entryinodenumber = int.from_bytes(entryinode, byteorder='big')
-                inobj2 = InodeNumber(entryinodenumber)
-                inobj2.InodeNumberToInode(self.RawBlocks)
-                if inobj2.inode.type == fsconfig.INODE_TYPE_DIR:
-                    print("[" + str(inobj2.inode.refcnt) + "]:" + entryname.decode() + "/")
-                else:
-                    if inobj2.inode.type == fsconfig.INODE_TYPE_SYM:
-                        target_block_number = inobj2.inode.block_numbers[0]
-                        target_block = self.RawBlocks.Get(target_block_number)
-                        target_slice = target_block[0:inobj2.inode.size]
-                        print("[" + str(inobj2.inode.refcnt) + "]:" + entryname.decode() + "@ -> " + target_slice.decode())
-                    else:
-                        print("[" + str(inobj2.inode.refcnt) + "]:" + entryname.decode())
-                current_position += fsconfig.FILE_NAME_DIRENTRY_SIZE
-            block_index += 1
+                print("[" + str(inode.refcnt) + "]:" + entryname)
         return 0
 
     # implements cat (print file contents)
@@ -159,11 +151,15 @@ class FSShell():
         if inobj.inode.type != fsconfig.INODE_TYPE_FILE:
             print("Error: not a file\n")
             return -1
-        data, errorcode = self.FileOperationsObject.Read(i, 0, fsconfig.MAX_FILE_SIZE)
-        if data == -1:
+        stream, errorcode = self.FileOperationsObject.ReadStream(i, 0)
+        if stream == -1:
             print("Error: " + errorcode)
             return -1
-        print(data.decode())
+        # decode window by window; a character split across two windows is completed by the next one
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for data in stream:
+            sys.stdout.write(decoder.decode(data))
+        print(decoder.decode(b'', final=True))
         return 0
 
     # implements mkdir
@@ -188,18 +184,30 @@ class FSShell():
         if i == -1:
             print("Error: not found\n")
             return -1
-        inobj = InodeNumber(i)
-        inobj.InodeNumberToInode(self.RawBlocks)
-        if inobj.inode.type != fsconfig.INODE_TYPE_FILE:
-            print("Error: not a file\n")
-            return -1
-        written, errorcode = self.FileOperationsObject.Write(i, inobj.inode.size, bytearray(string, "utf-8"))
+        written, errorcode = self.FileOperationsObject.Append(i, bytearray(string, "utf-8"))
         if written == -1:
             print("Error: " + errorcode)
             return -1
         print("Successfully appended " + str(written) + " bytes.")
         return 0
 
+    # implements truncate filename size (shrink a file, or extend it with zeroes)
+    def truncate(self, filename, size):
+        try:
+            size = int(size)
+        except ValueError:
+            print('Error: ' + size + ' not a valid Integer')
+            return -1
+        i = self.AbsolutePathObject.GeneralPathToInodeNumber(filename, self.cwd)
+        if i == -1:
+            print("Error: not found\n")
+            return -1
+        result, errorcode = self.FileOperationsObject.Truncate(i, size)
+        if result == -1:
+            print("Error: " + errorcode)
+            return -1
+        return 0
+
     # implements slice filename offset count ("slice off" contents from a file starting from offset and for count bytes)
     def slice(self, filename, offset, count):
         try:
@@ -260,6 +268,60 @@ class FSShell():
             return -1
         return 0
 
+    # implements cp [--reflink] source name (copy a file; a reflink copy shares the source's data blocks)
+    def cp(self, source, name, reflink):
+        i = self.AbsolutePathObject.GeneralPathToInodeNumber(source, self.cwd)
+        if i == -1:
+            print("Error: not found\n")
+            return -1
+        inobj = InodeNumber(i)
+        inobj.InodeNumberToInode(self.RawBlocks)
+        if inobj.inode.type != fsconfig.INODE_TYPE_FILE:
+            print("Error: not a file\n")
+            return -1
+        if reflink:
+            j, errorcode = self.FileOperationsObject.Clone(i, self.cwd, name)
+            if j == -1:
+                print("Error: " + errorcode)
+                return -1
+            return 0
+        j, errorcode = self.FileOperationsObject.Create(self.cwd, name, fsconfig.INODE_TYPE_FILE)
+        if j == -1:
+            print("Error: " + errorcode)
+            return -1
+        stream, errorcode = self.FileOperationsObject.ReadStream(i, 0)
+        if stream == -1:
+            print("Error: " + errorcode)
+            return -1
+        written, errorcode = self.FileOperationsObject.WriteStream(j, 0, stream)
+        if written == -1:
+            print("Error: " + errorcode)
+            return -1
+        return 0
+
+    # implements snapshot create|delete|restore name, and snapshot list
+    def snapshot(self, action, name=None):
+        if action == "list":
+            for snapshot_name in self.SnapshotsObject.List():
+                print(snapshot_name)
+            return 0
+        if action == "create":
+            i, errorcode = self.SnapshotsObject.Create(name)
+        elif action == "delete":
+            i, errorcode = self.SnapshotsObject.Delete(name)
+        elif action == "restore":
+            i, errorcode = self.SnapshotsObject.Restore(name)
+            # the current directory may not exist in the restored file system
+            if i != -1:
+                self.cwd = 0
+        else:
+            print("Error: unknown snapshot action " + action)
+            return -1
+        if i == -1:
+            print("Error: " + errorcode)
+            return -1
+        return 0
+
     # implements soft link
     def lns(self, target, name):
         i, errorcode = self.AbsolutePathObject.Symlink(target, name, self.cwd)
@@ -283,31 +345,57 @@ class FSShell():
             print(f"Error: Server ID {server_id} is out of range (0-{fsconfig.NO_OF_SERVERS - 1})")
             return -1
 
+        layout = self.RawBlocks.layout
+        if not layout.parity:
+            print(f"Error: the {layout.name} layout has no parity to repair server {server_id} from")
+            return -1
+
         print(f"Starting repair for server {server_id}...")
 
+        # Parity blocks read below must include their pending updates (deferred parity)
+        self.RawBlocks.FlushParity()
+
         server_port = fsconfig.STARTPORT + server_id
 
-        # Track which stripes have already been repaired for this server to avoid redundant work
-        repaired_stripes = set()
+        # Iterate over all stripes
+        for stripe_number in range(0, layout.total_stripes):
+            block_number = layout.StripeBlocks(stripe_number)[0]
+            parity_server_index = layout.stripe_parity_server[stripe_number]
+            offset = layout.stripe_offset[stripe_number]
 
-        # Iterate over all blocks
-        for block_number in range(fsconfig.TOTAL_NUM_BLOCKS):
-            data_server_index, stripe_number, parity_server_index = self.RawBlocks.getServerBlockAndParity(block_number)
+            # Check if this stripe has a block on the failed server
+            if server_id in layout.stripe_data_servers[stripe_number] or parity_server_index == server_id or \
+                    layout.stripe_q_server[stripe_number] == server_id:
+                print(f"Reconstructing block {block_number} on server {server_id}...")
 
-            # Check if this block belongs to the failed server
-            if data_server_index == server_id or parity_server_index == server_id:
-                # Skip if we already repaired this stripe for this server
-                if stripe_number in repaired_stripes:
+                if layout.q_parity:
+                    # RAID-6: the server's block is recovered from the rest of the stripe, even with another server failed
+                    stripe = self.RawBlocks.ReadStripe(stripe_number, exclude=(server_id,))
+                    if stripe is None:
+                        print(f"Error: block {block_number} cannot be reconstructed, too many servers failed")
+                        return -1
+                    data, p, q = stripe
+                    if server_id == parity_server_index:
+                        reconstructed_data = p
+                    elif server_id == layout.stripe_q_server[stripe_number]:
+                        reconstructed_data = q
+                    else:
+                        reconstructed_data = data[layout.stripe_data_servers[stripe_number].index(server_id)]
+                    try:
+                        if self.RawBlocks.block_servers[server_port].Put(offset, reconstructed_data) == -1:
+                            print(f"Error: Failed to write block {block_number} to server {server_id}")
+                            return -1
+                    except ConnectionRefusedError:
+                        print(f"Error: Failed to write block {block_number} to server {server_id}. Server unreachable.")
+                        return -1
+                    print(f"Successfully repaired block {block_number} on server {server_id}")
                     continue
-                repaired_stripes.add(stripe_number)
-
-                print(f"Reconstructing block {block_number} on server {server_id}...")
 
                 try:
                     # Fetch parity data
                     parity_port = fsconfig.STARTPORT + parity_server_index
                     try:
-                        parity_data = self.RawBlocks.block_servers[parity_port].Get(stripe_number)
+                        parity_data = self.RawBlocks.block_servers[parity_port].Get(offset)
                     except ConnectionRefusedError:
                         print(f"Error: Parity server {parity_server_index} is unreachable.")
                         return -1
@@ -319,11 +407,11 @@ class FSShell():
                     reconstructed_data = bytearray(parity_data)
 
                     # XOR with data from all other servers
-                    for i in range(fsconfig.NO_OF_SERVERS):
-                        if i != server_id and i != parity_server_index:
+                    for i in layout.stripe_data_servers[stripe_number]:
+                        if i != server_id:
                             data_port = fsconfig.STARTPORT + i
                             try:
-                                data_block = self.RawBlocks.block_servers[data_port].Get(stripe_number)
+                                data_block = self.RawBlocks.block_servers[data_port].Get(offset)
                                 if data_block:
                                     reconstructed_data = bytes([x ^ y for x, y in zip(reconstructed_data, data_block)])
                             except ConnectionRefusedError:
@@ -331,7 +419,7 @@ class FSShell():
 
                     # Write reconstructed data to the failed server
                     try:
-                        ret = self.RawBlocks.block_servers[server_port].Put(stripe_number, reconstructed_data)
+                        ret = self.RawBlocks.block_servers[server_port].Put(offset, reconstructed_data)
                         if ret == -1:
                             print(f"Error: Failed to write block {block_number} to server {server_id}")
                             return -1
@@ -353,7 +441,10 @@ class FSShell():
     ## Main interpreter loop
     def Interpreter(self):
         while (True):
-            command = input("[cwd=" + str(self.cwd) + "]%")
+            try:
+                command = input("[cwd=" + str(self.cwd) + "]%")
+            except EOFError:
+                return
             splitcmd = command.split()
             if len(splitcmd) == 0:
                 continue
@@ -396,15 +487,20 @@ class FSShell():
                 else:
                     self.showfsconfig()
             elif splitcmd[0] == "load":
-                if len(splitcmd) != 2:
-                    print ("Error: load requires 1 argument")
+                if len(splitcmd) < 2:
+                    print ("Error: load requires at least 1 argument")
                 else:
-                    self.load(splitcmd[1])
+                    self.RawBlocks.Acquire()
+                    self.load(*splitcmd[1:])
+                    self.RawBlocks.Release()
             elif splitcmd[0] == "save":
-                if len(splitcmd) != 2:
+                incremental = len(splitcmd) > 1 and splitcmd[1] == "--incremental"
+                if len(splitcmd) != 2 + incremental:
                     print ("Error: save requires 1 argument")
                 else:
-                    self.save(splitcmd[1])
+                    self.RawBlocks.Acquire()
+                    self.save(splitcmd[-1], incremental)
+                    self.RawBlocks.Release()
             elif splitcmd[0] == "mkdir":
                 if len(splitcmd) != 2:
                     print("Error: mkdir requires one argument")
@@ -435,6 +531,13 @@ class FSShell():
                         self.RawBlocks.Acquire()
                         self.append(splitcmd[1], splitcmd[2])
                         self.RawBlocks.Release()
+            elif splitcmd[0] == "truncate":
+                if len(splitcmd) != 3:
+                    print("Error: truncate requires two arguments")
+                else:
+                    self.RawBlocks.Acquire()
+                    self.truncate(splitcmd[1], splitcmd[2])
+                    self.RawBlocks.Release()
             elif splitcmd[0] == "slice":
                 if len(splitcmd) != 4:
                     print ("Error: slice requires three arguments")
@@ -476,6 +579,28 @@ class FSShell():
                         self.RawBlocks.Acquire()
                         self.lns(splitcmd[1], splitcmd[2])
                         self.RawBlocks.Release()
+            elif splitcmd[0] == "cp":
+                reflink = len(splitcmd) > 1 and splitcmd[1] == "--reflink"
+                if len(splitcmd) != 3 + reflink:
+                    print("Error: cp requires two arguments")
+                else:
+                    if len(splitcmd[-1]) > fsconfig.MAX_FILENAME:
+                        print("Error: filename exceeds maximum length of " + str(fsconfig.MAX_FILENAME) + " characters")
+                    else:
+                        self.RawBlocks.Acquire()
+                        self.cp(splitcmd[-2], splitcmd[-1], reflink)
+                        self.RawBlocks.Release()
+            elif splitcmd[0] == "snapshot":
+                if len(splitcmd) == 2 and splitcmd[1] == "list":
+                    self.RawBlocks.Acquire()
+                    self.snapshot(splitcmd[1])
+                    self.RawBlocks.Release()
+                elif len(splitcmd) != 3:
+                    print("Error: snapshot requires an action (create, list, delete, restore) and a name")
+                else:
+                    self.RawBlocks.Acquire()
+                    self.snapshot(splitcmd[1], splitcmd[2])
+                    self.RawBlocks.Release()
             elif splitcmd[0] == "repair":
                 if len(splitcmd) != 2:
                     print("Error: repair requires one argument (server ID)")
@@ -499,13 +624,9 @@ class FSShell():
                 if len(splitcmd) != 1:
                     print("Error: verifyall does not require arguments")
                 else:
-                    checked_stripes = set()
                     all_consistent = True
-                    for block_number in range(fsconfig.TOTAL_NUM_BLOCKS):
-                        _, stripe_number, _ = self.RawBlocks.getServerBlockAndParity(block_number)
-                        if stripe_number in checked_stripes:
-                            continue
-                        checked_stripes.add(stripe_number)
+                    for stripe_number in range(0, self.RawBlocks.layout.total_stripes):
+                        block_number = self.RawBlocks.layout.StripeBlocks(stripe_number)[0]
                         if not self.RawBlocks.verifyRAID5Consistency(block_number):
                             print(f"RAID 5 consistency check FAILED for block {block_number} (stripe {stripe_number})")
                             all_consistent = False
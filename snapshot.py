@@ -0,0 +1,187 @@
+import fsconfig
+import logging
+from inodenumber import InodeNumber
+
+logger = logging.getLogger(__name__)
+
+#### SNAPSHOT LAYER
+
+
+## This class implements copy-on-write snapshots of the whole file system
+## A snapshot is a copy of the inode table (root directory included), stored in data blocks listed by an
+## index block. Every block reachable from its inodes (data, directory and indirect blocks) is shared with
+## the live file system: the snapshot holds a reference to each in the free bitmap's reference counts, so
+## taking a snapshot costs metadata I/O only, and writers copy shared blocks before modifying them.
+## The snapshot table lives in the superblock; its first entry-sized slot holds the superblock flags and
+## each following slot a snapshot's name and the block number of its index block
+
+class Snapshots():
+    def __init__(self, FileNameObject):
+        self.FileNameObject = FileNameObject
+        self.RawBlocks = FileNameObject.RawBlocks
+
+
+    ## Reads the snapshot table from the superblock
+    ## Returns the superblock and a list of (name, index block number) tuples
+
+    def _ReadTable(self):
+        superblock = self.RawBlocks.Get(fsconfig.SUPERBLOCK_BLOCK_NUMBER)
+        entries = []
+        for slot in range(1, fsconfig.MAX_SNAPSHOTS + 1):
+            index_block = self.FileNameObject.HelperGetFilenameInodeNumber(superblock, slot)
+            if index_block != 0:
+                name = self.FileNameObject.HelperGetFilenameString(superblock, slot)
+                entries.append((name.decode().rstrip('\x00'), index_block))
+        return superblock, entries
+
+
+    ## Writes the snapshot table back to the superblock, keeping its flags
+
+    def _WriteTable(self, superblock, entries):
+        table = bytearray(superblock[0:fsconfig.FILE_NAME_DIRENTRY_SIZE])
+        for name, index_block in entries:
+            table += bytearray(name, "utf-8").ljust(fsconfig.MAX_FILENAME, b'\x00')
+            table += index_block.to_bytes(fsconfig.INODE_NUMBER_DIRENTRY_SIZE, 'big')
+        self.RawBlocks.Put(fsconfig.SUPERBLOCK_BLOCK_NUMBER, table)
+
+
+    ## Returns the block numbers of a snapshot's inode table copy, read from its index block
+
+    def _CopyBlockNumbers(self, index_block):
+        raw_block = self.RawBlocks.Get(index_block)
+        size = fsconfig.INODE_BYTES_STORE_BLOCK_NUMBER
+        return [int.from_bytes(raw_block[i * size:(i + 1) * size], byteorder='big')
+                for i in range(0, fsconfig.INODE_NUM_BLOCKS)]
+
+
+    ## Returns the contents of an inode table (the live one, or a snapshot's copy) as one bytearray
+
+    def _ReadInodeTable(self, block_numbers):
+        blocks = self.RawBlocks.GetBlocks(block_numbers)
+        table = bytearray()
+        for block_number in block_numbers:
+            table += blocks[block_number]
+        return table
+
+
+    ## Returns every block referenced by the inodes of an inode table, with multiplicity
+
+    def _ReferencedBlocks(self, table):
+        referenced = []
+        for inode_number in range(0, fsconfig.MAX_NUM_INODES):
+            inode_object = InodeNumber(inode_number)
+            inode_object.inode.InodeFromBytearray(table[inode_number * fsconfig.INODE_SIZE:(inode_number + 1) * fsconfig.INODE_SIZE])
+            if inode_object.inode.type != fsconfig.INODE_TYPE_INVALID:
+                referenced += inode_object.ReferencedBlocks(self.RawBlocks)
+        return referenced
+
+
+    def _LiveInodeTableBlocks(self):
+        return list(range(fsconfig.INODE_BLOCK_OFFSET, fsconfig.INODE_BLOCK_OFFSET + fsconfig.INODE_NUM_BLOCKS))
+
+
+    ## Returns the names of the snapshots
+
+    def List(self):
+        _, entries = self._ReadTable()
+        return [name for name, _ in entries]
+
+
+    ## Takes a snapshot of the file system, named name
+    ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
+
+    def Create(self, name):
+        logger.debug('Snapshots::Create: %s', name)
+
+        if len(name) == 0 or len(name) > fsconfig.MAX_FILENAME:
+            logger.debug("ERROR_SNAPSHOT_INVALID_NAME %s", name)
+            return -1, "ERROR_SNAPSHOT_INVALID_NAME"
+
+        superblock, entries = self._ReadTable()
+        if name in [n for n, _ in entries]:
+            logger.debug("ERROR_SNAPSHOT_ALREADY_EXISTS %s", name)
+            return -1, "ERROR_SNAPSHOT_ALREADY_EXISTS"
+        if len(entries) >= fsconfig.MAX_SNAPSHOTS or fsconfig.INODE_NUM_BLOCKS > fsconfig.BLOCK_NUMBERS_PER_BLOCK:
+            logger.debug("ERROR_SNAPSHOT_TABLE_FULL %s", name)
+            return -1, "ERROR_SNAPSHOT_TABLE_FULL"
+
+        # Copy the inode table into new blocks, listed by a new index block
+        table = self._ReadInodeTable(self._LiveInodeTableBlocks())
+        new_blocks = self.FileNameObject.AllocateDataBlocks(fsconfig.INODE_NUM_BLOCKS + 1)
+        if new_blocks == -1:
+            logger.debug("ERROR_SNAPSHOT_DATA_BLOCK_NOT_AVAILABLE %s", name)
+            return -1, "ERROR_SNAPSHOT_DATA_BLOCK_NOT_AVAILABLE"
+        index_block = new_blocks[0]
+        copy_blocks = new_blocks[1:]
+
+        # Share every block the inodes reference with the snapshot
+        referenced = self._ReferencedBlocks(table)
+        if self.FileNameObject.IncrementBlockRefCounts(referenced) == -1:
+            self.FileNameObject.FreeDataBlocks(new_blocks)
+            logger.debug("ERROR_SNAPSHOT_TOO_MANY_REFERENCES %s", name)
+            return -1, "ERROR_SNAPSHOT_TOO_MANY_REFERENCES"
+        self.FileNameObject.MarkSharedBlocks()
+
+        blocks = {}
+        index = bytearray()
+        for i, block_number in enumerate(copy_blocks):
+            blocks[block_number] = table[i * fsconfig.BLOCK_SIZE:(i + 1) * fsconfig.BLOCK_SIZE]
+            index += block_number.to_bytes(fsconfig.INODE_BYTES_STORE_BLOCK_NUMBER, 'big')
+        blocks[index_block] = index
+        self.RawBlocks.PutBlocks(blocks)
+
+        # MarkSharedBlocks() may have updated the superblock flags
+        superblock, entries = self._ReadTable()
+        self._WriteTable(superblock, entries + [(name, index_block)])
+        return 0, "SUCCESS"
+
+
+    ## Deletes snapshot name, dropping its references to the blocks it shares
+    ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
+
+    def Delete(self, name):
+        logger.debug('Snapshots::Delete: %s', name)
+
+        superblock, entries = self._ReadTable()
+        found = [index_block for n, index_block in entries if n == name]
+        if not found:
+            logger.debug("ERROR_SNAPSHOT_NOT_FOUND %s", name)
+            return -1, "ERROR_SNAPSHOT_NOT_FOUND"
+
+        copy_blocks = self._CopyBlockNumbers(found[0])
+        referenced = self._ReferencedBlocks(self._ReadInodeTable(copy_blocks))
+        self.FileNameObject.FreeDataBlocks(referenced + copy_blocks + [found[0]])
+
+        self._WriteTable(superblock, [(n, b) for n, b in entries if n != name])
+        return 0, "SUCCESS"
+
+
+    ## Rolls the live file system back to snapshot name (the snapshot is kept)
+    ## Returns (0, "SUCCESS") or (-1, "ERROR_...")
+
+    def Restore(self, name):
+        logger.debug('Snapshots::Restore: %s', name)
+
+        _, entries = self._ReadTable()
+        found = [index_block for n, index_block in entries if n == name]
+        if not found:
+            logger.debug("ERROR_SNAPSHOT_NOT_FOUND %s", name)
+            return -1, "ERROR_SNAPSHOT_NOT_FOUND"
+
+        live_blocks = self._LiveInodeTableBlocks()
+        live_referenced = self._ReferencedBlocks(self._ReadInodeTable(live_blocks))
+        table = self._ReadInodeTable(self._CopyBlockNumbers(found[0]))
+
+        # the restored inodes take their own references before the current ones are dropped,
+        # so blocks common to both are never freed
+        if self.FileNameObject.IncrementBlockRefCounts(self._ReferencedBlocks(table)) == -1:
+            logger.debug("ERROR_SNAPSHOT_TOO_MANY_REFERENCES %s", name)
+            return -1, "ERROR_SNAPSHOT_TOO_MANY_REFERENCES"
+        self.RawBlocks.PutBlocks(dict((block_number, table[i * fsconfig.BLOCK_SIZE:(i + 1) * fsconfig.BLOCK_SIZE])
+                                      for i, block_number in enumerate(live_blocks)))
+        self.FileNameObject.FreeDataBlocks(live_referenced)
+
+        # Cached state refers to the inodes that were replaced
+        self.FileNameObject.InvalidateDentry()
+        self.FileNameObject.reservations = {}
+        return 0, "SUCCESS"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests of the local write intent log (intentlog.IntentLog): replay of the records left by a previous run,
+torn last record included, compaction, and restarting with the stripes still dirty
+"""
+
+import fsconfig
+import pytest
+from intentlog import IntentLog
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(fsconfig, 'INTENT_LOG_MAX_DIRTY', 4, raising=False)
+    monkeypatch.setattr(fsconfig, 'INTENT_LOG_MAX_BYTES', 64, raising=False)
+
+
+def test_replay_torn_record(tmp_path, limits):
+    path = tmp_path / 'intents.log'
+    # the last record was torn by a crash before its stripes were written
+    path.write_text('+1 +2 +3\n-2 +5\n+7 +8')
+    assert IntentLog(str(path)).Replay() == [1, 3, 5]
+
+
+def test_replay_missing_log(tmp_path, limits):
+    assert IntentLog(str(tmp_path / 'intents.log')).Replay() == []
+
+
+def test_begin_end(tmp_path, limits):
+    path = str(tmp_path / 'intents.log')
+    log = IntentLog(path)
+    log.Reset()
+    assert log.Begin([1, 2]) == 0
+    # stripes with writes in flight are never cleaned, however many other stripes are recorded
+    for stripe in range(10, 20):
+        assert log.Begin([stripe]) == 0
+        log.End([stripe])
+    assert 1 in log.dirty and 2 in log.dirty
+    assert len(log.dirty) == fsconfig.INTENT_LOG_MAX_DIRTY
+    assert IntentLog(path).Replay() == sorted(log.dirty)
+
+    # recording a stripe already dirty writes nothing
+    size = (tmp_path / 'intents.log').stat().st_size
+    assert log.Begin([2]) == 0
+    assert (tmp_path / 'intents.log').stat().st_size == size
+    log.End([1, 2])
+    log.End([2])
+    assert not log.active
+
+
+def test_compaction(tmp_path, limits):
+    path = tmp_path / 'intents.log'
+    log = IntentLog(str(path))
+    log.Reset()
+    for stripe in range(0, 200):
+        assert log.Begin([stripe]) == 0
+        log.End([stripe])
+        # rewritten with the live entries only, once past INTENT_LOG_MAX_BYTES
+        assert path.stat().st_size <= fsconfig.INTENT_LOG_MAX_BYTES + len(' +199 -195\n')
+        assert IntentLog(str(path)).Replay() == sorted(log.dirty)
+    assert sorted(log.dirty) == [196, 197, 198, 199]
+
+
+def test_reset_still_dirty(tmp_path, limits):
+    path = str(tmp_path / 'intents.log')
+    log = IntentLog(path)
+    log.Reset()
+    log.Begin([1, 2, 3])
+    log.End([1, 2, 3])
+    # after a restart, the stripes that could not be resynchronized stay dirty, the others are clean
+    log = IntentLog(path)
+    assert log.Replay() == [1, 2, 3]
+    log.Reset([2])
+    assert IntentLog(path).Replay() == [2]
+    assert log.Begin([4]) == 0
+    log.End([4])
+    assert IntentLog(path).Replay() == [2, 4]
@@ -8,6 +8,9 @@ import subprocess
 import time
 import sys
 import os
+import argparse
+import itertools
+import socket
 
 def start_servers(num_servers=4, block_size=128, total_blocks=256):
     """Start the block servers"""
@@ -155,6 +158,456 @@ def test_raid5_failure_recovery():
         if 'fs_process' in locals():
             fs_process.terminate()
 
+## In-process clients: the tests below run the file system layers in the test process, against block servers
+## started on ports of their own (so that tests do not share servers)
+
+_ports = itertools.count(8100, 10)
+
+def start_block_servers(num_servers=4, block_size=128, total_blocks=256):
+    """Start the block servers on unused ports; returns (servers, first port)"""
+    startport = next(_ports)
+    servers = []
+    for i in range(num_servers):
+        servers.append(subprocess.Popen([sys.executable, 'blockserver.py', '-nb', str(total_blocks), '-bs', str(block_size),
+                                         '-port', str(startport + i)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for i in range(num_servers):
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', startport + i), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+    return servers, startport
+
+def stop_block_servers(servers):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        server.wait()
+
+def mount_client(startport, num_servers=4, total_blocks=256, client_id=0, **options):
+    """Configure the file system as fsmain.py does and mount it; returns (RawBlocks, FileObject, FileOperationsObject)"""
+    import fsconfig
+    from block import DiskBlocks
+    from filename import FileName
+    from fileoperations import FileOperations
+    args = argparse.Namespace(total_num_blocks=total_blocks * (num_servers - 1), block_size=128, max_num_inodes=16,
+                              inode_size=16, client_id=client_id, port=startport, startport=startport,
+                              no_of_servers=num_servers, **options)
+    fsconfig.ConfigureFSConstants(args)
+    RawBlocks = DiskBlocks()
+    FileObject = FileName(RawBlocks)
+    RawBlocks.Acquire()
+    FileObject.InitRootInode()
+    RawBlocks.Release()
+    return RawBlocks, FileObject, FileOperations(FileObject)
+
+def create_file(FileOperationsObject, name, data):
+    import fsconfig
+    file_inode_number, errorcode = FileOperationsObject.Create(0, name, fsconfig.INODE_TYPE_FILE)
+    assert file_inode_number != -1, errorcode
+    written, errorcode = FileOperationsObject.Write(file_inode_number, 0, bytearray(data))
+    assert written == len(data), errorcode
+    return file_inode_number
+
+def read_file(FileOperationsObject, file_inode_number):
+    from inodenumber import InodeNumber
+    inode_number = InodeNumber(file_inode_number)
+    inode_number.InodeNumberToInode(FileOperationsObject.FileNameObject.RawBlocks)
+    data, errorcode = FileOperationsObject.Read(file_inode_number, 0, inode_number.inode.size)
+    assert data != -1, errorcode
+    return bytes(data)
+
+def test_slice():
+    """Slice removes count bytes at offset, for cuts aligned on blocks or not"""
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        original = bytes(i % 251 for i in range(768))
+        for name, offset, count in [('a', 128, 128), ('b', 0, 256), ('c', 128, 300), ('d', 100, 128), ('e', 37, 5),
+                                    ('f', 700, 68)]:
+            file_inode_number = create_file(FileOperationsObject, name, original)
+            removed, errorcode = FileOperationsObject.Slice(file_inode_number, offset, count)
+            assert removed == count, (name, errorcode)
+            assert read_file(FileOperationsObject, file_inode_number) == original[:offset] + original[offset + count:], name
+    finally:
+        stop_block_servers(servers)
+
+def test_append_truncate():
+    """Shrinking a file frees its tail blocks and growing it again reads zeroes, not the stale bytes"""
+    import fsconfig
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        original = bytes(i % 251 for i in range(300))
+        file_inode_number = create_file(FileOperationsObject, 'f', original)
+        used = used_data_blocks(FileObject)
+        tail = file_block_numbers(FileObject, file_inode_number)[1:]
+
+        assert FileOperationsObject.Truncate(file_inode_number, 100) == (0, "SUCCESS")
+        assert read_file(FileOperationsObject, file_inode_number) == original[:100]
+        assert set(FileObject.GetBlockRefCounts(tail).values()) == {0}
+        assert used_data_blocks(FileObject) == used - len(tail)
+
+        # the bytes past 100 in the last block are stale: growing the file zeroes them
+        assert FileOperationsObject.Truncate(file_inode_number, 400) == (0, "SUCCESS")
+        assert read_file(FileOperationsObject, file_inode_number) == original[:100] + bytes(300)
+        assert FileOperationsObject.Append(file_inode_number, bytearray(b'a' * 50)) == (50, "SUCCESS")
+        assert read_file(FileOperationsObject, file_inode_number) == original[:100] + bytes(300) + b'a' * 50
+        # writing past the end leaves a hole
+        assert FileOperationsObject.Write(file_inode_number, 600, bytearray(b'w')) == (1, "SUCCESS")
+        assert read_file(FileOperationsObject, file_inode_number) == original[:100] + bytes(300) + b'a' * 50 + bytes(150) + b'w'
+
+        assert FileOperationsObject.Truncate(file_inode_number, 0) == (0, "SUCCESS")
+        assert read_file(FileOperationsObject, file_inode_number) == b''
+        # the file's first data block and its indirect block go too: only the root directory's block is left
+        assert used_data_blocks(FileObject) == used - len(tail) - 2 == 1
+        assert FileOperationsObject.Truncate(file_inode_number, fsconfig.MAX_FILE_SIZE + 1)[0] == -1
+    finally:
+        stop_block_servers(servers)
+
+def used_data_blocks(FileObject):
+    import fsconfig
+    counts = FileObject.GetBlockRefCounts(range(fsconfig.DATA_BLOCKS_OFFSET, fsconfig.TOTAL_NUM_BLOCKS))
+    return sum(1 for count in counts.values() if count)
+
+def test_mirror():
+    """Mirror reverses a file's bytes, whatever its size"""
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        for size in [1, 100, 128, 129, 300, 768, 1000]:
+            original = bytes(i % 251 for i in range(size))
+            file_inode_number = create_file(FileOperationsObject, 'm' + str(size), original)
+            result, errorcode = FileOperationsObject.Mirror(file_inode_number)
+            assert result == 0, (size, errorcode)
+            assert read_file(FileOperationsObject, file_inode_number) == original[::-1], size
+    finally:
+        stop_block_servers(servers)
+
+def file_block_numbers(FileObject, file_inode_number):
+    """Raw block numbers of a file's data blocks, in order"""
+    import fsconfig
+    from inodenumber import InodeNumber
+    inode_number = InodeNumber(file_inode_number)
+    inode_number.InodeNumberToInode(FileObject.RawBlocks)
+    num_blocks = (inode_number.inode.size + fsconfig.BLOCK_SIZE - 1) // fsconfig.BLOCK_SIZE
+    return [inode_number.IndexToBlockNumber(FileObject.RawBlocks, index) for index in range(0, num_blocks)]
+
+def max_refcount(FileObject):
+    import fsconfig
+    return max(FileObject.GetBlockRefCounts(range(fsconfig.DATA_BLOCKS_OFFSET, fsconfig.TOTAL_NUM_BLOCKS)).values())
+
+def test_snapshots():
+    """A snapshot shares the file system's blocks: writes after it copy them, restoring it brings the old contents
+    back, and deleting it frees the blocks only it referenced"""
+    from snapshot import Snapshots
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        SnapshotsObject = Snapshots(FileObject)
+        original = bytes(i % 251 for i in range(500))
+        file_inode_number = create_file(FileOperationsObject, 'f', original)
+        used = used_data_blocks(FileObject)
+
+        assert SnapshotsObject.Create('s1') == (0, "SUCCESS")
+        assert SnapshotsObject.List() == ['s1']
+        counts = FileObject.GetBlockRefCounts(file_block_numbers(FileObject, file_inode_number))
+        assert set(counts.values()) == {2}
+
+        # the overwritten blocks are copied, the snapshot keeps the old ones
+        assert FileOperationsObject.Write(file_inode_number, 0, bytearray(b'y' * 100))[0] == 100
+        assert FileOperationsObject.Append(file_inode_number, bytearray(b'z' * 300))[0] == 300
+        create_file(FileOperationsObject, 'g', b'after the snapshot')
+        assert read_file(FileOperationsObject, file_inode_number) == b'y' * 100 + b'z' * 300
+        counts = FileObject.GetBlockRefCounts(file_block_numbers(FileObject, file_inode_number))
+        assert set(counts.values()) == {1}
+
+        assert SnapshotsObject.Restore('s1') == (0, "SUCCESS")
+        assert read_file(FileOperationsObject, FileObject.Lookup('f', 0)) == original
+        assert FileObject.Lookup('g', 0) == -1
+        assert SnapshotsObject.Restore('missing') == (-1, "ERROR_SNAPSHOT_NOT_FOUND")
+
+        # the blocks written after the snapshot were freed by the restore, its own ones by the delete
+        assert SnapshotsObject.Delete('s1') == (0, "SUCCESS")
+        assert SnapshotsObject.List() == []
+        assert used_data_blocks(FileObject) == used
+        assert max_refcount(FileObject) == 1
+        assert read_file(FileOperationsObject, FileObject.Lookup('f', 0)) == original
+    finally:
+        stop_block_servers(servers)
+
+def test_reflink_copy():
+    """cp --reflink shares the source's data blocks; writing to either copy leaves the other one unchanged"""
+    import fsconfig
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        original = bytes(i % 251 for i in range(500))
+        file_inode_number = create_file(FileOperationsObject, 'f', original)
+        used = used_data_blocks(FileObject)
+
+        clone_inode_number, errorcode = FileOperationsObject.Clone(file_inode_number, 0, 'c')
+        assert clone_inode_number != -1, errorcode
+        assert file_block_numbers(FileObject, clone_inode_number) == file_block_numbers(FileObject, file_inode_number)
+        assert read_file(FileOperationsObject, clone_inode_number) == original
+        # only the clone's indirect block is new
+        assert used_data_blocks(FileObject) == used + 1
+
+        # the clone's partial last block is copied before the append fills it
+        assert FileOperationsObject.Append(clone_inode_number, bytearray(b'c' * 100))[0] == 100
+        assert read_file(FileOperationsObject, clone_inode_number) == original + b'c' * 100
+        assert read_file(FileOperationsObject, file_inode_number) == original
+        # the source's block 2 is copied, its block 3 is no longer shared and is written in place
+        modified = original[:2 * fsconfig.BLOCK_SIZE] + b'f' * fsconfig.BLOCK_SIZE + original[3 * fsconfig.BLOCK_SIZE:]
+        assert FileOperationsObject.Write(file_inode_number, 2 * fsconfig.BLOCK_SIZE,
+                                          bytearray(modified[2 * fsconfig.BLOCK_SIZE:]))[0] == 500 - 2 * fsconfig.BLOCK_SIZE
+        assert read_file(FileOperationsObject, file_inode_number) == modified
+        assert read_file(FileOperationsObject, clone_inode_number) == original + b'c' * 100
+        # copies of blocks 2 and 3, and the clone's new block 4; blocks 0 and 1 are still shared
+        assert file_block_numbers(FileObject, clone_inode_number)[:2] == file_block_numbers(FileObject, file_inode_number)[:2]
+        assert used_data_blocks(FileObject) == used + 1 + 3
+
+        assert FileOperationsObject.Unlink(0, 'c')[0] != -1
+        assert read_file(FileOperationsObject, file_inode_number) == modified
+        assert used_data_blocks(FileObject) == used
+        assert max_refcount(FileObject) == 1
+    finally:
+        stop_block_servers(servers)
+
+def test_dedup():
+    """With deduplication, identical blocks share one raw block; overwriting one copy leaves the other intact"""
+    import fsconfig
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport, dedup=True)
+        block = bytes(i % 251 for i in range(fsconfig.BLOCK_SIZE))
+        used = used_data_blocks(FileObject)
+        a = create_file(FileOperationsObject, 'a', block)
+        b = create_file(FileOperationsObject, 'b', block)
+        shared = file_block_numbers(FileObject, a)
+        assert file_block_numbers(FileObject, b) == shared
+        assert FileObject.GetBlockRefCounts(shared) == {shared[0]: 2}
+        assert used_data_blocks(FileObject) == used + 1
+
+        assert FileOperationsObject.Write(a, 0, bytearray(b'a' * fsconfig.BLOCK_SIZE))[0] == fsconfig.BLOCK_SIZE
+        assert read_file(FileOperationsObject, a) == b'a' * fsconfig.BLOCK_SIZE
+        assert read_file(FileOperationsObject, b) == block
+        assert file_block_numbers(FileObject, b) == shared
+        assert FileObject.GetBlockRefCounts(shared) == {shared[0]: 1}
+        assert used_data_blocks(FileObject) == used + 2
+    finally:
+        stop_block_servers(servers)
+
+def test_indirect_blocks():
+    """A file larger than its inode's direct blocks goes through single and double indirect blocks, reads back,
+    and truncating it frees its data and indirect blocks"""
+    import fsconfig
+    from inodenumber import InodeNumber
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        # 16-byte inodes: two block numbers, direct pointers until the file needs more, then a single indirect
+        # block of 32 block numbers and a double indirect one
+        assert fsconfig.INODE_DIRECT_BLOCK_NUMBERS == 0 and fsconfig.BLOCK_NUMBERS_PER_BLOCK == 32
+        assert fsconfig.MAX_FILE_SIZE == (32 + 32 * 32) * fsconfig.BLOCK_SIZE
+        used = used_data_blocks(FileObject)
+
+        num_blocks = 40
+        original = bytes(i % 251 for i in range(num_blocks * fsconfig.BLOCK_SIZE - 10))
+        file_inode_number = create_file(FileOperationsObject, 'big', original)
+        inode_number = InodeNumber(file_inode_number)
+        inode_number.InodeNumberToInode(RawBlocks)
+        assert inode_number.inode.flags & fsconfig.INODE_FLAG_INDIRECT
+        assert read_file(FileOperationsObject, file_inode_number) == original
+        # data blocks, the single indirect block, and the double indirect block with one block of pointers
+        assert used_data_blocks(FileObject) == used + num_blocks + 3
+
+        # back within the single indirect block: the double indirect blocks go too
+        assert FileOperationsObject.Truncate(file_inode_number, 20 * fsconfig.BLOCK_SIZE)[0] == 0
+        assert read_file(FileOperationsObject, file_inode_number) == original[:20 * fsconfig.BLOCK_SIZE]
+        assert used_data_blocks(FileObject) == used + 20 + 1
+
+        assert FileOperationsObject.Truncate(file_inode_number, 100)[0] == 0
+        assert read_file(FileOperationsObject, file_inode_number) == original[:100]
+        assert used_data_blocks(FileObject) == used + 1 + 1
+
+        assert FileOperationsObject.Truncate(file_inode_number, 0)[0] == 0
+        assert used_data_blocks(FileObject) == used
+
+        # growing leaves a hole, read as zeroes
+        assert FileOperationsObject.Truncate(file_inode_number, 5000)[0] == 0
+        assert read_file(FileOperationsObject, file_inode_number) == bytes(5000)
+    finally:
+        stop_block_servers(servers)
+
+def test_dump_round_trip(tmp_path):
+    """A full dump and an incremental one saved on one array restore the same files on a blank array; a delta
+    is refused unless its base dump was loaded first"""
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        first = bytes(i % 251 for i in range(700))
+        create_file(FileOperationsObject, 'one', first)
+        assert RawBlocks.DumpToDisk(str(tmp_path / 'full.bin')) == 0
+        # small enough a change for the delta to hold only the blocks it wrote
+        second = b'written after the full dump'
+        create_file(FileOperationsObject, 'two', second)
+        assert RawBlocks.DumpToDisk(str(tmp_path / 'delta.bin'), True) == 0
+        assert os.path.getsize(tmp_path / 'delta.bin') < os.path.getsize(tmp_path / 'full.bin')
+    finally:
+        stop_block_servers(servers)
+
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+        assert RawBlocks.LoadFromDump(str(tmp_path / 'delta.bin')) == -1
+        assert RawBlocks.LoadFromDump(str(tmp_path / 'full.bin')) == 0
+        RawBlocks.InvalidateCaches()
+        assert read_file(FileOperationsObject, FileObject.Lookup('one', 0)) == first
+        assert FileObject.Lookup('two', 0) == -1
+        assert RawBlocks.LoadFromDump(str(tmp_path / 'delta.bin')) == 0
+        RawBlocks.InvalidateCaches()
+        assert read_file(FileOperationsObject, FileObject.Lookup('one', 0)) == first
+        assert read_file(FileOperationsObject, FileObject.Lookup('two', 0)) == second
+        assert RawBlocks.verifyAllRAID5Consistency()
+    finally:
+        stop_block_servers(servers)
+
+def test_deferred_parity_folded_at_exit():
+    """Parity updates still pending when the shell exits (or its input ends) are folded before the client exits"""
+    for last_command in ['exit', '']:
+        servers, startport = start_block_servers()
+        try:
+            subprocess.run([sys.executable, 'fsmain.py', '-nb', '768', '-bs', '128', '-ni', '16', '-is', '16', '-cid', '0',
+                            '-port', str(startport), '-startport', str(startport), '-ns', '4', '-pf', '30', '-lt', '0',
+                            '-lp', 'production'],
+                           input='create f\nappend f ' + 'x' * 500 + '\n' + last_command + '\n', capture_output=True,
+                           text=True, timeout=60)
+            RawBlocks, FileObject, FileOperationsObject = mount_client(startport)
+            assert RawBlocks.verifyAllRAID5Consistency(), last_command
+        finally:
+            stop_block_servers(servers)
+
+def test_deferred_parity_write_failure(tmp_path):
+    """Stripes whose parity could not be written when folding deferred updates stay dirty in the intent log"""
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport, parity_flush_interval=30, lease_time=0,
+                                                                   intent_log=str(tmp_path / 'intents.log'))
+        create_file(FileOperationsObject, 'f', b'x' * 500)
+        pending = sorted(RawBlocks.parity_deltas)
+        assert pending
+
+        # parity writes fail, including those of the resynchronization that follows
+        multicall_server = RawBlocks._MultiCallServer
+        RawBlocks._MultiCallServer = lambda server_index, calls: \
+            None if calls[0][0] == 'Put' else multicall_server(server_index, calls)
+        assert RawBlocks.FlushParity() == -1
+        assert all(stripe in RawBlocks.intent_log.active for stripe in pending)
+        assert not RawBlocks.parity_deltas
+
+        RawBlocks._MultiCallServer = multicall_server
+        assert RawBlocks.ResyncStripes(pending) == []
+        assert RawBlocks.verifyAllRAID5Consistency()
+    finally:
+        stop_block_servers(servers)
+
+def test_raid6_write_faults():
+    """RAID-6 writes fail once more than two servers of a stripe did not store their blocks, whether unreachable or
+    answering with a fault"""
+    servers, startport = start_block_servers()
+    try:
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport, total_blocks=170, raid_layout='raid6')
+        block_number = 40
+        stripe_number = RawBlocks.getServerBlockAndParity(block_number)[1]
+        written = [RawBlocks.getServerBlockAndParity(block_number)[0], RawBlocks.getStripeParityServer(stripe_number),
+                   RawBlocks.layout.stripe_q_server[stripe_number]]
+
+        # the Put multicalls to faulting servers get no reply, as when the server answers with a Fault
+        multicall_server = RawBlocks._MultiCallServer
+        for faulting, expected in [(written[:1], 0), (written[1:], 0), (written, -1)]:
+            RawBlocks._MultiCallServer = lambda server_index, calls: \
+                None if calls[0][0] == 'Put' and server_index in faulting else multicall_server(server_index, calls)
+            assert RawBlocks.PutBlocks({block_number: bytearray(b'z' * 128)}) == expected, faulting
+        assert not RawBlocks.failed_servers
+    finally:
+        stop_block_servers(servers)
+
+def test_lease_handoff():
+    """Two clients take turns on the file system lock: the next holder sees what the previous one wrote, and a
+    client whose lease expired during an operation can no longer write"""
+    servers, startport = start_block_servers()
+    try:
+        A = mount_client(startport, client_id=0, lease_time=1.0)
+        B = mount_client(startport, client_id=1, lease_time=1.0)
+        A[0].Acquire()
+        create_file(A[2], 'f', b'from client 0')
+        assert A[1].Lookup('f', 0) != -1
+        A[0].Release()
+
+        B[0].Acquire()
+        assert read_file(B[2], B[1].Lookup('f', 0)) == b'from client 0'
+        assert B[2].Unlink(0, 'f')[0] != -1
+        create_file(B[2], 'g', b'from client 1')
+        B[0].Release()
+
+        # A's dentry and block caches still hold f: the handoff drops them
+        A[0].Acquire()
+        assert A[1].Lookup('f', 0) == -1
+        assert read_file(A[2], A[1].Lookup('g', 0)) == b'from client 1'
+        A[0].Release()
+
+        # A stalls past its lease (the renewer is held off), and B takes the lock in the meantime
+        A[0].Acquire()
+        g_inode_number = A[1].Lookup('g', 0)
+        with A[0].lease_mutex:
+            time.sleep(1.2)
+            B[0].Acquire()
+            create_file(B[2], 'h', b'written while client 0 stalled')
+            B[0].Release()
+        block = bytearray(128)
+        assert A[0].Put(0, block) == -1
+        assert A[0].PutBlocks({1: block}) == -1
+        # (the layers above ignore the refused writes: what matters is that none reaches the servers)
+        A[2].Write(g_inode_number, 0, bytearray(b'lost'))
+        A[0].Release()
+
+        B[0].Acquire()
+        assert read_file(B[2], B[1].Lookup('g', 0)) == b'from client 1'
+        assert read_file(B[2], B[1].Lookup('h', 0)) == b'written while client 0 stalled'
+        assert B[0].verifyAllRAID5Consistency()
+        B[0].Release()
+    finally:
+        stop_block_servers(servers)
+
+def test_dirty_region_bitmap_raid6():
+    """Under RAID-6, recording a write in the dirty-region bitmap keeps both P and Q of the bitmap's stripe up to date"""
+    import fsconfig
+    servers, startport = start_block_servers()
+    try:
+        # two data blocks per stripe: 170 blocks per server fit in the servers' 256
+        RawBlocks, FileObject, FileOperationsObject = mount_client(startport, total_blocks=170, raid_layout='raid6',
+                                                                   dirty_region_stripes=2)
+        assert RawBlocks.intent_log.dirty
+        file_inode_number = create_file(FileOperationsObject, 'f', b'x' * 500)
+        assert RawBlocks.verifyRAID5Consistency(fsconfig.DIRTY_REGION_BLOCK_NUMBER)
+        assert read_file(FileOperationsObject, file_inode_number) == b'x' * 500
+        assert RawBlocks.verifyAllRAID5Consistency()
+
+        # a write whose intent cannot be recorded is refused: the bitmap is the only block written
+        writes = []
+        RawBlocks.RAID6PutBlocks = lambda blocks: writes.append(sorted(blocks)) or -1
+        last_block = fsconfig.TOTAL_NUM_BLOCKS - 1
+        assert RawBlocks.Put(last_block, bytearray(b'y' * 128)) == -1
+        assert writes == [[fsconfig.DIRTY_REGION_BLOCK_NUMBER]]
+        assert not RawBlocks.intent_log.active
+        del RawBlocks.RAID6PutBlocks
+        assert RawBlocks.Put(last_block, bytearray(b'y' * 128)) == 0
+        assert RawBlocks.verifyRAID5Consistency(fsconfig.DIRTY_REGION_BLOCK_NUMBER)
+    finally:
+        stop_block_servers(servers)
+
 if __name__ == "__main__":
     print("RAID 5 Implementation Test Suite")
     print("=================================")
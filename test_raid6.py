@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests of the RAID-6 arithmetic (raid6.py): P and Q encoding, and recovery of every one or two missing blocks
+of a stripe, with the bytes.translate backend and, when NumPy is installed, the NumPy one
+"""
+
+import itertools
+import os
+import pytest
+import raid6
+
+BLOCK_SIZE = 128
+
+BACKENDS = [pytest.param(raid6.SyndromesPython, id='python'),
+            pytest.param(raid6.SyndromesNumPy, id='numpy',
+                         marks=pytest.mark.skipif(raid6.numpy is None, reason='NumPy is not installed'))]
+
+
+def stripe(data_blocks):
+    return [bytearray(os.urandom(BLOCK_SIZE)) for _ in range(data_blocks)]
+
+
+def reference_syndromes(data):
+    """P and Q computed byte by byte from the definition: P = sum D_i, Q = sum g^i D_i"""
+    p = bytearray(BLOCK_SIZE)
+    q = bytearray(BLOCK_SIZE)
+    for i, block in enumerate(data):
+        for j in range(BLOCK_SIZE):
+            p[j] ^= block[j]
+            q[j] ^= raid6.Multiply(raid6.EXP[i], block[j])
+    return p, q
+
+
+@pytest.fixture
+def syndromes(request):
+    default_syndromes = raid6.Syndromes
+    raid6.Syndromes = request.param
+    yield request.param
+    raid6.Syndromes = default_syndromes
+
+
+def test_field():
+    for a in range(1, 256):
+        assert raid6.Multiply(a, raid6.Inverse(a)) == 1
+        assert raid6.Multiply(a, 1) == a
+        assert raid6.Multiply(a, 0) == 0
+    assert raid6.Multiply(0x80, 2) == raid6.GF_POLYNOMIAL & 0xff
+
+
+@pytest.mark.parametrize('syndromes', BACKENDS, indirect=True)
+@pytest.mark.parametrize('data_blocks', [1, 2, 4, 6])
+def test_encode(syndromes, data_blocks):
+    data = stripe(data_blocks)
+    assert syndromes(data) == reference_syndromes(data)
+    assert syndromes(data) == raid6.SyndromesPython(data)
+
+
+@pytest.mark.parametrize('syndromes', BACKENDS, indirect=True)
+@pytest.mark.parametrize('data_blocks', [2, 4, 6])
+def test_recover(syndromes, data_blocks):
+    data = stripe(data_blocks)
+    p, q = raid6.SyndromesPython(data)
+    blocks = list(range(data_blocks)) + ['P', 'Q']
+    for missing in itertools.chain(itertools.combinations(blocks, 1), itertools.combinations(blocks, 2)):
+        recovered = raid6.Recover([None if i in missing else block for i, block in enumerate(data)],
+                                  None if 'P' in missing else p, None if 'Q' in missing else q)
+        assert recovered == (data, p, q), missing
+
+
+def test_recover_three_missing():
+    data = stripe(4)
+    p, q = raid6.SyndromesPython(data)
+    assert raid6.Recover([None, None] + data[2:], None, q) is None